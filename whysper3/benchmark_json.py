@@ -0,0 +1,105 @@
+import argparse
+import json
+import time
+from typing import List
+from matrix_json import available_codecs, get_codec
+
+# Size of the generated sync payload when no recorded ones are given
+SYNTHETIC_ROOMS = 50
+SYNTHETIC_EVENTS_PER_ROOM = 100
+
+
+def synthetic_sync_payload(rooms: int = SYNTHETIC_ROOMS, events_per_room: int = SYNTHETIC_EVENTS_PER_ROOM) -> bytes:
+    """
+    Build a /sync response shaped like the ones an initial sync returns.
+
+    Args:
+        rooms (int): Number of joined rooms
+        events_per_room (int): Number of timeline events in each room
+
+    Returns:
+        bytes: The encoded response
+    """
+    join = {}
+    for room in range(rooms):
+        events = []
+        for index in range(events_per_room):
+            events.append({
+                "type": "m.room.message",
+                "sender": f"@user{index % 7}:matrix.org",
+                "content": {
+                    "msgtype": "m.text",
+                    "body": f"Message {index} in room {room}, with some text to make it a typical length",
+                    "format": "org.matrix.custom.html",
+                    "formatted_body": f"<p>Message {index} in room {room}</p>"
+                },
+                "event_id": f"$event{room}-{index}:matrix.org",
+                "origin_server_ts": 1700000000000 + index,
+                "unsigned": {"age": 1234 + index}
+            })
+        join[f"!room{room}:matrix.org"] = {
+            "timeline": {"events": events, "limited": True, "prev_batch": f"t{room}"},
+            "state": {"events": []},
+            "ephemeral": {"events": []}
+        }
+    return json.dumps({"next_batch": "s1", "rooms": {"join": join}}).encode("utf-8")
+
+
+def time_call(function, argument, repeat: int) -> float:
+    """
+    Time the fastest of several calls.
+
+    Args:
+        function: The function to time
+        argument: Its argument
+        repeat (int): Number of calls
+
+    Returns:
+        float: The fastest call in seconds
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(argument)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run(payloads: List[bytes], repeat: int) -> None:
+    """
+    Print how long each installed codec takes to decode and encode the payloads.
+
+    Args:
+        payloads (List[bytes]): The response bodies
+        repeat (int): Number of runs per payload, the fastest one counts
+    """
+    total_bytes = sum(len(payload) for payload in payloads)
+    print(f"{len(payloads)} payload(s), {total_bytes / 1024:.0f} KiB, best of {repeat}")
+    decoded = [json.loads(payload) for payload in payloads]
+    for name in available_codecs():
+        codec = get_codec(name)
+        loads = sum(time_call(codec.loads, payload, repeat) for payload in payloads)
+        dumps = sum(time_call(codec.dumps, value, repeat) for value in decoded)
+        print(f"{name:>8}: loads {loads * 1000:8.2f} ms ({total_bytes / loads / 1e6:7.1f} MB/s), "
+              f"dumps {dumps * 1000:8.2f} ms")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare the JSON codecs on sync payloads")
+    parser.add_argument("payloads", nargs="*",
+                        help="Files with recorded /sync or /messages response bodies, a synthetic one if none")
+    parser.add_argument("--repeat", type=int, default=20, help="Number of runs per payload")
+    args = parser.parse_args()
+
+    if args.payloads:
+        payloads = []
+        for path in args.payloads:
+            with open(path, "rb") as file:
+                payloads.append(file.read())
+    else:
+        payloads = [synthetic_sync_payload()]
+    run(payloads, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
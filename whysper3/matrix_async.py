@@ -0,0 +1,502 @@
+import aiohttp
+import asyncio
+import json
+from typing import AsyncIterator, BinaryIO, Dict, List, Optional, Union
+import itertools
+import os
+import mimetypes
+import uuid
+from urllib.parse import quote
+from matrix_sync import DEFAULT_SYNC_FILTER
+from matrix_upload import prepare_image
+from matrix_event import Event
+
+
+class AsyncMatrixClient:
+    def __init__(self, homeserver_url: str, max_connections: int = 100):
+        """
+        Initialize the asyncio Matrix client.
+
+        It offers the same operations as MatrixLogin as coroutines. All requests
+        share one pooled aiohttp session, so a single event loop can drive many
+        concurrent operations, rooms and accounts without extra threads.
+
+        Args:
+            homeserver_url (str): The URL of the Matrix homeserver (e.g., 'https://matrix.org')
+            max_connections (int): Maximum number of pooled connections to the homeserver
+        """
+        self.homeserver_url = homeserver_url.rstrip('/')
+        self.max_connections = max_connections
+        self.session = None
+        self.access_token = None
+        self.user_id = None
+        self.device_id = None
+        self.next_batch = None
+        self.sync_filter_id = None
+        self.inline_sync_filter = None
+        self.pagination_tokens = {}  # room_id -> {"start": token, "end": token}
+        self.txn_prefix = uuid.uuid4().hex[:12]
+        self.txn_counter = itertools.count(1)
+
+    async def __aenter__(self) -> 'AsyncMatrixClient':
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        await self.close()
+
+    def get_session(self) -> aiohttp.ClientSession:
+        """
+        Get the pooled HTTP session, creating it on first use.
+
+        Returns:
+            aiohttp.ClientSession: The client's HTTP session
+        """
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections)
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
+
+    async def close(self) -> None:
+        """
+        Close the HTTP session and its connections.
+        """
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def auth_headers(self) -> Dict:
+        """
+        Get the headers authenticating a request.
+
+        Returns:
+            Dict: The Authorization header
+        """
+        return {"Authorization": f"Bearer {self.access_token}"}
+
+    async def request(self, method: str, path: str, description: str, **kwargs) -> Optional[Dict]:
+        """
+        Make a request to the client-server API and decode the JSON response.
+
+        Args:
+            method (str): The HTTP method
+            path (str): The path below the homeserver URL
+            description (str): What the request does, for error messages
+            **kwargs: Passed on to aiohttp
+
+        Returns:
+            Optional[Dict]: The response if successful, None if failed
+        """
+        try:
+            async with self.get_session().request(method, f"{self.homeserver_url}{path}", **kwargs) as response:
+                if response.status == 200:
+                    return await response.json(content_type=None)
+                else:
+                    print(f"Failed to {description} with status code: {response.status}")
+                    print(f"Response: {await response.text()}")
+                    return None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"Error trying to {description}: {str(e)}")
+            return None
+
+    async def register(self, username: str, password: str, display_name: Optional[str] = None) -> Optional[Dict]:
+        """
+        Register a new account on the Matrix homeserver.
+
+        Args:
+            username (str): The desired username (without the @ and homeserver part)
+            password (str): The desired password
+            display_name (Optional[str]): The display name for the account
+
+        Returns:
+            Optional[Dict]: The registration response if successful, None if failed
+        """
+        payload = {
+            "auth": {
+                "type": "m.login.dummy"
+            },
+            "username": username,
+            "password": password,
+            "inhibit_login": False
+        }
+
+        if display_name:
+            payload["displayname"] = display_name
+
+        response_data = await self.request("POST", "/_matrix/client/r0/register", "register",
+                                           json=payload, params={"kind": "user"})
+        if response_data:
+            self.access_token = response_data.get('access_token')
+            self.user_id = response_data.get('user_id')
+            self.device_id = response_data.get('device_id')
+            self.sync_filter_id = None
+            self.inline_sync_filter = None
+        return response_data
+
+    async def login(self, username: str, password: str) -> Optional[Dict]:
+        """
+        Attempt to login to the Matrix homeserver.
+
+        Args:
+            username (str): The Matrix username (e.g., '@user:matrix.org')
+            password (str): The account password
+
+        Returns:
+            Optional[Dict]: The login response containing access token and user ID if successful,
+                          None if login failed
+        """
+        payload = {
+            "type": "m.login.password",
+            "identifier": {
+                "type": "m.id.user",
+                "user": username
+            },
+            "password": password
+        }
+
+        response_data = await self.request("POST", "/_matrix/client/r0/login", "login", json=payload)
+        if response_data:
+            self.access_token = response_data.get('access_token')
+            self.user_id = response_data.get('user_id')
+            self.device_id = response_data.get('device_id')
+            self.sync_filter_id = None
+            self.inline_sync_filter = None
+        return response_data
+
+    async def join_room(self, room_id_or_alias: str) -> Optional[Dict]:
+        """
+        Join a Matrix room using its ID or alias.
+
+        Args:
+            room_id_or_alias (str): The room ID (e.g., '!room:matrix.org') or alias (e.g., '#room:matrix.org')
+
+        Returns:
+            Optional[Dict]: The join response if successful, None if failed
+        """
+        if not self.access_token:
+            print("Not logged in. Please login first.")
+            return None
+
+        return await self.request("POST", f"/_matrix/client/r0/join/{quote(room_id_or_alias, safe='')}",
+                                  "join room", headers=self.auth_headers())
+
+    async def get_joined_rooms(self) -> Optional[Dict]:
+        """
+        Get a list of rooms the user has joined.
+
+        Returns:
+            Optional[Dict]: The response containing joined rooms if successful, None if failed
+        """
+        if not self.access_token:
+            print("Not logged in. Please login first.")
+            return None
+
+        return await self.request("GET", "/_matrix/client/r0/joined_rooms", "get joined rooms",
+                                  headers=self.auth_headers())
+
+    async def send_event(self, room_id: str, event_type: str, content: Dict,
+                         txn_id: Optional[str] = None, max_retries: int = 5) -> Optional[Dict]:
+        """
+        Send an event to a room, waiting out rate limits with the same transaction ID.
+
+        Args:
+            room_id (str): The room ID
+            event_type (str): The event type (e.g., 'm.room.message')
+            content (Dict): The event content
+            txn_id (Optional[str]): The transaction ID to use, None to create one
+            max_retries (int): Number of times a request failing with a server or network error
+                is retried, rate limited requests are retried until the server accepts them
+
+        Returns:
+            Optional[Dict]: The send response if successful, None if failed
+        """
+        if not self.access_token:
+            print("Not logged in. Please login first.")
+            return None
+
+        txn_id = txn_id or f"{self.txn_prefix}.{next(self.txn_counter)}"
+        url = (f"{self.homeserver_url}/_matrix/client/r0/rooms/{quote(room_id, safe='')}"
+               f"/send/{quote(event_type, safe='')}/{quote(txn_id, safe='')}")
+
+        attempt = 0  # Failed attempts, rate limits don't count
+        rate_limits = 0
+        while True:
+            retry_after_ms = None
+            try:
+                async with self.get_session().put(url, json=content, headers=self.auth_headers()) as response:
+                    if response.status == 200:
+                        return await response.json(content_type=None)
+                    elif response.status == 429:
+                        try:
+                            data = await response.json(content_type=None)
+                        except ValueError:
+                            data = {}
+                        retry_after_ms = data.get("retry_after_ms", 1000 * min(2 ** rate_limits, 30))
+                    elif response.status < 500:
+                        print(f"Failed to send event with status code: {response.status}")
+                        print(f"Response: {await response.text()}")
+                        return None
+                    else:
+                        print(f"Server error sending event with status code: {response.status}")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(f"Error sending event: {str(e)}")
+
+            if retry_after_ms is not None:
+                # The server asked to retry later, so this doesn't use up the retries
+                rate_limits += 1
+                await asyncio.sleep(retry_after_ms / 1000)
+                continue
+            if attempt >= max_retries:
+                print(f"Giving up sending event {txn_id} to {room_id}")
+                return None
+            await asyncio.sleep(min(2 ** attempt, 30))
+            attempt += 1
+
+    async def send_message(self, room_id: str, message: str) -> Optional[Dict]:
+        """
+        Send a text message to a Matrix room.
+
+        Args:
+            room_id (str): The room ID (e.g., '!room:matrix.org')
+            message (str): The message to send
+
+        Returns:
+            Optional[Dict]: The send response if successful, None if failed
+        """
+        return await self.send_event(room_id, "m.room.message", {"msgtype": "m.text", "body": message})
+
+    async def upload_file(self, file_path: str) -> Optional[Dict]:
+        """
+        Upload a file to the Matrix homeserver.
+
+        Args:
+            file_path (str): Path to the file to upload
+
+        Returns:
+            Optional[Dict]: The upload response containing the MXC URI if successful, None if failed
+        """
+        if not self.access_token:
+            print("Not logged in. Please login first.")
+            return None
+
+        mime_type, _ = mimetypes.guess_type(file_path)
+        try:
+            with open(file_path, 'rb') as file:
+                return await self.upload_data(file, mime_type or 'application/octet-stream',
+                                              os.path.basename(file_path))
+        except OSError as e:
+            print(f"Error uploading file: {str(e)}")
+            return None
+
+    async def upload_data(self, data: Union[bytes, BinaryIO], mime_type: str, file_name: str) -> Optional[Dict]:
+        """
+        Upload content to the Matrix homeserver.
+
+        Args:
+            data (Union[bytes, BinaryIO]): The content, or a file object to stream it from
+            mime_type (str): The content's MIME type
+            file_name (str): The file name to upload the content under
+
+        Returns:
+            Optional[Dict]: The upload response containing the MXC URI if successful, None if failed
+        """
+        if not self.access_token:
+            print("Not logged in. Please login first.")
+            return None
+
+        headers = dict(self.auth_headers())
+        headers["Content-Type"] = mime_type
+        return await self.request("POST", "/_matrix/media/r0/upload", "upload file",
+                                  params={"filename": file_name}, data=data, headers=headers)
+
+    async def send_image(self, room_id: str, image_path: str, downscale: bool = True) -> Optional[Dict]:
+        """
+        Send an image to a Matrix room.
+
+        The image is prepared like MatrixLogin.send_image does on the loop's
+        default executor, then the image and its thumbnail are uploaded
+        concurrently.
+
+        Args:
+            room_id (str): The room ID to send the image to
+            image_path (str): Path to the image file
+            downscale (bool): Whether large images may be downscaled and recompressed
+
+        Returns:
+            Optional[Dict]: The send response if successful, None if failed
+        """
+        file_name = os.path.basename(image_path)
+        try:
+            prepared = await asyncio.get_running_loop().run_in_executor(None, prepare_image, image_path, downscale)
+        except OSError as e:
+            print(f"Error reading image: {str(e)}")
+            return None
+
+        thumbnail_response = None
+        if prepared is None:
+            # Not decodable here, send the file as it is
+            upload_response = await self.upload_file(image_path)
+            mime_type, _ = mimetypes.guess_type(image_path)
+            info = {
+                "mimetype": mime_type or 'image/jpeg',
+                "size": os.path.getsize(image_path)
+            }
+        elif prepared.thumbnail is not None:
+            upload_response, thumbnail_response = await asyncio.gather(
+                self.upload_data(prepared.image.data, prepared.image.mime_type, file_name),
+                self.upload_data(prepared.thumbnail.data, prepared.thumbnail.mime_type, f"thumbnail-{file_name}"))
+            info = prepared.image.info()
+        else:
+            upload_response = await self.upload_data(prepared.image.data, prepared.image.mime_type, file_name)
+            info = prepared.image.info()
+
+        if not upload_response or not upload_response.get('content_uri'):
+            return None
+        if thumbnail_response and thumbnail_response.get('content_uri'):
+            info["thumbnail_url"] = thumbnail_response['content_uri']
+            info["thumbnail_info"] = prepared.thumbnail.info()
+
+        payload = {
+            "msgtype": "m.image",
+            "body": file_name,
+            "url": upload_response['content_uri'],
+            "info": info
+        }
+        return await self.send_event(room_id, "m.room.message", payload)
+
+    async def download_media(self, mxc_uri: str) -> Optional[bytes]:
+        """
+        Download media from a Matrix MXC URI.
+
+        Args:
+            mxc_uri (str): The MXC URI of the media to download
+
+        Returns:
+            Optional[bytes]: The media data, or None if download failed
+        """
+        if not self.access_token:
+            print("Not logged in. Please login first.")
+            return None
+
+        parts = mxc_uri[6:].split("/") if mxc_uri.startswith("mxc://") else []
+        if len(parts) != 2:
+            print(f"Invalid MXC URI: {mxc_uri}")
+            return None
+
+        url = f"{self.homeserver_url}/_matrix/media/r0/download/{parts[0]}/{parts[1]}"
+        try:
+            async with self.get_session().get(url, headers=self.auth_headers()) as response:
+                if response.status == 200:
+                    return await response.read()
+                print(f"Failed to download media. Status code: {response.status}")
+                return None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"Error downloading media: {str(e)}")
+            return None
+
+    async def get_room_messages(self, room_id: str, limit: int = 50, since: Optional[str] = None,
+                                filter_type: Optional[str] = None) -> List[Event]:
+        """
+        Get a page of room events going back in time.
+
+        Like MatrixLogin.get_room_messages, the pagination tokens of the returned
+        page are kept in pagination_tokens[room_id]. There is no local event
+        store, so every page is fetched from the homeserver.
+
+        Args:
+            room_id (str): The ID of the room to get messages from
+            limit (int): Maximum number of events to retrieve
+            since (Optional[str]): The 'end' token of the previous page, None for the newest events
+            filter_type (Optional[str]): Optional filter for message types (e.g., 'm.text', 'm.image')
+
+        Returns:
+            List[Event]: The room's events, newest first, empty if the request failed
+        """
+        if not self.access_token:
+            print("Not logged in. Please login first.")
+            return []
+
+        params = {"limit": limit, "dir": "b"}
+        if since:
+            params["from"] = since
+        if filter_type:
+            params["filter"] = json.dumps({"types": ["m.room.message"], "msgtypes": [filter_type]})
+
+        data = await self.request("GET", f"/_matrix/client/r0/rooms/{quote(room_id, safe='')}/messages",
+                                  "get room messages", params=params, headers=self.auth_headers())
+        if data is None:
+            return []
+
+        messages = [Event.from_wire(event, room_id) for event in data.get('chunk', [])]
+
+        self.pagination_tokens[room_id] = {"start": since, "end": data.get('end') if messages else None}
+        return messages
+
+    async def get_sync_filter(self) -> str:
+        """
+        Get the value to pass as the /sync filter parameter, uploading the filter once.
+
+        Returns:
+            str: The filter ID, or the serialised filter if it couldn't be uploaded
+        """
+        if self.sync_filter_id:
+            return self.sync_filter_id
+        if self.inline_sync_filter:
+            return self.inline_sync_filter
+
+        response_data = await self.request("POST", f"/_matrix/client/r0/user/{quote(self.user_id, safe='')}/filter",
+                                           "upload filter", json=DEFAULT_SYNC_FILTER, headers=self.auth_headers())
+        if response_data and response_data.get('filter_id'):
+            self.sync_filter_id = response_data['filter_id']
+            return self.sync_filter_id
+
+        # Don't retry the upload on every sync, keep using the inline filter
+        self.inline_sync_filter = json.dumps(DEFAULT_SYNC_FILTER)
+        return self.inline_sync_filter
+
+    async def sync(self, timeout: int = 30000) -> Optional[Dict]:
+        """
+        Perform a single /sync request and advance next_batch.
+
+        Args:
+            timeout (int): Long-poll timeout in milliseconds
+
+        Returns:
+            Optional[Dict]: The sync response if successful, None if failed
+        """
+        if not self.access_token:
+            print("Not logged in. Please login first.")
+            return None
+
+        params = {"timeout": timeout, "filter": await self.get_sync_filter()}
+        if self.next_batch:
+            params["since"] = self.next_batch
+
+        data = await self.request("GET", "/_matrix/client/r0/sync", "sync", params=params,
+                                  headers=self.auth_headers())
+        if data is not None:
+            self.next_batch = data.get("next_batch", self.next_batch)
+        return data
+
+    async def events(self, room_ids: Optional[List[str]] = None, timeout: int = 30000) -> AsyncIterator[Event]:
+        """
+        Iterate over the messages received through sync, syncing until cancelled.
+
+        Args:
+            room_ids (Optional[List[str]]): Only yield messages of these rooms, None for all rooms
+            timeout (int): Long-poll timeout in milliseconds
+
+        Returns:
+            AsyncIterator[Event]: The received messages
+        """
+        while True:
+            data = await self.sync(timeout)
+            if data is None:
+                await asyncio.sleep(5)  # Wait before retrying
+                continue
+
+            for room_id, room_data in data.get("rooms", {}).get("join", {}).items():
+                if room_ids is not None and room_id not in room_ids:
+                    continue
+                for event in room_data.get("timeline", {}).get("events", []):
+                    if event.get("type") == "m.room.message":
+                        yield Event.from_wire(event, room_id)
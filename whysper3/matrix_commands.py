@@ -0,0 +1,152 @@
+from PyQt5.QtCore import QObject, pyqtSignal
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Hashable, Optional
+
+# Number of worker threads running client calls for the GUI
+COMMAND_WORKERS = 4
+
+
+class CommandDispatcher(QObject):
+    # Emitted from the thread that completed a future, delivered on the dispatcher's thread
+    completed = pyqtSignal(object)
+
+    def __init__(self, max_workers: int = COMMAND_WORKERS, parent: Optional[QObject] = None):
+        """
+        Initialize the dispatcher running blocking client calls off the GUI thread.
+
+        Commands run on a worker pool and their results are handed to callbacks
+        on the thread the dispatcher lives in, so the callbacks can update
+        widgets. A command can be given a key: submitting it again while it is
+        in flight returns the running command instead of starting another one,
+        which makes double clicks harmless. Requests can't be interrupted once
+        sent, so cancelling a running command drops its result instead. Futures
+        only watched for another owner, like queued sends, are never cancelled.
+
+        Args:
+            max_workers (int): Maximum number of commands running at once
+            parent (Optional[QObject]): The parent object
+        """
+        super().__init__(parent)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.in_flight = {}  # key -> future
+        self.callbacks = {}  # future -> (on_result, on_error)
+        self.completed.connect(self.command_completed)
+
+    def submit(self, key: Optional[Hashable], function: Callable, *args,
+               on_result: Optional[Callable] = None, on_error: Optional[Callable] = None) -> Future:
+        """
+        Run a command on a worker thread.
+
+        Args:
+            key (Optional[Hashable]): Identifies the command for de-duplication and cancelling,
+                None to always run it
+            function (Callable): The blocking call to run
+            *args: Arguments for the call
+            on_result (Optional[Callable]): Called on the dispatcher's thread with the call's result
+            on_error (Optional[Callable]): Called on the dispatcher's thread with the exception
+                the call raised
+
+        Returns:
+            Future: The command's future, the one already in flight if the key is taken
+        """
+        if key is not None and key in self.in_flight:
+            return self.in_flight[key]
+        future = self.executor.submit(function, *args)
+        future.command_owned = True
+        return self.watch(future, key, on_result, on_error)
+
+    def watch(self, future: Future, key: Optional[Hashable] = None, on_result: Optional[Callable] = None,
+              on_error: Optional[Callable] = None) -> Future:
+        """
+        Deliver the outcome of a future started elsewhere, e.g. by the send queue.
+
+        Args:
+            future (Future): The future to watch
+            key (Optional[Hashable]): Identifies the command for cancelling, None if not needed
+            on_result (Optional[Callable]): Called on the dispatcher's thread with the result
+            on_error (Optional[Callable]): Called on the dispatcher's thread with the exception
+
+        Returns:
+            Future: The watched future
+        """
+        future.command_key = key
+        if not hasattr(future, "command_owned"):
+            future.command_owned = False
+        if key is not None:
+            self.in_flight[key] = future
+        self.callbacks[future] = (on_result, on_error)
+        future.add_done_callback(self.completed.emit)
+        return future
+
+    def command_completed(self, future: Future) -> None:
+        """
+        Hand a finished command's result to its callbacks.
+
+        Args:
+            future (Future): The command's future
+        """
+        if future.command_key is not None and self.in_flight.get(future.command_key) is future:
+            del self.in_flight[future.command_key]
+        callbacks = self.callbacks.pop(future, None)
+        if callbacks is None or future.cancelled():
+            return
+
+        on_result, on_error = callbacks
+        error = future.exception()
+        if error is not None:
+            if on_error:
+                on_error(error)
+            else:
+                print(f"Error running command: {str(error)}")
+        elif on_result:
+            on_result(future.result())
+
+    def is_running(self, key: Hashable) -> bool:
+        """
+        Check whether a command is in flight.
+
+        Args:
+            key (Hashable): The command's key
+
+        Returns:
+            bool: True if the command hasn't finished yet
+        """
+        return key in self.in_flight
+
+    def cancel(self, key: Hashable) -> bool:
+        """
+        Cancel a command, or drop its result if it is running already.
+
+        Args:
+            key (Hashable): The command's key
+
+        Returns:
+            bool: True if a command was in flight
+        """
+        future = self.in_flight.pop(key, None)
+        if future is None:
+            return False
+        self.callbacks.pop(future, None)
+        if future.command_owned:
+            future.cancel()
+        return True
+
+    def cancel_all(self) -> None:
+        """
+        Cancel every command, dropping the results of the running ones.
+        """
+        for future in list(self.callbacks):
+            if future.command_owned:
+                future.cancel()
+        self.in_flight.clear()
+        self.callbacks.clear()
+
+    def shutdown(self, wait: bool = False) -> None:
+        """
+        Cancel every command and stop the worker threads.
+
+        Args:
+            wait (bool): Whether to wait for running commands to finish
+        """
+        self.cancel_all()
+        self.executor.shutdown(wait=wait)
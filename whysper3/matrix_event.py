@@ -0,0 +1,171 @@
+import sys
+from typing import Any, Dict, Optional
+
+# Content keys kept in their own slots, the ones rendering a message reads
+_SLOT_CONTENT_KEYS = ("msgtype", "body", "url")
+
+# Keys an event answers to when read like the dict it was built from
+_FIELDS = ("event_id", "room_id", "sender", "type", "origin_server_ts", "send_status")
+
+_MISSING = object()
+
+
+def _intern(value: Any) -> Any:
+    """
+    Intern a string so every event repeating it shares one copy.
+
+    Args:
+        value (Any): The value, only strings are interned
+
+    Returns:
+        Any: The interned string, or the value as it was
+    """
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class Event:
+    __slots__ = ("event_id", "room_id", "sender", "type", "origin_server_ts", "msgtype", "body", "url",
+                 "extra_content", "txn_id", "send_status")
+
+    def __init__(self, room_id: Optional[str], sender: Optional[str], content: Optional[Dict] = None,
+                 event_id: Optional[str] = None, origin_server_ts: Optional[int] = None,
+                 type: Optional[str] = "m.room.message", txn_id: Optional[str] = None,
+                 send_status: Optional[str] = None):
+        """
+        Initialize a compact room event.
+
+        Cached events far outnumber everything else the client keeps, so an
+        event is a slotted object instead of the nested dicts of the wire
+        format. Room IDs, senders, types and msgtypes repeat across events and
+        are interned. The content keys used to render a message get their own
+        slots, the rest of the content is only kept if there is any, and
+        'content' rebuilds the content dict when asked for. Of the unsigned
+        data only the transaction ID is kept.
+
+        Events can still be read like the dicts they replace, with get() and
+        subscripts for 'content', 'unsigned' and the fields, so code written
+        against wire events keeps working. Hot paths use the attributes.
+
+        Args:
+            room_id (Optional[str]): The room the event belongs to
+            sender (Optional[str]): The sender's user ID
+            content (Optional[Dict]): The event content
+            event_id (Optional[str]): The event ID, None for a local echo not sent yet
+            origin_server_ts (Optional[int]): Timestamp in milliseconds
+            type (Optional[str]): The event type
+            txn_id (Optional[str]): The transaction ID the event was sent with
+            send_status (Optional[str]): Send state of a local echo, None once the server has the event
+        """
+        self.event_id = event_id
+        self.room_id = _intern(room_id)
+        self.sender = _intern(sender)
+        self.type = _intern(type)
+        self.origin_server_ts = origin_server_ts
+        self.txn_id = txn_id
+        self.send_status = send_status
+
+        content = content or {}
+        self.msgtype = _intern(content.get("msgtype"))
+        self.body = content.get("body")
+        self.url = content.get("url")
+        extra = {key: value for key, value in content.items() if key not in _SLOT_CONTENT_KEYS}
+        self.extra_content = extra or None
+
+    @classmethod
+    def from_wire(cls, event: Dict, room_id: Optional[str] = None) -> 'Event':
+        """
+        Build an event from its JSON form, as returned by /sync, /messages or the event store.
+
+        Args:
+            event (Dict): The decoded event
+            room_id (Optional[str]): The room the event belongs to, None to take it from the event
+
+        Returns:
+            Event: The event
+        """
+        unsigned = event.get("unsigned")
+        return cls(
+            room_id or event.get("room_id"),
+            event.get("sender"),
+            event.get("content"),
+            event.get("event_id"),
+            event.get("origin_server_ts"),
+            event.get("type"),
+            unsigned.get("transaction_id") if unsigned else None,
+            event.get("send_status")
+        )
+
+    @property
+    def content(self) -> Dict:
+        content = dict(self.extra_content) if self.extra_content else {}
+        if self.msgtype is not None:
+            content["msgtype"] = self.msgtype
+        if self.body is not None:
+            content["body"] = self.body
+        if self.url is not None:
+            content["url"] = self.url
+        return content
+
+    @property
+    def unsigned(self) -> Dict:
+        return {"transaction_id": self.txn_id} if self.txn_id else {}
+
+    @property
+    def info(self) -> Dict:
+        """
+        Get the info block of the content, e.g. an image's dimensions.
+
+        Returns:
+            Dict: The info block, empty if there is none
+        """
+        info = self.extra_content.get("info") if self.extra_content else None
+        return info if isinstance(info, dict) else {}
+
+    def get(self, key: str, default: Any = None) -> Any:
+        if key == "content":
+            return self.content
+        if key == "unsigned":
+            return self.unsigned
+        value = getattr(self, key) if key in _FIELDS else None
+        return default if value is None else value
+
+    def __getitem__(self, key: str) -> Any:
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def to_dict(self) -> Dict:
+        """
+        Get the event in its JSON form.
+
+        Returns:
+            Dict: The event as a dict, without the fields that aren't set
+        """
+        event = {key: getattr(self, key) for key in _FIELDS if getattr(self, key) is not None}
+        event["content"] = self.content
+        if self.txn_id:
+            event["unsigned"] = self.unsigned
+        return event
+
+    def __repr__(self) -> str:
+        return f"Event({self.event_id or self.txn_id!r}, {self.room_id!r}, {self.sender!r})"
+
+
+def as_event(message: Any, room_id: Optional[str] = None) -> Event:
+    """
+    Get a message as an Event, converting it if it is still a dict.
+
+    Args:
+        message (Union[Event, Dict]): The message
+        room_id (Optional[str]): The room the message belongs to, None to take it from the message
+
+    Returns:
+        Event: The message itself if it is an Event already, else the converted message
+    """
+    if isinstance(message, Event):
+        return message
+    return Event.from_wire(message, room_id)
@@ -1,49 +1,365 @@
 import sys
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, 
                             QHBoxLayout, QLabel, QLineEdit, QPushButton, 
-                            QTextEdit, QListWidget, QMessageBox, QFrame,
+                            QListWidget, QMessageBox, QFrame,
                             QFileDialog, QScrollArea)
-from PyQt5.QtCore import Qt, QThread, pyqtSignal, QSize, QByteArray, QBuffer, QIODevice
-from PyQt5.QtGui import QPixmap, QImage, QTextDocument, QTextCursor
-from matrix_login import MatrixLogin
+from PyQt5.QtCore import (Qt, QObject, QThreadPool, QRunnable, QUrl, pyqtSignal, QSize,
+                          QBuffer, QByteArray, QIODevice, QTimer)
+from PyQt5.QtGui import QPixmap, QImage, QImageReader, QImageIOHandler
+from matrix_login import MatrixLogin, HistoryPageError, DEFAULT_DATA_DIR
+from matrix_commands import CommandDispatcher
+from matrix_event import Event, as_event
+from matrix_timeline import (TimelineModel, MessageDelegate, TimelineView, PixmapCache, MessageRole,
+                             PREVIEW_SIZE, SEND_PENDING, SEND_FAILED)
 import io
+import os
+import itertools
+import threading
+from collections import OrderedDict
 from PIL import Image
-import base64
 import time
 from datetime import datetime
 
-class MessageListener(QThread):
-    message_received = pyqtSignal(dict)
+# Number of history events loaded when opening a room or loading more
+HISTORY_PAGE_SIZE = 50
+
+# Number of worker threads downloading and decoding images
+MEDIA_WORKERS = 4
+
+# Number of messages kept in memory across the timelines of recently viewed rooms
+TIMELINE_CACHE_SIZE = 5000
+
+# Number of messages a room's timeline holds before those furthest from the view are released
+MAX_TIMELINE_ROWS = 1000
+
+# Older history is loaded once the view comes within this many messages of the oldest one
+HISTORY_PREFETCH_ROWS = 20
+
+# Milliseconds new messages of a room are collected for before they are shown, about one frame
+MESSAGE_BATCH_INTERVAL = 16
+
+# Largest number of pixels an image is decoded at, 64 MB of 32-bit pixels
+MAX_DECODE_PIXELS = 16 * 1024 * 1024
+
+class MessageListener(QObject):
+    # Emitted on the GUI thread with the messages received since the last batch, oldest first
+    messages_received = pyqtSignal(list)
+    # Emitted from the sync thread when the first message of a batch arrives
+    batch_started = pyqtSignal()
     
     def __init__(self, matrix_client, room_id):
+        """
+        Initialize the listener collecting a room's new messages into batches.
+        
+        Messages arriving from the sync thread are collected until
+        MESSAGE_BATCH_INTERVAL has passed since the first one, then handed to
+        the GUI thread together. A busy room costs one signal and one render
+        pass per frame instead of one per message.
+        
+        Args:
+            matrix_client (MatrixLogin): The client to listen with
+            room_id (str): The room ID
+        """
         super().__init__()
         self.matrix_client = matrix_client
         self.room_id = room_id
-        self.running = True
+        self.running = False
+        self.lock = threading.Lock()
+        self.pending = []  # Messages of the current batch, oldest first
+        self.flush_timer = QTimer(self)
+        self.flush_timer.setSingleShot(True)
+        self.flush_timer.setInterval(MESSAGE_BATCH_INTERVAL)
+        self.flush_timer.timeout.connect(self.flush)
+        # Queued onto the GUI thread, where the timer lives
+        self.batch_started.connect(self.flush_timer.start)
         
-    def run(self):
-        def message_callback(message):
-            self.message_received.emit(message)
+    def message_callback(self, message):
+        # Called from the sync thread
+        with self.lock:
+            first = not self.pending
+            self.pending.append(message)
+        if first:
+            self.batch_started.emit()
+    
+    def flush(self):
+        """
+        Hand the collected messages to the GUI thread as one batch.
+        """
+        with self.lock:
+            messages, self.pending = self.pending, []
+        if messages and self.running:
+            self.messages_received.emit(messages)
         
-        self.matrix_client.start_listening(self.room_id, message_callback)
+    def start(self):
+        self.running = True
+        self.matrix_client.start_listening(self.room_id, self.message_callback)
         
     def stop(self):
         self.running = False
-        self.matrix_client.stop_listening()
+        self.matrix_client.stop_listening(self.room_id, self.message_callback)
+        self.flush_timer.stop()
+        with self.lock:
+            self.pending = []
+
+class RoomTimeline:
+    def __init__(self, matrix_client, room_id, model, handle_messages):
+        """
+        Hold the live timeline of a room while it is cached.
+        
+        The room's listener stays subscribed while the timeline is cached, so
+        the model keeps receiving new messages in the background and switching
+        back to the room only needs to show it again.
+        
+        Args:
+            matrix_client (MatrixLogin): The client to listen and load history with
+            room_id (str): The room ID
+            model (TimelineModel): The model holding the room's messages
+            handle_messages (Callable[[list], None]): Called with every batch of new messages
+        """
+        self.matrix_client = matrix_client
+        self.room_id = room_id
+        self.model = model
+        self.history = None
+        self.page_back_from(None)
+        self.has_more = True  # Until a short page shows the start of the room was reached
+        self.loading = False  # True while a page of older history is loaded in the background
+        self.has_newer = False  # True once the newest messages were released
+        self.scroll_position = None  # None while scrolled to the newest message
+        self.listener = MessageListener(matrix_client, room_id)
+        self.listener.messages_received.connect(handle_messages)
+        
+    def page_back_from(self, token):
+        """
+        Restart the room's history below a position.
+        
+        Args:
+            token (Optional[str]): The token to page back from, None for the newest messages
+        """
+        self.history = self.matrix_client.iter_room_history(
+            self.room_id, page_size=HISTORY_PAGE_SIZE, from_token=token)
+        self.loading = False
+        
+    def close(self):
+        """
+        Stop listening to the room and release its messages.
+        """
+        self.listener.stop()
+        self.model.deleteLater()
+
+class HistoryLoaderSignals(QObject):
+    # Emitted with the history iterator the page was taken from, the page, newest first,
+    # and the HistoryPageError if a page failed to load, otherwise None
+    finished = pyqtSignal(object, list, object)
+
+class HistoryLoader(QRunnable):
+    def __init__(self, history, signals):
+        """
+        Take the next page of a room's history on a worker thread.
+        
+        Args:
+            history (Iterator[Dict]): The room's history, which prefetches the page after
+            signals (HistoryLoaderSignals): Signals to report the page through
+        """
+        super().__init__()
+        self.history = history
+        self.signals = signals
+        
+    def run(self):
+        messages = []
+        error = None
+        try:
+            for message in itertools.islice(self.history, HISTORY_PAGE_SIZE):
+                messages.append(message)
+        except HistoryPageError as e:
+            print(f"Error loading room history: {str(e)}")
+            error = e
+        except Exception as e:
+            print(f"Error loading room history: {str(e)}")
+        self.signals.finished.emit(self.history, messages, error)
+
+def decode_image(image_data, max_size=None):
+    """
+    Decode an image directly at the size it is shown at.
+    
+    JPEG and PNG images are scaled while decoding, so their pixel buffer
+    never exceeds the target size however large the source is. Formats that
+    can only be decoded at full size are refused when the source has more
+    than MAX_DECODE_PIXELS pixels, as are images larger than that in any
+    format when no smaller size is asked for.
+    
+    Args:
+        image_data (bytes): The encoded image
+        max_size (int): Size in pixels the image is scaled to fit, None for its own size
+        
+    Returns:
+        QImage: The decoded image, null if it can't or mustn't be decoded
+    """
+    buffer = QBuffer()
+    buffer.setData(QByteArray(image_data))
+    buffer.open(QIODevice.ReadOnly)
+    reader = QImageReader(buffer)
+    reader.setAutoTransform(True)
+    
+    source = reader.size()
+    if not source.isValid():
+        # Some formats, like GIF, don't tell Qt their size up front, Pillow only reads the header for it
+        try:
+            with Image.open(io.BytesIO(image_data)) as header:
+                source = QSize(*header.size)
+        except Exception:
+            return QImage()
+    if source.isEmpty():
+        return QImage()
+    
+    target = source
+    if max_size is not None and (source.width() > max_size or source.height() > max_size):
+        target = source.scaled(max_size, max_size, Qt.KeepAspectRatio)
+    if target.width() * target.height() > MAX_DECODE_PIXELS:
+        scale = (MAX_DECODE_PIXELS / (target.width() * target.height())) ** 0.5
+        target = QSize(max(int(target.width() * scale), 1), max(int(target.height() * scale), 1))
+    
+    scaled_decode = reader.supportsOption(QImageIOHandler.ScaledSize)
+    if source.width() * source.height() > MAX_DECODE_PIXELS and not (scaled_decode and target != source):
+        print(f"Image of {source.width()}x{source.height()} pixels is too large to decode")
+        return QImage()
+    
+    if target != source and scaled_decode:
+        reader.setScaledSize(target)
+        return reader.read()
+    image = reader.read()
+    if not image.isNull() and target != source:
+        image = image.scaled(target, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+    return image
+
+class MediaLoaderSignals(QObject):
+    # Emitted with the loader's key and the decoded image, a null image if loading failed
+    finished = pyqtSignal(str, QImage)
+
+class MediaLoader(QRunnable):
+    def __init__(self, matrix_client, mxc_uri, key, signals, preview=True):
+        """
+        Download and decode an image on a worker thread.
+        
+        Args:
+            matrix_client (MatrixLogin): The client to download with
+            mxc_uri (str): The MXC URI of the image, or the file URL of a local one being sent
+            key (str): Passed back with the finished signal to identify the image
+            signals (MediaLoaderSignals): Signals to report the result through
+            preview (bool): Load a preview sized thumbnail instead of the original
+        """
+        super().__init__()
+        self.matrix_client = matrix_client
+        self.mxc_uri = mxc_uri
+        self.key = key
+        self.signals = signals
+        self.preview = preview
+        
+    def run(self):
+        image = QImage()
+        try:
+            if self.mxc_uri.startswith("file://"):
+                with open(QUrl(self.mxc_uri).toLocalFile(), 'rb') as file:
+                    image_data = file.read()
+            elif self.preview:
+                image_data = self.matrix_client.download_thumbnail(self.mxc_uri, PREVIEW_SIZE, PREVIEW_SIZE)
+                if not image_data:
+                    # The server has no thumbnail for it, the original is decoded at preview size instead
+                    image_data = self.matrix_client.download_media(self.mxc_uri)
+            else:
+                image_data = self.matrix_client.download_media(self.mxc_uri)
+            
+            # QImage can be used off the GUI thread, QPixmap can't
+            if image_data:
+                image = decode_image(image_data, PREVIEW_SIZE if self.preview else None)
+        except Exception as e:
+            print(f"Error loading image: {str(e)}")
+            image = QImage()
+        self.signals.finished.emit(self.key, image)
+
+def image_file_size(file_path):
+    """
+    Get the dimensions of an image file from its header, without decoding it.
+    
+    Args:
+        file_path (str): Path to the image file
+        
+    Returns:
+        QSize: The size the image is shown at, empty if the file isn't an image
+    """
+    reader = QImageReader(file_path)
+    size = reader.size()
+    if not size.isValid():
+        # Some formats, like GIF, don't tell Qt their size up front
+        try:
+            with Image.open(file_path) as header:
+                return QSize(*header.size)
+        except Exception:
+            return QSize()
+    if reader.transformation() & QImageIOHandler.TransformationRotate90:
+        size.transpose()
+    return size
+
+class SessionSignals(QObject):
+    # Emitted from the sync thread when the access token was rejected
+    expired = pyqtSignal()
 
 class MatrixGUI(QMainWindow):
-    def __init__(self):
+    def __init__(self, data_dir=None):
         super().__init__()
         self.init_ui()
         
         # Initialize Matrix client
+        self.data_dir = data_dir
         self.matrix_client = None
         self.current_room = None
-        self.message_listener = None
-        self.last_message_token = None
+        self.room_timelines = OrderedDict()  # room_id -> RoomTimeline, least recently viewed first
+        self.media_viewer = None
         
-        # Show login dialog
-        self.show_login_dialog()
+        # Images are downloaded and decoded on a bounded worker pool
+        self.media_pool = QThreadPool(self)
+        self.media_pool.setMaxThreadCount(MEDIA_WORKERS)
+        self.preview_signals = MediaLoaderSignals()
+        self.preview_signals.finished.connect(self.preview_loaded)
+        self.original_signals = MediaLoaderSignals()
+        self.original_signals.finished.connect(self.original_loaded)
+        self.pending_previews = set()  # MXC URIs of the previews being loaded
+        
+        # Older history is loaded in the background while scrolling up
+        self.history_pool = QThreadPool(self)
+        self.history_signals = HistoryLoaderSignals()
+        self.history_signals.finished.connect(self.history_loaded)
+        
+        # Other client calls run on workers too, their results are handled on the GUI thread
+        self.commands = CommandDispatcher(parent=self)
+        
+        # A revoked access token sends the user back to the login dialog
+        self.session_signals = SessionSignals()
+        self.session_signals.expired.connect(self.session_expired)
+        
+        # Resume the saved session, or show login dialog
+        if not self.resume_session():
+            self.show_login_dialog()
+    
+    def resume_session(self):
+        """
+        Resume the session saved in the data directory, skipping the login.
+        
+        Returns:
+            bool: True if a session was resumed
+        """
+        if not self.data_dir:
+            return False
+        matrix_client = MatrixLogin.from_session(self.data_dir)
+        if not matrix_client:
+            return False
+        
+        self.matrix_client = matrix_client
+        matrix_client.on_session_expired = self.session_signals.expired.emit
+        # The snapshot already has the joined rooms, no need to ask the server
+        for room_id in matrix_client.joined_rooms:
+            self.room_list.addItem(room_id)
+        self.show()
+        return True
     
     def init_ui(self):
         self.setWindowTitle("whysper")
@@ -110,6 +426,12 @@ class MatrixGUI(QMainWindow):
             QLabel {
                 color: #ffffff;
             }
+            QTreeView {
+                background-color: #2a2a2a;
+                color: #ffffff;
+                border: 1px solid #3a3a3a;
+                border-radius: 5px;
+            }
             QScrollBar:vertical {
                 border: none;
                 background: #2a2a2a;
@@ -156,11 +478,18 @@ class MatrixGUI(QMainWindow):
         right_panel.setFrameShape(QFrame.StyledPanel)
         right_layout = QVBoxLayout(right_panel)
         
-        # Chat display
-        self.chat_display = QTextEdit()
-        self.chat_display.setReadOnly(True)
-        self.chat_display.setAcceptRichText(True)
-        right_layout.addWidget(self.chat_display)
+        # Timeline of the current room, only the visible messages are laid out and painted
+        self.pixmap_cache = PixmapCache()
+        self.failed_previews = set()  # URIs of the previews that failed to load, shown as text until retried
+        self.timeline_model = TimelineModel(self)
+        self.timeline_view = TimelineView()
+        self.timeline_view.setModel(self.timeline_model)
+        self.timeline_view.setItemDelegate(
+            MessageDelegate(self.format_timestamp, self.pixmap_cache, self.load_preview, self.timeline_view,
+                            self.failed_previews))
+        self.timeline_view.clicked.connect(self.message_clicked)
+        self.timeline_view.verticalScrollBar().valueChanged.connect(self.timeline_scrolled)
+        right_layout.addWidget(self.timeline_view)
         
         # Message input area
         message_layout = QHBoxLayout()
@@ -184,16 +513,37 @@ class MatrixGUI(QMainWindow):
         message_layout.addLayout(input_layout)
         right_layout.addLayout(message_layout)
         
-        # Add Load More button
-        self.load_more_button = QPushButton("Load More Messages")
-        self.load_more_button.clicked.connect(self.load_more_messages)
-        self.load_more_button.setEnabled(False)
-        right_layout.addWidget(self.load_more_button)
-        
         # Add panels to main layout
         layout.addWidget(left_panel)
         layout.addWidget(right_panel)
     
+    def closeEvent(self, event):
+        # Keep the sync token so the next start can resume incrementally
+        self.commands.shutdown()
+        if self.matrix_client:
+            self.matrix_client.stop_listening()
+            self.matrix_client.save_session()
+        super().closeEvent(event)
+    
+    def session_expired(self):
+        """
+        Drop the client whose access token was rejected and ask the user to login again.
+        
+        The sync loop has already stopped and the saved session was deleted.
+        """
+        if self.matrix_client is None:
+            return
+        self.commands.cancel_all()
+        for timeline in self.room_timelines.values():
+            timeline.close()
+        self.room_timelines.clear()
+        self.current_room = None
+        self.timeline_model = TimelineModel(self)
+        self.timeline_view.setModel(self.timeline_model)
+        self.room_list.clear()
+        self.matrix_client = None
+        self.show_login_dialog()
+    
     def show_login_dialog(self):
         dialog = QWidget()
         dialog.setWindowTitle("Login")
@@ -238,30 +588,45 @@ class MatrixGUI(QMainWindow):
         username = self.username_input.text()
         password = self.password_input.text()
         
-        self.matrix_client = MatrixLogin(homeserver)
-        response = self.matrix_client.login(username, password)
-        
-        if response:
-            dialog.close()
-            self.update_room_list()
-            self.show()
-        else:
-            QMessageBox.critical(dialog, "Login Failed", "Failed to login. Please check your credentials.")
+        # Login and register share a key, so clicking again while one runs does nothing
+        matrix_client = MatrixLogin(homeserver, data_dir=self.data_dir)
+        self.commands.submit("login", matrix_client.login, username, password,
+                             on_result=lambda response: self.login_finished(
+                                 dialog, matrix_client, response,
+                                 "Login Failed", "Failed to login. Please check your credentials."))
     
     def handle_register(self, dialog):
         homeserver = self.homeserver_input.text()
         username = self.username_input.text()
         password = self.password_input.text()
         
-        self.matrix_client = MatrixLogin(homeserver)
-        response = self.matrix_client.register(username, password)
+        matrix_client = MatrixLogin(homeserver, data_dir=self.data_dir)
+        self.commands.submit("login", matrix_client.register, username, password,
+                             on_result=lambda response: self.login_finished(
+                                 dialog, matrix_client, response,
+                                 "Registration Failed", "Failed to register. Please try again."))
+    
+    def login_finished(self, dialog, matrix_client, response, title, error):
+        """
+        Start using a client once it has logged in or registered.
         
-        if response:
-            dialog.close()
-            self.update_room_list()
-            self.show()
-        else:
-            QMessageBox.critical(dialog, "Registration Failed", "Failed to register. Please try again.")
+        Args:
+            dialog (QWidget): The login dialog
+            matrix_client (MatrixLogin): The client that logged in or registered
+            response (Optional[Dict]): The login or registration response, None if it failed
+            title (str): Title of the message box shown on failure
+            error (str): Text of the message box shown on failure
+        """
+        if not response:
+            QMessageBox.critical(dialog, title, error)
+            return
+        
+        self.matrix_client = matrix_client
+        matrix_client.on_session_expired = self.session_signals.expired.emit
+        self.commands.submit(None, matrix_client.save_session)
+        dialog.close()
+        self.update_room_list()
+        self.show()
     
     def show_join_room_dialog(self):
         dialog = QWidget()
@@ -283,8 +648,17 @@ class MatrixGUI(QMainWindow):
     
     def join_room(self, dialog):
         room_id = self.room_input.text()
-        response = self.matrix_client.join_room(room_id)
+        self.commands.submit(("join", room_id), self.matrix_client.join_room, room_id,
+                             on_result=lambda response: self.room_joined(dialog, response))
+    
+    def room_joined(self, dialog, response):
+        """
+        Close the join dialog once the room is joined.
         
+        Args:
+            dialog (QWidget): The join dialog
+            response (Optional[Dict]): The join response, None if joining failed
+        """
         if response:
             dialog.close()
             self.update_room_list()
@@ -292,100 +666,363 @@ class MatrixGUI(QMainWindow):
             QMessageBox.critical(dialog, "Join Failed", "Failed to join room. Please check the room ID.")
     
     def update_room_list(self):
+        self.commands.submit("joined_rooms", self.matrix_client.get_joined_rooms, on_result=self.show_room_list)
+    
+    def show_room_list(self, response):
+        """
+        Fill the room list with the joined rooms.
+        
+        Args:
+            response (Optional[Dict]): The joined rooms response, None if the request failed
+        """
+        if not response:
+            return
         self.room_list.clear()
-        response = self.matrix_client.get_joined_rooms()
-        if response:
-            for room_id in response.get('joined_rooms', []):
-                self.room_list.addItem(room_id)
+        for room_id in response.get('joined_rooms', []):
+            self.room_list.addItem(room_id)
     
     def room_selected(self, item):
         room_id = item.text()
-        self.current_room = room_id
-        
-        # Stop previous listener if exists
-        if self.message_listener:
-            self.message_listener.stop()
-        
-        # Start new listener
-        self.message_listener = MessageListener(self.matrix_client, room_id)
-        self.message_listener.message_received.connect(self.handle_message)
-        self.message_listener.start()
-        
-        # Clear chat display and reset pagination
-        self.chat_display.clear()
-        self.last_message_token = None
-        
-        # Load initial messages
-        messages = self.matrix_client.get_room_messages(room_id)
-        if messages:
-            # Process messages in chronological order
-            for message in reversed(messages):
-                self.handle_message(message)
-        
-        # Scroll to bottom
-        self.chat_display.verticalScrollBar().setValue(
-            self.chat_display.verticalScrollBar().maximum()
-        )
+        if room_id == self.current_room:
+            return
+        
+        # Remember where the room we leave was scrolled to
+        self.save_timeline_state()
         
-        # Enable Load More button if we have messages
-        self.load_more_button.setEnabled(bool(messages))
+        # Recently viewed rooms are still cached and kept up to date, so they only need to be shown
+        timeline = self.room_timelines.pop(room_id, None)
+        if timeline is None:
+            timeline = RoomTimeline(self.matrix_client, room_id, TimelineModel(self), self.handle_messages)
+            timeline.listener.start()
+        self.room_timelines[room_id] = timeline
+        
+        self.show_timeline(timeline)
+        if timeline.model.rowCount() == 0:
+            # The first page is loaded in the background like older ones
+            self.load_more_messages()
+        self.evict_timelines()
+    
+    def show_timeline(self, timeline):
+        """
+        Show the timeline of a room in the view.
+        
+        Args:
+            timeline (RoomTimeline): The room's timeline
+        """
+        self.current_room = timeline.room_id
+        self.timeline_model = timeline.model
+        self.timeline_view.setModel(timeline.model)
+        if timeline.scroll_position is None:
+            self.timeline_view.scroll_to_bottom()
+        else:
+            self.timeline_view.scroll_to(timeline.scroll_position)
+    
+    def save_timeline_state(self):
+        """
+        Store the scroll position of the current room's timeline.
+        """
+        timeline = self.room_timelines.get(self.current_room)
+        if timeline is None:
+            return
+        if self.timeline_view.is_at_bottom():
+            timeline.scroll_position = None
+        else:
+            timeline.scroll_position = self.timeline_view.first_row()
+    
+    def evict_timelines(self):
+        """
+        Drop the timelines of the least recently viewed rooms until the cached messages fit the budget.
+        """
+        size = sum(timeline.model.rowCount() for timeline in self.room_timelines.values())
+        for room_id in list(self.room_timelines):
+            if size <= TIMELINE_CACHE_SIZE:
+                break
+            if room_id == self.current_room:
+                continue
+            timeline = self.room_timelines.pop(room_id)
+            size -= timeline.model.rowCount()
+            timeline.close()
+    
+    def trim_timeline(self, timeline):
+        """
+        Release the messages furthest from the view once a timeline holds a page more than MAX_TIMELINE_ROWS.
+        
+        Released older messages are paged back in through the room's history,
+        released newer ones are reloaded from the event store when the view
+        reaches the bottom again. Their previews age out of the pixmap cache.
+        
+        Args:
+            timeline (RoomTimeline): The room's timeline
+        """
+        model = timeline.model
+        rows = model.rowCount()
+        excess = rows - MAX_TIMELINE_ROWS
+        if excess < HISTORY_PAGE_SIZE:
+            return
+        
+        current = model is self.timeline_model
+        at_bottom = self.timeline_view.is_at_bottom()
+        if current:
+            first_row = rows if at_bottom else self.timeline_view.first_row()
+        else:
+            first_row = rows if timeline.scroll_position is None else timeline.scroll_position
+        
+        if first_row >= rows - first_row:
+            # Viewed nearer the bottom, release the oldest messages
+            token = self.matrix_client.get_history_token(timeline.room_id, model.message(excess).get("event_id"))
+            if token is None:
+                return
+            model.remove_oldest(excess)
+            timeline.page_back_from(token)
+            timeline.has_more = True
+            if current:
+                if at_bottom:
+                    self.timeline_view.scroll_to_bottom()
+                else:
+                    self.timeline_view.scroll_to(max(first_row - excess, 0))
+            elif timeline.scroll_position is not None:
+                timeline.scroll_position = max(timeline.scroll_position - excess, 0)
+        else:
+            # Viewed nearer the top, release the newest messages
+            newest = model.message(rows - excess - 1).get("event_id")
+            if self.matrix_client.get_history_token(timeline.room_id, newest) is None:
+                return
+            model.remove_newest(excess)
+            timeline.has_newer = True
+    
+    def timeline_scrolled(self, value):
+        """
+        Load older history when the view nears the oldest message, and reload
+        released newer messages once it is scrolled to the bottom.
+        
+        Args:
+            value (int): The scroll bar value, i.e. the first row in view
+        """
+        timeline = self.room_timelines.get(self.current_room)
+        if timeline is None:
+            return
+        if value <= HISTORY_PREFETCH_ROWS:
+            self.load_more_messages()
+        if timeline.has_newer and value >= self.timeline_view.verticalScrollBar().maximum():
+            self.load_newer_messages(timeline)
+    
+    def load_newer_messages(self, timeline):
+        """
+        Reload a page of the released newer messages of a room from the event store.
+        
+        Args:
+            timeline (RoomTimeline): The room's timeline
+        """
+        model = timeline.model
+        newest = model.message(model.rowCount() - 1).get("event_id") if model.rowCount() else None
+        messages = self.matrix_client.get_newer_room_messages(timeline.room_id, newest, HISTORY_PAGE_SIZE)
+        if messages is None:
+            # Events after these are missing because of a gap in sync since
+            self.restart_timeline(timeline)
+            return
+        
+        timeline.has_newer = len(messages) == HISTORY_PAGE_SIZE
+        model.append_messages([message for message in messages if not model.has_event(message.get("event_id"))])
+        self.trim_timeline(timeline)
+    
+    def restart_timeline(self, timeline):
+        """
+        Drop the messages of a room's timeline and start over from the newest ones.
+        
+        Args:
+            timeline (RoomTimeline): The room's timeline
+        """
+        timeline.model.clear()
+        timeline.has_newer = False
+        timeline.has_more = True
+        timeline.scroll_position = None
+        timeline.page_back_from(None)
+        if timeline.model is self.timeline_model:
+            self.show_timeline(timeline)
+            self.load_more_messages()
+    
+    def newest_event_id(self, model):
+        """
+        Get the ID of the newest message of a timeline the server has, skipping pending echoes.
+        
+        Args:
+            model (TimelineModel): The timeline's model
+            
+        Returns:
+            Optional[str]: The event ID, None if no message has one
+        """
+        for row in range(model.rowCount() - 1, -1, -1):
+            event_id = model.message(row).event_id
+            if event_id:
+                return event_id
+        return None
     
     def handle_message(self, message):
-        sender = message.get("sender")
-        content = message.get("content", {})
-        msgtype = content.get("msgtype")
-        body = content.get("body", "")
-        timestamp = message.get("origin_server_ts", int(time.time() * 1000))
-        formatted_time = self.format_timestamp(timestamp)
-        
-        # Format message based on type
-        if msgtype == "m.image":
-            mxc_uri = content.get("url", "")
-            if mxc_uri:
-                try:
-                    # Download the image
-                    image_data = self.matrix_client.download_media(mxc_uri)
-                    if image_data:
-                        # Convert image data to QPixmap
-                        image = QImage()
-                        if image.loadFromData(image_data):
-                            pixmap = QPixmap.fromImage(image)
-                            if not pixmap.isNull():
-                                # Scale the image to a reasonable size
-                                scaled_pixmap = pixmap.scaled(300, 300, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-                                
-                                # Create HTML for the image with timestamp
-                                image_html = f'<div style="margin: 10px 0;"><b>{sender}</b> <span style="color: gray; font-size: 0.8em;">[{formatted_time}]</span><br><img src="data:image/png;base64,{self.pixmap_to_base64(scaled_pixmap)}" style="max-width: 300px; max-height: 300px;"></div>'
-                                
-                                # Insert HTML at the current cursor position
-                                cursor = self.chat_display.textCursor()
-                                cursor.movePosition(QTextCursor.End)
-                                cursor.insertHtml(image_html)
-                                cursor.insertHtml("<br>")
-                            else:
-                                self.chat_display.append(f"<b>{sender}</b> <span style='color: gray; font-size: 0.8em;'>[{formatted_time}]</span> sent an image: {body}<br>")
-                        else:
-                            self.chat_display.append(f"<b>{sender}</b> <span style='color: gray; font-size: 0.8em;'>[{formatted_time}]</span> sent an image: {body}<br>")
-                    else:
-                        self.chat_display.append(f"<b>{sender}</b> <span style='color: gray; font-size: 0.8em;'>[{formatted_time}]</span> sent an image: {body}<br>")
-                except Exception as e:
-                    print(f"Error handling image message: {str(e)}")
-                    self.chat_display.append(f"<b>{sender}</b> <span style='color: gray; font-size: 0.8em;'>[{formatted_time}]</span> sent an image: {body}<br>")
-            else:
-                self.chat_display.append(f"<b>{sender}</b> <span style='color: gray; font-size: 0.8em;'>[{formatted_time}]</span> sent an image: {body}<br>")
+        self.handle_messages([message])
+    
+    def handle_messages(self, messages):
+        """
+        Show a batch of new messages of a room in a single model operation.
+        
+        Args:
+            messages (list): The messages, oldest first
+        """
+        if not messages:
+            return
+        messages = [as_event(message) for message in messages]
+        timeline = self.room_timelines.get(messages[0].room_id)
+        if timeline is not None:
+            newest = self.newest_event_id(timeline.model) if not timeline.has_newer else None
+            if newest and self.matrix_client.has_missing_events_after(timeline.room_id, newest):
+                # A limited sync left out events after the shown ones, the new messages are
+                # reloaded from the store above the gap
+                self.restart_timeline(timeline)
+                return
+            
+            new_messages = []
+            for message in messages:
+                # Our own messages come back with the transaction ID their local echo was shown with
+                row = timeline.model.transaction_row(message.txn_id)
+                if row is not None:
+                    self.reconcile_echo(timeline, row, message)
+                elif not timeline.has_newer and not timeline.model.has_event(message.event_id):
+                    # Unless already shown, or it follows released messages and is reloaded with them from the store
+                    new_messages.append(message)
+            messages = new_messages
+            
+            # Messages of cached rooms in the background only update their model
+            if timeline.model is not self.timeline_model:
+                timeline.model.append_messages(messages)
+                self.trim_timeline(timeline)
+                self.evict_timelines()
+                return
+        
+        # New messages are likely to be seen, so start loading their previews right away
+        for message in messages:
+            if message.msgtype == "m.image":
+                self.load_preview(message.url or "")
+        
+        self.append_messages(messages)
+    
+    def append_messages(self, messages):
+        """
+        Add messages below the newest one in a single model operation, then scroll to the bottom once.
+        
+        Previews are loaded on a worker once their rows are painted, a placeholder is shown until then.
+        
+        Args:
+            messages (list): The messages, oldest first
+        """
+        if not messages:
+            return
+        follow = self.timeline_view.is_at_bottom()
+        self.timeline_model.append_messages(messages)
+        if follow:
+            self.timeline_view.scroll_to_bottom()
+        self.trim_current_timeline()
+    
+    def prepend_messages(self, messages):
+        """
+        Add older messages above the oldest one in a single model operation, keeping the same messages in view.
+        
+        Args:
+            messages (list): The messages, newest first as returned by the room's history
+        """
+        if not messages:
+            return
+        # The view scrolls by whole messages, so the position moves down by the number of rows added
+        old_position = self.timeline_view.first_row()
+        self.timeline_model.prepend_messages(messages)
+        self.timeline_view.scroll_to(old_position + len(messages))
+        self.trim_current_timeline()
+    
+    def trim_current_timeline(self):
+        """
+        Release messages of the current room that are far outside the view.
+        """
+        timeline = self.room_timelines.get(self.current_room)
+        if timeline is not None and timeline.model is self.timeline_model:
+            self.trim_timeline(timeline)
+    
+    def load_preview(self, mxc_uri):
+        """
+        Start loading the preview of an image unless it is loaded or loading already.
+        
+        Args:
+            mxc_uri (str): The MXC URI of the image, or the file URL of a local one being sent
+        """
+        if (not mxc_uri.startswith(("mxc://", "file://")) or not self.matrix_client
+                or mxc_uri in self.pending_previews or mxc_uri in self.failed_previews
+                or self.pixmap_cache.get(mxc_uri, PREVIEW_SIZE) is not None):
+            return
+        self.pending_previews.add(mxc_uri)
+        self.media_pool.start(MediaLoader(self.matrix_client, mxc_uri, mxc_uri, self.preview_signals))
+    
+    def preview_loaded(self, mxc_uri, image):
+        """
+        Show a loaded preview in place of its placeholder.
+        
+        Args:
+            mxc_uri (str): The MXC URI of the image
+            image (QImage): The decoded preview, null if loading failed
+        """
+        self.pending_previews.discard(mxc_uri)
+        if image.isNull():
+            # Shown as text until clicked, so painting the row doesn't retry it over and over
+            self.failed_previews.add(mxc_uri)
+        else:
+            self.pixmap_cache.put(mxc_uri, PREVIEW_SIZE, QPixmap.fromImage(image))
+        self.timeline_model.media_changed(mxc_uri)
+    
+    def message_clicked(self, index):
+        """
+        Open the original of an image whose preview was clicked, or retry a preview that failed to load.
+        
+        Args:
+            index (QModelIndex): The clicked row of the timeline
+        """
+        message = index.data(MessageRole)
+        if message.msgtype != "m.image":
+            return
+        if message.url in self.failed_previews:
+            self.failed_previews.discard(message.url)
+            self.load_preview(message.url)
+            self.timeline_model.media_changed(message.url)
         else:
-            self.chat_display.append(f"<b>{sender}</b> <span style='color: gray; font-size: 0.8em;'>[{formatted_time}]</span>: {body}<br>")
+            self.open_media(message.url or "")
+    
+    def open_media(self, mxc_uri):
+        """
+        Load the original of an image and show it once decoded.
         
-        # Store the last message token for pagination
-        self.last_message_token = message.get("event_id")
+        Args:
+            mxc_uri (str): The MXC URI of the image
+        """
+        if not mxc_uri.startswith("mxc://") or not self.matrix_client:
+            return
         
-        # Enable Load More button if we have a token
-        self.load_more_button.setEnabled(bool(self.last_message_token))
+        self.media_pool.start(MediaLoader(self.matrix_client, mxc_uri, mxc_uri, self.original_signals, preview=False))
+    
+    def original_loaded(self, mxc_uri, image):
+        """
+        Show the original of an image in its own window.
         
-        # Scroll to bottom
-        self.chat_display.verticalScrollBar().setValue(
-            self.chat_display.verticalScrollBar().maximum()
-        )
+        Args:
+            mxc_uri (str): The MXC URI of the image
+            image (QImage): The decoded image, null if loading failed
+        """
+        if image.isNull():
+            QMessageBox.warning(self, "Invalid Image", "Failed to load the image.")
+            return
+        
+        label = QLabel()
+        label.setPixmap(QPixmap.fromImage(image))
+        viewer = QScrollArea()
+        viewer.setWindowTitle(mxc_uri)
+        viewer.setWidget(label)
+        viewer.resize(min(image.width() + 20, 1200), min(image.height() + 20, 800))
+        viewer.show()
+        self.media_viewer = viewer  # Keep a reference so the window stays open
     
     def format_timestamp(self, timestamp_ms):
         """
@@ -402,42 +1039,98 @@ class MatrixGUI(QMainWindow):
         dt = datetime.fromtimestamp(timestamp_ms / 1000)
         return dt.strftime("%Y-%m-%d %H:%M:%S")
     
-    def pixmap_to_base64(self, pixmap: QPixmap) -> str:
+    def send_message(self):
+        if not self.current_room:
+            return
+            
+        message = self.message_input.text()
+        if message:
+            # The message is shown right away and sent in order by the client's send queue
+            room_id = self.current_room
+            txn_id = self.matrix_client.new_transaction_id()
+            future = self.matrix_client.queue_message(room_id, message, txn_id)
+            if future is None:
+                QMessageBox.critical(self, "Send Failed", "Failed to send message.")
+                return
+            self.message_input.clear()
+            self.show_echo(room_id, txn_id, {"msgtype": "m.text", "body": message})
+            self.commands.watch(future, on_result=lambda response: self.message_sent(room_id, txn_id, response),
+                                on_error=lambda error: self.message_sent(room_id, txn_id, None))
+    
+    def show_echo(self, room_id, txn_id, content):
         """
-        Convert a QPixmap to a base64-encoded string.
+        Show a message being sent in its room's timeline before the server has it.
+        
+        The echo is replaced by the server's event once it comes back through sync.
+        A room scrolled back through its history has no room for it below the gap,
+        its message shows up when the newest messages are reloaded instead.
         
         Args:
-            pixmap (QPixmap): The pixmap to convert
-            
-        Returns:
-            str: The base64-encoded string
+            room_id (str): The room the message is sent to
+            txn_id (str): The transaction ID the message is sent with
+            content (dict): The message content
         """
-        # Convert to QImage
-        image = pixmap.toImage()
-        
-        # Convert to bytes
-        byte_array = QByteArray()
-        buffer = QBuffer(byte_array)
-        buffer.open(QIODevice.WriteOnly)
-        image.save(buffer, "PNG")
+        timeline = self.room_timelines.get(room_id)
+        if timeline is None or timeline.has_newer:
+            return
+        echo = Event(room_id, self.matrix_client.user_id, content, origin_server_ts=int(time.time() * 1000),
+                     txn_id=txn_id, send_status=SEND_PENDING)
+        if timeline.model is self.timeline_model:
+            # Sending is a good reason to jump back to the newest messages
+            self.timeline_view.scroll_to_bottom()
+            self.append_messages([echo])
+        else:
+            timeline.model.append_messages([echo])
+    
+    def reconcile_echo(self, timeline, row, event):
+        """
+        Replace the local echo of a sent message with the event the server returned.
         
-        # Convert to base64
-        return base64.b64encode(byte_array).decode('utf-8')
+        Args:
+            timeline (RoomTimeline): The room's timeline
+            row (int): The row of the echo
+            event (Event): The event
+        """
+        local_uri = timeline.model.message(row).url
+        mxc_uri = event.url
+        if local_uri and mxc_uri and local_uri != mxc_uri:
+            # The preview shown for the local file is the preview of the uploaded image too
+            pixmap = self.pixmap_cache.get(local_uri, PREVIEW_SIZE)
+            if pixmap is not None:
+                self.pixmap_cache.put(mxc_uri, PREVIEW_SIZE, pixmap)
+        timeline.model.replace_message(row, event)
     
-    def send_message(self):
-        if not hasattr(self, 'current_room'):
-            return
-            
-        message = self.message_input.text()
-        if message:
-            response = self.matrix_client.send_message(self.current_room, message)
-            if response:
-                self.message_input.clear()
-            else:
+    def message_sent(self, room_id, txn_id, response):
+        """
+        Mark the local echo of a message as sent, or as failed inline.
+        
+        Args:
+            room_id (str): The room the message was sent to
+            txn_id (str): The transaction ID the message was sent with
+            response (Optional[Dict]): The send response, None if sending failed
+        """
+        timeline = self.room_timelines.get(room_id)
+        row = timeline.model.transaction_row(txn_id) if timeline is not None else None
+        if row is None:
+            # No echo to mark, e.g. the room was evicted from the cache meanwhile
+            if not response:
                 QMessageBox.critical(self, "Send Failed", "Failed to send message.")
+            return
+        
+        echo = timeline.model.message(row)
+        if echo.send_status != SEND_PENDING:
+            # The server's event came back through sync first
+            return
+        if response:
+            # The event ID lets reloaded history recognise the message until sync returns it
+            echo.event_id = response.get("event_id")
+            echo.send_status = None
+        else:
+            echo.send_status = SEND_FAILED
+        timeline.model.replace_message(row, echo)
     
     def send_image(self):
-        if not hasattr(self, 'current_room'):
+        if not self.current_room:
             QMessageBox.warning(self, "No Room Selected", "Please select a room first.")
             return
         
@@ -450,62 +1143,81 @@ class MatrixGUI(QMainWindow):
         )
         
         if file_path:
-            response = self.matrix_client.send_image(self.current_room, file_path)
-            if not response:
-                QMessageBox.critical(self, "Send Failed", "Failed to send image.")
-            else:
-                # Display the sent image in the chat
-                image = QImage(file_path)
-                if not image.isNull():
-                    pixmap = QPixmap.fromImage(image)
-                    if not pixmap.isNull():
-                        scaled_pixmap = pixmap.scaled(300, 300, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-                        
-                        # Create HTML for the image
-                        image_html = f'<div style="margin: 10px 0;"><b>You</b> sent an image:<br><img src="data:image/png;base64,{self.pixmap_to_base64(scaled_pixmap)}" style="max-width: 300px; max-height: 300px;"></div>'
-                        self.chat_display.append(image_html)
-                        
-                        # Scroll to bottom
-                        self.chat_display.verticalScrollBar().setValue(
-                            self.chat_display.verticalScrollBar().maximum()
-                        )
-                    else:
-                        QMessageBox.warning(self, "Invalid Image", "Failed to load the selected image.")
-                else:
-                    QMessageBox.warning(self, "Invalid Image", "Failed to load the selected image.")
+            # Only the header is read here, the echo's placeholder is sized from it
+            size = image_file_size(file_path)
+            if size.isEmpty():
+                QMessageBox.warning(self, "Invalid Image", "Failed to load the selected image.")
+                return
+            local_uri = QUrl.fromLocalFile(os.path.abspath(file_path)).toString()
+            
+            room_id = self.current_room
+            txn_id = self.matrix_client.new_transaction_id()
+            self.show_echo(room_id, txn_id, {
+                "msgtype": "m.image",
+                "body": os.path.basename(file_path),
+                "url": local_uri,
+                "info": {"w": size.width(), "h": size.height()}
+            })
+            # Decoded on a worker, the uploaded image then shares the preview
+            self.load_preview(local_uri)
+            self.commands.submit(None, self.matrix_client.send_image, room_id, file_path, txn_id,
+                                 on_result=lambda response: self.message_sent(room_id, txn_id, response),
+                                 on_error=lambda error: self.message_sent(room_id, txn_id, None))
 
     def load_more_messages(self):
         """
-        Load older messages from the current room.
+        Start loading the next page of older messages of the current room in the background.
         """
-        if not self.current_room or not self.last_message_token:
+        timeline = self.room_timelines.get(self.current_room)
+        if timeline is None or timeline.loading or not timeline.has_more:
             return
-            
-        # Get older messages
-        messages = self.matrix_client.get_room_messages(
-            self.current_room,
-            since=self.last_message_token
-        )
+        timeline.loading = True
+        self.history_pool.start(HistoryLoader(timeline.history, self.history_signals))
+    
+    def history_loaded(self, history, messages, error):
+        """
+        Add a page of older messages above the oldest one of its room.
         
-        if messages:
-            # Store current scroll position
-            scrollbar = self.chat_display.verticalScrollBar()
-            old_position = scrollbar.value()
-            old_max = scrollbar.maximum()
-            
-            # Insert messages at the top
-            for message in reversed(messages):
-                self.handle_message(message)
-            
-            # Restore scroll position
-            new_max = scrollbar.maximum()
-            scrollbar.setValue(old_position + (new_max - old_max))
+        Args:
+            history (Iterator[Dict]): The history iterator the page was taken from
+            messages (list): The messages, newest first
+            error (Optional[HistoryPageError]): The error if a page failed to load, None otherwise
+        """
+        timeline = next((timeline for timeline in self.room_timelines.values() if timeline.history is history), None)
+        if timeline is None:
+            # The room was dropped from the cache or its history restarted since
+            return
+        
+        timeline.loading = False
+        if error is not None:
+            # Not the start of the room, the next scroll up tries the failed page again
+            timeline.page_back_from(error.from_token)
+            timeline.has_more = True
+        else:
+            timeline.has_more = len(messages) == HISTORY_PAGE_SIZE
+        
+        # Live messages may have arrived while the first page loaded
+        model = timeline.model
+        messages = [message for message in messages if not model.has_event(message.get("event_id"))]
+        if model.rowCount() == 0:
+            # The first page, shown from the bottom
+            if model is self.timeline_model:
+                self.append_messages(messages[::-1])
+            else:
+                model.append_messages(messages[::-1])
+        elif model is self.timeline_model:
+            # Keeps the same messages in view
+            self.prepend_messages(messages)
         else:
-            QMessageBox.information(self, "No More Messages", "No older messages available.")
+            timeline.model.prepend_messages(messages)
+            if timeline.scroll_position is not None:
+                timeline.scroll_position += len(messages)
+            self.trim_timeline(timeline)
+        self.evict_timelines()
 
 def main():
     app = QApplication(sys.argv)
-    window = MatrixGUI()
+    window = MatrixGUI(data_dir=DEFAULT_DATA_DIR)
     sys.exit(app.exec_())
 
 if __name__ == "__main__":
@@ -0,0 +1,84 @@
+import json
+from typing import Any, List, Optional, Union
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, the standard library codec is used without it
+    orjson = None
+
+
+class JsonCodec:
+    # Name the codec is selected by
+    name = "json"
+
+    def loads(self, data: Union[bytes, str]) -> Any:
+        """
+        Decode a JSON document.
+
+        Response bodies are passed as the bytes they arrived as, the standard
+        library detects their encoding itself, so requests never has to decode
+        them to text first.
+
+        Args:
+            data (Union[bytes, str]): The document
+
+        Returns:
+            Any: The decoded value
+        """
+        return json.loads(data)
+
+    def dumps(self, value: Any) -> str:
+        """
+        Encode a value as a JSON document.
+
+        Args:
+            value (Any): The value
+
+        Returns:
+            str: The document
+        """
+        return json.dumps(value)
+
+
+class OrjsonCodec(JsonCodec):
+    name = "orjson"
+
+    def loads(self, data: Union[bytes, str]) -> Any:
+        return orjson.loads(data)
+
+    def dumps(self, value: Any) -> str:
+        return orjson.dumps(value).decode("utf-8")
+
+
+def available_codecs() -> List[str]:
+    """
+    Get the names of the codecs that can be used here.
+
+    Returns:
+        List[str]: The codec names, the fastest first
+    """
+    return (["orjson"] if orjson is not None else []) + ["json"]
+
+
+def get_codec(name: Optional[str] = None) -> JsonCodec:
+    """
+    Get a JSON codec.
+
+    Args:
+        name (Optional[str]): 'orjson' or 'json', None for the fastest one installed
+
+    Returns:
+        JsonCodec: The codec
+
+    Raises:
+        ValueError: If the codec is unknown or its library isn't installed
+    """
+    if name is None:
+        name = available_codecs()[0]
+    if name == "json":
+        return JsonCodec()
+    if name == "orjson":
+        if orjson is None:
+            raise ValueError("The orjson codec needs the orjson package")
+        return OrjsonCodec()
+    raise ValueError(f"Unknown JSON codec: {name}")
@@ -1,29 +1,101 @@
 import requests
 import json
-from typing import Dict, Optional, Callable
+from typing import BinaryIO, Dict, Optional, Callable, Iterator, Union
 import time
 import threading
-import queue
 import os
 import mimetypes
 import base64
 from urllib.parse import urlparse
+from concurrent.futures import Future, ThreadPoolExecutor
+from matrix_sync import (SyncEngine, MessageQueue, DEFAULT_SYNC_FILTER, DEFAULT_MESSAGE_QUEUE_SIZE,
+                         OVERFLOW_DROP_OLDEST)
+from matrix_store import EventStore
+from matrix_media import MediaCache
+from matrix_send import SendQueue
+from matrix_upload import prepare_image
+from matrix_event import Event
+from matrix_json import JsonCodec, get_codec
+
+# Filter IDs returned by the user filter API, keyed by
+# (homeserver_url, user_id, serialised filter) so every client for the same
+# account and homeserver reuses the filter uploaded first.
+_filter_id_cache = {}
+
+# Default directory for the session snapshot and other client data
+DEFAULT_DATA_DIR = os.path.join(os.path.expanduser("~"), ".whysper")
+
+SESSION_FILE = "session.json"
+
+# Size of the chunks media is streamed in
+MEDIA_CHUNK_SIZE = 64 * 1024
+
+# Prefix of pagination tokens that point into the local event store
+LOCAL_TOKEN_PREFIX = "whysper:"
+
+# Number of times a page of room history is fetched again before iter_room_history gives up
+HISTORY_PAGE_RETRIES = 3
+
+class HistoryPageError(Exception):
+    def __init__(self, room_id: str, from_token: Optional[str]):
+        """
+        Raised by iter_room_history when a page of history can't be fetched.
+        
+        Args:
+            room_id (str): The ID of the room
+            from_token (Optional[str]): The token of the page that failed, history can be resumed from it
+        """
+        super().__init__(f"Failed to fetch history of {room_id}")
+        self.room_id = room_id
+        self.from_token = from_token
+
+def serialise_filter(filter_definition: Dict) -> str:
+    """
+    Serialise a filter definition the same way every time, so equal filters compare equal.
+    
+    Args:
+        filter_definition (Dict): The filter definition
+        
+    Returns:
+        str: The serialised filter
+    """
+    return json.dumps(filter_definition, sort_keys=True, separators=(',', ':'))
 
 class MatrixLogin:
-    def __init__(self, homeserver_url: str):
+    def __init__(self, homeserver_url: str, data_dir: Optional[str] = None, codec: Optional[JsonCodec] = None,
+                 media_cache: Optional[MediaCache] = None):
         """
         Initialize the Matrix login client.
         
         Args:
             homeserver_url (str): The URL of the Matrix homeserver (e.g., 'https://matrix.org')
+            data_dir (Optional[str]): Directory to keep the session snapshot in, None to not persist anything
+            codec (Optional[JsonCodec]): Codec for sync and message responses and stored events,
+                None for the fastest one installed
+            media_cache (Optional[MediaCache]): Cache for downloaded media, None for one with the default
+                budgets and its disk tier in data_dir
         """
         self.homeserver_url = homeserver_url.rstrip('/')
+        self.data_dir = data_dir
+        self.codec = codec or get_codec()
         self.session = requests.Session()
         self.access_token = None
         self.user_id = None
-        self.message_queue = queue.Queue()
-        self.stop_event = threading.Event()
-        self.media_cache = {}  # Cache for downloaded media
+        self.device_id = None
+        self.joined_rooms = []
+        self.message_queue = None  # Only kept once enabled, callbacks get messages either way
+        self.sync_engine = SyncEngine(self)
+        self.send_queue = SendQueue(self)
+        self.sync_filter_id = None
+        self.sync_filter = None  # The serialised filter sync_filter_id was uploaded for
+        self.inline_sync_filter = None
+        self.media_cache = media_cache or MediaCache(disk_dir=os.path.join(data_dir, "media") if data_dir else None)
+        self.event_store = None
+        self.event_store_user = None
+        self.event_store_lock = threading.Lock()
+        self.pagination_tokens = {}  # room_id -> {"start": token, "end": token}
+        self.session_lock = threading.Lock()  # Held while the snapshot is written, it is saved from several threads
+        self.on_session_expired = None  # Called from the sync thread once the access token is rejected
     
     def register(self, username: str, password: str, display_name: Optional[str] = None) -> Optional[Dict]:
         """
@@ -75,6 +147,10 @@ class MatrixLogin:
                 response_data = response.json()
                 self.access_token = response_data.get('access_token')
                 self.user_id = response_data.get('user_id')
+                self.device_id = response_data.get('device_id')
+                self.sync_filter_id = None
+                self.sync_filter = None
+                self.inline_sync_filter = None
                 return response_data
             else:
                 print(f"Registration failed with status code: {response.status_code}")
@@ -120,6 +196,10 @@ class MatrixLogin:
                 response_data = response.json()
                 self.access_token = response_data.get('access_token')
                 self.user_id = response_data.get('user_id')
+                self.device_id = response_data.get('device_id')
+                self.sync_filter_id = None
+                self.sync_filter = None
+                self.inline_sync_filter = None
                 return response_data
             else:
                 print(f"Login failed with status code: {response.status_code}")
@@ -130,6 +210,126 @@ class MatrixLogin:
             print(f"Error during login: {str(e)}")
             return None
 
+    def get_session_path(self) -> Optional[str]:
+        """
+        Get the path of the session snapshot file.
+        
+        Returns:
+            Optional[str]: The snapshot path, None if the client has no data directory
+        """
+        if not self.data_dir:
+            return None
+        return os.path.join(self.data_dir, SESSION_FILE)
+
+    def save_session(self) -> bool:
+        """
+        Save a snapshot of the session so a later start can resume it.
+        
+        The snapshot holds the access token, device ID, sync token, sync filter ID
+        with the filter it belongs to and the joined rooms. It is written atomically and readable only by the owner.
+        
+        Returns:
+            bool: True if the snapshot was saved, False otherwise
+        """
+        path = self.get_session_path()
+        if not path or not self.access_token:
+            return False
+
+        snapshot = {
+            "homeserver_url": self.homeserver_url,
+            "user_id": self.user_id,
+            "access_token": self.access_token,
+            "device_id": self.device_id,
+            "next_batch": self.sync_engine.next_batch,
+            "filter_id": self.sync_filter_id,
+            "filter": self.sync_filter,
+            "joined_rooms": list(self.joined_rooms)
+        }
+        
+        try:
+            os.makedirs(self.data_dir, exist_ok=True)
+            temp_path = f"{path}.tmp"
+            with self.session_lock:
+                fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with os.fdopen(fd, 'w') as file:
+                    json.dump(snapshot, file)
+                os.replace(temp_path, path)
+            return True
+        except OSError as e:
+            print(f"Error saving session: {str(e)}")
+            return False
+
+    def restore_session(self) -> Optional[Dict]:
+        """
+        Resume the session saved by save_session without logging in again.
+        
+        Syncing continues incrementally from the saved sync token.
+        
+        Returns:
+            Optional[Dict]: The session snapshot if it was restored, None if there is none
+        """
+        path = self.get_session_path()
+        if not path or not os.path.exists(path):
+            return None
+
+        try:
+            with open(path, 'r') as file:
+                snapshot = json.load(file)
+        except (OSError, ValueError) as e:
+            print(f"Error reading session: {str(e)}")
+            return None
+
+        if snapshot.get('homeserver_url') != self.homeserver_url or not snapshot.get('access_token'):
+            return None
+
+        self.access_token = snapshot.get('access_token')
+        self.user_id = snapshot.get('user_id')
+        self.device_id = snapshot.get('device_id')
+        # A filter ID saved for another filter definition would sync with the old filter
+        if snapshot.get('filter') == serialise_filter(DEFAULT_SYNC_FILTER):
+            self.sync_filter_id = snapshot.get('filter_id')
+            self.sync_filter = snapshot.get('filter')
+        self.joined_rooms = list(snapshot.get('joined_rooms', []))
+        self.sync_engine.next_batch = snapshot.get('next_batch')
+        return snapshot
+
+    def clear_session(self) -> None:
+        """
+        Delete the session snapshot, e.g. after the access token was rejected.
+        """
+        path = self.get_session_path()
+        if path and os.path.exists(path):
+            try:
+                os.remove(path)
+            except OSError as e:
+                print(f"Error removing session: {str(e)}")
+
+    @classmethod
+    def from_session(cls, data_dir: str, media_cache: Optional[MediaCache] = None) -> Optional['MatrixLogin']:
+        """
+        Create a client from the session snapshot in a data directory.
+        
+        Args:
+            data_dir (str): The data directory holding the snapshot
+            media_cache (Optional[MediaCache]): Cache for downloaded media, None for the default one
+            
+        Returns:
+            Optional[MatrixLogin]: The resumed client, None if there is no usable snapshot
+        """
+        try:
+            with open(os.path.join(data_dir, SESSION_FILE), 'r') as file:
+                homeserver_url = json.load(file).get('homeserver_url')
+        except (OSError, ValueError):
+            return None
+
+        if not homeserver_url:
+            return None
+
+        matrix_client = cls(homeserver_url, data_dir=data_dir, media_cache=media_cache)
+        if not matrix_client.restore_session():
+            return None
+        return matrix_client
+
     def join_room(self, room_id_or_alias: str) -> Optional[Dict]:
         """
         Join a Matrix room using its ID or alias.
@@ -160,7 +360,11 @@ class MatrixLogin:
             )
             
             if response.status_code == 200:
-                return response.json()
+                response_data = response.json()
+                joined_room_id = response_data.get('room_id')
+                if joined_room_id and joined_room_id not in self.joined_rooms:
+                    self.joined_rooms.append(joined_room_id)
+                return response_data
             else:
                 print(f"Failed to join room with status code: {response.status_code}")
                 print(f"Response: {response.text}")
@@ -194,7 +398,9 @@ class MatrixLogin:
             )
             
             if response.status_code == 200:
-                return response.json()
+                response_data = response.json()
+                self.joined_rooms = list(response_data.get('joined_rooms', []))
+                return response_data
             else:
                 print(f"Failed to get joined rooms with status code: {response.status_code}")
                 print(f"Response: {response.text}")
@@ -215,49 +421,129 @@ class MatrixLogin:
         Returns:
             Optional[Dict]: The send response if successful, None if failed
         """
+        future = self.queue_message(room_id, message)
+        return future.result() if future else None
+
+    def new_transaction_id(self) -> str:
+        """
+        Create a transaction ID to send an event with.
+        
+        The event comes back through sync with the ID in unsigned.transaction_id,
+        which lets a local echo shown before sending be matched with it.
+        
+        Returns:
+            str: A transaction ID unique to this client
+        """
+        return self.send_queue.next_txn_id()
+
+    def queue_message(self, room_id: str, message: str, txn_id: Optional[str] = None) -> Optional[Future]:
+        """
+        Queue a text message to be sent to a Matrix room without waiting for it.
+        
+        Messages to the same room are sent in the order they were queued.
+        
+        Args:
+            room_id (str): The room ID (e.g., '!room:matrix.org')
+            message (str): The message to send
+            txn_id (Optional[str]): The transaction ID to send with, None to create one
+            
+        Returns:
+            Optional[Future]: Resolves to the send response, or None if sending failed.
+                Its txn_id attribute holds the message's transaction ID. None if not logged in.
+        """
         if not self.access_token:
             print("Not logged in. Please login first.")
             return None
 
-        # URL encode the room ID
-        encoded_room = requests.utils.quote(room_id)
-        send_url = f"{self.homeserver_url}/_matrix/client/r0/rooms/{encoded_room}/send/m.room.message"
+        payload = {
+            "msgtype": "m.text",
+            "body": message
+        }
+        
+        return self.send_queue.send(room_id, "m.room.message", payload, txn_id)
+
+    def upload_filter(self, filter_definition: Dict) -> Optional[str]:
+        """
+        Upload a filter definition through the user filter API.
+        
+        Args:
+            filter_definition (Dict): The filter definition to upload
+            
+        Returns:
+            Optional[str]: The filter ID if successful, None if failed
+        """
+        if not self.access_token:
+            print("Not logged in. Please login first.")
+            return None
+
+        encoded_user = requests.utils.quote(self.user_id)
+        filter_url = f"{self.homeserver_url}/_matrix/client/r0/user/{encoded_user}/filter"
         
         headers = {
             "Authorization": f"Bearer {self.access_token}",
             "Content-Type": "application/json"
         }
         
-        # Generate a unique transaction ID using timestamp
-        txn_id = str(int(time.time() * 1000))
-        
-        payload = {
-            "msgtype": "m.text",
-            "body": message
-        }
-        
         try:
-            response = self.session.put(
-                f"{send_url}/{txn_id}",
-                json=payload,
+            response = self.session.post(
+                filter_url,
+                json=filter_definition,
                 headers=headers
             )
             
             if response.status_code == 200:
-                return response.json()
+                return response.json().get('filter_id')
             else:
-                print(f"Failed to send message with status code: {response.status_code}")
+                print(f"Failed to upload filter with status code: {response.status_code}")
                 print(f"Response: {response.text}")
                 return None
                 
         except requests.exceptions.RequestException as e:
-            print(f"Error sending message: {str(e)}")
+            print(f"Error uploading filter: {str(e)}")
             return None
 
+    def get_sync_filter(self, filter_definition: Dict = DEFAULT_SYNC_FILTER) -> str:
+        """
+        Get the value to pass as the /sync filter parameter.
+        
+        The filter is uploaded once per account and homeserver and the returned
+        filter ID is reused for every later sync. If the upload fails the filter
+        is sent inline instead.
+        
+        Args:
+            filter_definition (Dict): The filter definition to use for syncing
+            
+        Returns:
+            str: The filter ID, or the serialised filter if it couldn't be uploaded
+        """
+        if self.sync_filter_id:
+            return self.sync_filter_id
+        if self.inline_sync_filter:
+            return self.inline_sync_filter
+        
+        serialised = serialise_filter(filter_definition)
+        
+        cache_key = (self.homeserver_url, self.user_id, serialised)
+        filter_id = _filter_id_cache.get(cache_key)
+        if not filter_id:
+            filter_id = self.upload_filter(filter_definition)
+            if not filter_id:
+                # Don't retry the upload on every sync, keep using the inline filter
+                self.inline_sync_filter = serialised
+                return serialised
+            _filter_id_cache[cache_key] = filter_id
+        
+        self.sync_filter_id = filter_id
+        self.sync_filter = serialised
+        return filter_id
+
     def start_listening(self, room_id: str, message_callback: Optional[Callable[[Dict], None]] = None) -> None:
         """
         Start listening for messages in a room.
         
+        All rooms share the client's single sync loop, so listening to another
+        room only adds a subscriber and does not start another /sync long-poll.
+        
         Args:
             room_id (str): The room ID to listen to
             message_callback (Optional[Callable[[Dict], None]]): Optional callback function for received messages
@@ -266,67 +552,54 @@ class MatrixLogin:
             print("Not logged in. Please login first.")
             return
 
-        def listen_thread():
-            next_batch = None
-            
-            while not self.stop_event.is_set():
-                try:
-                    sync_url = f"{self.homeserver_url}/_matrix/client/r0/sync"
-                    params = {
-                        "access_token": self.access_token,
-                        "timeout": 30000,  # 30 seconds
-                        "filter": json.dumps({
-                            "room": {
-                                "timeline": {
-                                    "limit": 10
-                                }
-                            }
-                        })
-                    }
-                    
-                    if next_batch:
-                        params["since"] = next_batch
-                    
-                    response = self.session.get(sync_url, params=params)
-                    
-                    if response.status_code == 200:
-                        data = response.json()
-                        next_batch = data.get("next_batch")
-                        
-                        # Process room events
-                        for room_id, room_data in data.get("rooms", {}).get("join", {}).items():
-                            for event in room_data.get("timeline", {}).get("events", []):
-                                if event.get("type") == "m.room.message":
-                                    message = {
-                                        "room_id": room_id,
-                                        "sender": event.get("sender"),
-                                        "content": event.get("content", {}),
-                                        "event_id": event.get("event_id")
-                                    }
-                                    
-                                    # Add message to queue
-                                    self.message_queue.put(message)
-                                    
-                                    # Call callback if provided
-                                    if message_callback:
-                                        message_callback(message)
-                    
-                except requests.exceptions.RequestException as e:
-                    print(f"Error during sync: {str(e)}")
-                    time.sleep(5)  # Wait before retrying
-                except Exception as e:
-                    print(f"Unexpected error: {str(e)}")
-                    time.sleep(5)  # Wait before retrying
-        
-        # Start the listening thread
-        self.stop_event.clear()
-        threading.Thread(target=listen_thread, daemon=True).start()
+        if message_callback:
+            self.sync_engine.subscribe(room_id, message_callback)
+        
+        # Start the shared sync loop if it isn't running yet
+        self.sync_engine.start()
     
-    def stop_listening(self) -> None:
+    def stop_listening(self, room_id: Optional[str] = None,
+                       message_callback: Optional[Callable[[Dict], None]] = None) -> None:
         """
         Stop listening for messages.
+        
+        Args:
+            room_id (Optional[str]): The room to unsubscribe from, None to stop the sync loop entirely
+            message_callback (Optional[Callable[[Dict], None]]): The callback to remove, None for all callbacks of the room
+        """
+        if room_id is None:
+            self.sync_engine.stop()
+        else:
+            self.sync_engine.unsubscribe(room_id, message_callback)
+    
+    def enable_message_queue(self, maxsize: int = DEFAULT_MESSAGE_QUEUE_SIZE,
+                             overflow: str = OVERFLOW_DROP_OLDEST) -> MessageQueue:
+        """
+        Start queueing received messages for get_next_message.
+        
+        Clients receiving messages through callbacks don't need the queue, so
+        it is off unless enabled. It is bounded, and when it is full the
+        overflow policy either blocks the sync loop until a message is taken,
+        drops the oldest queued message or drops the new one.
+        
+        Args:
+            maxsize (int): Maximum number of queued messages
+            overflow (str): OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST or OVERFLOW_DROP_NEWEST
+            
+        Returns:
+            MessageQueue: The queue, whose stats() report drops and the high-water mark
         """
-        self.stop_event.set()
+        self.disable_message_queue()
+        self.message_queue = MessageQueue(maxsize, overflow)
+        return self.message_queue
+    
+    def disable_message_queue(self) -> None:
+        """
+        Stop queueing received messages and release the queued ones.
+        """
+        if self.message_queue is not None:
+            self.message_queue.close()
+            self.message_queue = None
     
     def get_next_message(self, timeout: Optional[float] = None) -> Optional[Dict]:
         """
@@ -336,12 +609,13 @@ class MatrixLogin:
             timeout (Optional[float]): Timeout in seconds, None for no timeout
             
         Returns:
-            Optional[Dict]: The next message if available, None if timeout or no messages
+            Optional[Dict]: The next message if available, None if timeout, no messages
+                or the queue isn't enabled
         """
-        try:
-            return self.message_queue.get(timeout=timeout)
-        except queue.Empty:
+        if self.message_queue is None:
+            print("Message queue not enabled. Call enable_message_queue first.")
             return None
+        return self.message_queue.get(timeout=timeout)
 
     def upload_file(self, file_path: str) -> Optional[Dict]:
         """
@@ -350,6 +624,32 @@ class MatrixLogin:
         Args:
             file_path (str): Path to the file to upload
             
+        Returns:
+            Optional[Dict]: The upload response containing the MXC URI if successful, None if failed
+        """
+        # Get file info
+        file_name = os.path.basename(file_path)
+        mime_type, _ = mimetypes.guess_type(file_path)
+        if not mime_type:
+            mime_type = 'application/octet-stream'
+        
+        try:
+            # Read and upload file
+            with open(file_path, 'rb') as file:
+                return self.upload_data(file, mime_type, file_name)
+        except OSError as e:
+            print(f"Error uploading file: {str(e)}")
+            return None
+
+    def upload_data(self, data: Union[bytes, BinaryIO], mime_type: str, file_name: str) -> Optional[Dict]:
+        """
+        Upload content to the Matrix homeserver.
+        
+        Args:
+            data (Union[bytes, BinaryIO]): The content, or a file object to stream it from
+            mime_type (str): The content's MIME type
+            file_name (str): The file name to upload the content under
+            
         Returns:
             Optional[Dict]: The upload response containing the MXC URI if successful, None if failed
         """
@@ -358,12 +658,6 @@ class MatrixLogin:
             return None
 
         try:
-            # Get file info
-            file_name = os.path.basename(file_path)
-            mime_type, _ = mimetypes.guess_type(file_path)
-            if not mime_type:
-                mime_type = 'application/octet-stream'
-            
             # Prepare upload URL
             upload_url = f"{self.homeserver_url}/_matrix/media/r0/upload"
             params = {
@@ -371,16 +665,14 @@ class MatrixLogin:
                 "filename": file_name
             }
             
-            # Read and upload file
-            with open(file_path, 'rb') as file:
-                response = self.session.post(
-                    upload_url,
-                    params=params,
-                    data=file,
-                    headers={
-                        "Content-Type": mime_type
-                    }
-                )
+            response = self.session.post(
+                upload_url,
+                params=params,
+                data=data,
+                headers={
+                    "Content-Type": mime_type
+                }
+            )
             
             if response.status_code == 200:
                 return response.json()
@@ -393,13 +685,21 @@ class MatrixLogin:
             print(f"Error uploading file: {str(e)}")
             return None
 
-    def send_image(self, room_id: str, image_path: str) -> Optional[Dict]:
+    def send_image(self, room_id: str, image_path: str, txn_id: Optional[str] = None,
+                   downscale: bool = True) -> Optional[Dict]:
         """
         Send an image to a Matrix room.
         
+        Large images are downscaled and recompressed before uploading unless
+        downscale is False. Images larger than a thumbnail are sent with one, and
+        the dimensions of both are included, so recipients can lay out and draw
+        a preview without downloading the full image.
+        
         Args:
             room_id (str): The room ID to send the image to
             image_path (str): Path to the image file
+            txn_id (Optional[str]): The transaction ID to send with, None to create one
+            downscale (bool): Whether large images may be downscaled and recompressed
             
         Returns:
             Optional[Dict]: The send response if successful, None if failed
@@ -408,67 +708,64 @@ class MatrixLogin:
             print("Not logged in. Please login first.")
             return None
 
-        # Upload the image first
-        upload_response = self.upload_file(image_path)
-        if not upload_response:
+        file_name = os.path.basename(image_path)
+        try:
+            prepared = prepare_image(image_path, downscale)
+        except OSError as e:
+            print(f"Error reading image: {str(e)}")
             return None
-
+        
+        if prepared is None:
+            # Not decodable here, send the file as it is
+            upload_response = self.upload_file(image_path)
+            mime_type, _ = mimetypes.guess_type(image_path)
+            info = {
+                "mimetype": mime_type or 'image/jpeg',  # Default to JPEG if type can't be determined
+                "size": os.path.getsize(image_path)
+            }
+            thumbnail_response = None
+        else:
+            # The thumbnail is uploaded while the image is
+            executor = ThreadPoolExecutor(max_workers=1)
+            try:
+                thumbnail_future = None
+                if prepared.thumbnail is not None:
+                    thumbnail_future = executor.submit(self.upload_data, prepared.thumbnail.data,
+                                                       prepared.thumbnail.mime_type, f"thumbnail-{file_name}")
+                upload_response = self.upload_data(prepared.image.data, prepared.image.mime_type, file_name)
+                thumbnail_response = thumbnail_future.result() if thumbnail_future else None
+            finally:
+                executor.shutdown(wait=False)
+            info = prepared.image.info()
+        
         # Get the MXC URI from the upload response
-        mxc_uri = upload_response.get('content_uri')
+        mxc_uri = upload_response.get('content_uri') if upload_response else None
         if not mxc_uri:
             return None
 
-        # Get image info
-        file_name = os.path.basename(image_path)
-        mime_type, _ = mimetypes.guess_type(image_path)
-        if not mime_type:
-            mime_type = 'image/jpeg'  # Default to JPEG if type can't be determined
+        # A failed thumbnail upload only costs recipients the full download
+        thumbnail_uri = thumbnail_response.get('content_uri') if thumbnail_response else None
+        if thumbnail_uri:
+            info["thumbnail_url"] = thumbnail_uri
+            info["thumbnail_info"] = prepared.thumbnail.info()
 
-        # Prepare the send URL
-        encoded_room = requests.utils.quote(room_id)
-        send_url = f"{self.homeserver_url}/_matrix/client/r0/rooms/{encoded_room}/send/m.room.message"
-        
-        # Generate a unique transaction ID
-        txn_id = str(int(time.time() * 1000))
-        
         # Prepare the message payload
         payload = {
             "msgtype": "m.image",
             "body": file_name,
             "url": mxc_uri,
-            "info": {
-                "mimetype": mime_type,
-                "size": os.path.getsize(image_path)
-            }
-        }
-        
-        headers = {
-            "Authorization": f"Bearer {self.access_token}",
-            "Content-Type": "application/json"
+            "info": info
         }
         
-        try:
-            response = self.session.put(
-                f"{send_url}/{txn_id}",
-                json=payload,
-                headers=headers
-            )
-            
-            if response.status_code == 200:
-                return response.json()
-            else:
-                print(f"Failed to send image with status code: {response.status_code}")
-                print(f"Response: {response.text}")
-                return None
-                
-        except requests.exceptions.RequestException as e:
-            print(f"Error sending image: {str(e)}")
-            return None
+        return self.send_queue.send(room_id, "m.room.message", payload, txn_id).result()
 
     def download_media(self, mxc_uri: str) -> bytes:
         """
         Download media from a Matrix MXC URI.
         
+        Downloaded media is kept in the client's media cache, so repeat
+        downloads of the same URI don't touch the network.
+        
         Args:
             mxc_uri (str): The MXC URI of the media to download
             
@@ -493,6 +790,11 @@ class MatrixLogin:
             server_name = parts[0]
             media_id = parts[1]
             
+            # MXC content is immutable, so a cached copy never needs revalidating
+            cached = self.media_cache.get(mxc_uri)
+            if cached is not None:
+                return cached
+            
             # Construct download URL
             download_url = f"{self.homeserver_url}/_matrix/media/r0/download/{server_name}/{media_id}"
             
@@ -503,6 +805,7 @@ class MatrixLogin:
             )
             
             if response.status_code == 200:
+                self.media_cache.put(mxc_uri, response.content)
                 return response.content
             else:
                 print(f"Failed to download media. Status code: {response.status_code}")
@@ -513,6 +816,189 @@ class MatrixLogin:
             print(f"Error downloading media: {str(e)}")
             return None
 
+    def download_thumbnail(self, mxc_uri: str, width: int, height: int, method: str = "scale") -> Optional[bytes]:
+        """
+        Download a thumbnail of media from a Matrix MXC URI.
+        
+        The homeserver generates the thumbnail, so only a preview sized image is
+        transferred. Thumbnails are kept in the client's media cache.
+        
+        Args:
+            mxc_uri (str): The MXC URI of the media
+            width (int): The desired width in pixels
+            height (int): The desired height in pixels
+            method (str): 'scale' to fit within the size, 'crop' to fill it
+            
+        Returns:
+            Optional[bytes]: The thumbnail data, or None if the download failed
+        """
+        if not self.access_token:
+            print("Not logged in. Please login first.")
+            return None
+
+        if not mxc_uri.startswith("mxc://") or len(mxc_uri[6:].split("/")) != 2:
+            print(f"Invalid MXC URI: {mxc_uri}")
+            return None
+        server_name, media_id = mxc_uri[6:].split("/")
+        
+        cache_key = f"{mxc_uri}#thumbnail={width}x{height},{method}"
+        cached = self.media_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        
+        try:
+            thumbnail_url = f"{self.homeserver_url}/_matrix/media/r0/thumbnail/{server_name}/{media_id}"
+            response = self.session.get(
+                thumbnail_url,
+                params={"width": width, "height": height, "method": method},
+                headers={"Authorization": f"Bearer {self.access_token}"}
+            )
+            
+            if response.status_code == 200:
+                self.media_cache.put(cache_key, response.content)
+                return response.content
+            else:
+                print(f"Failed to download thumbnail. Status code: {response.status_code}")
+                print(f"Response: {response.text}")
+                return None
+                
+        except requests.exceptions.RequestException as e:
+            print(f"Error downloading thumbnail: {str(e)}")
+            return None
+
+    def iter_media(self, mxc_uri: str, chunk_size: int = MEDIA_CHUNK_SIZE, offset: int = 0,
+                   size_callback: Optional[Callable[[Optional[int]], None]] = None) -> Iterator[bytes]:
+        """
+        Download media from a Matrix MXC URI as a stream of chunks.
+        
+        Only one chunk is held in memory at a time, whatever the size of the media.
+        
+        Args:
+            mxc_uri (str): The MXC URI of the media to download
+            chunk_size (int): Maximum size of each chunk in bytes
+            offset (int): Number of bytes to skip, requested with an HTTP Range header. If the
+                media isn't longer than that, only the size is reported and nothing is yielded
+            size_callback (Optional[Callable[[Optional[int]], None]]): Called with the total
+                size of the media before the first chunk, None if the server doesn't say
+            
+        Returns:
+            Iterator[bytes]: The media data in chunks, nothing if the download failed
+            
+        Raises:
+            requests.exceptions.RequestException: If the connection fails while streaming
+        """
+        if not self.access_token:
+            print("Not logged in. Please login first.")
+            return
+
+        if not mxc_uri.startswith("mxc://") or len(mxc_uri[6:].split("/")) != 2:
+            print(f"Invalid MXC URI: {mxc_uri}")
+            return
+        server_name, media_id = mxc_uri[6:].split("/")
+        
+        download_url = f"{self.homeserver_url}/_matrix/media/r0/download/{server_name}/{media_id}"
+        headers = {"Authorization": f"Bearer {self.access_token}"}
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+        
+        with self.session.get(download_url, headers=headers, stream=True) as response:
+            if response.status_code == 416 and offset:
+                # Nothing left after the offset, the server says the total size in 'bytes */<total>'
+                total = response.headers.get("Content-Range", "").rsplit("/", 1)[-1]
+                if total.isdigit():
+                    if size_callback:
+                        size_callback(int(total))
+                    return
+            
+            if response.status_code not in (200, 206):
+                print(f"Failed to download media. Status code: {response.status_code}")
+                return
+            
+            content_length = response.headers.get("Content-Length")
+            if response.status_code == 206:
+                content_range = response.headers.get("Content-Range", "")
+                total = content_range.rsplit("/", 1)[-1]
+                total = int(total) if total.isdigit() else None
+                skip = 0
+            else:
+                # The server ignored the Range header and sent everything
+                total = int(content_length) if content_length else None
+                skip = offset
+            
+            if size_callback:
+                size_callback(total)
+            
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                if skip:
+                    if len(chunk) <= skip:
+                        skip -= len(chunk)
+                        continue
+                    chunk = chunk[skip:]
+                    skip = 0
+                yield chunk
+
+    def download_media_to_file(self, mxc_uri: str, file_path: str,
+                               progress_callback: Optional[Callable[[int, Optional[int]], None]] = None,
+                               chunk_size: int = MEDIA_CHUNK_SIZE, max_retries: int = 3) -> bool:
+        """
+        Download media from a Matrix MXC URI straight to a file.
+        
+        The data is written in chunks to '<file_path>.part' and renamed once complete.
+        An interrupted download, or a partial file left by an earlier attempt, is
+        resumed with an HTTP Range request. A partial file that is complete already,
+        e.g. after a crash before the rename, is only renamed.
+        
+        Args:
+            mxc_uri (str): The MXC URI of the media to download
+            file_path (str): Path of the file to write
+            progress_callback (Optional[Callable[[int, Optional[int]], None]]): Called with the number
+                of bytes downloaded and the total size (None if unknown) after every chunk
+            chunk_size (int): Maximum size of each chunk in bytes
+            max_retries (int): Number of times to resume after the connection fails
+            
+        Returns:
+            bool: True if the file was downloaded, False if failed
+        """
+        part_path = f"{file_path}.part"
+        response_info = {}
+        
+        def set_total(size):
+            response_info["total"] = size
+        
+        for attempt in range(max_retries + 1):
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            response_info.clear()
+            try:
+                with open(part_path, 'ab') as file:
+                    for chunk in self.iter_media(mxc_uri, chunk_size, offset, set_total):
+                        file.write(chunk)
+                        offset += len(chunk)
+                        if progress_callback:
+                            progress_callback(offset, response_info["total"])
+                
+                if "total" not in response_info:
+                    return False  # The server refused the request
+                total = response_info["total"]
+                if total is not None and offset > total:
+                    # The partial file is longer than the media, it can't be resumed
+                    os.remove(part_path)
+                    continue
+                if total is not None and offset < total:
+                    raise requests.exceptions.ChunkedEncodingError("Download ended early")
+                
+                os.replace(part_path, file_path)
+                return True
+                
+            except requests.exceptions.RequestException as e:
+                print(f"Error downloading media: {str(e)}")
+                if attempt < max_retries:
+                    time.sleep(min(2 ** attempt, 10))  # Back off before resuming
+            except OSError as e:
+                print(f"Error writing media: {str(e)}")
+                return False
+        
+        return False
+
     def get_media_url(self, mxc_uri: str) -> Optional[str]:
         """
         Get the direct URL for a Matrix MXC URI.
@@ -546,23 +1032,57 @@ class MatrixLogin:
             print(f"Error getting media URL: {str(e)}")
             return None
 
-    def get_room_messages(self, room_id: str, limit: int = 50, since: str = None, filter_type: str = None) -> list:
+    def decode_response(self, response: requests.Response) -> Dict:
         """
-        Get messages from a room with improved functionality.
+        Decode a JSON response body with the client's codec.
+
+        The body is decoded straight from the bytes received, instead of
+        going through the text requests would first decode it to.
+
+        Args:
+            response (requests.Response): The response
+
+        Returns:
+            Dict: The decoded body
+        """
+        return self.codec.loads(response.content)
+
+    def get_event_store(self) -> EventStore:
+        """
+        Get the local event store of the logged in account.
+        
+        The store is kept in the data directory, or in memory if the client has none.
+        
+        Returns:
+            EventStore: The account's event store
+        """
+        with self.event_store_lock:
+            if self.event_store is None or self.event_store_user != self.user_id:
+                if self.event_store is not None:
+                    self.event_store.close()
+                if self.data_dir and self.user_id:
+                    os.makedirs(self.data_dir, exist_ok=True)
+                    file_name = f"events-{requests.utils.quote(self.user_id, safe='')}.sqlite3"
+                    self.event_store = EventStore(os.path.join(self.data_dir, file_name), self.codec)
+                else:
+                    self.event_store = EventStore(codec=self.codec)
+                self.event_store_user = self.user_id
+            return self.event_store
+
+    def fetch_room_messages(self, room_id: str, limit: int, from_token: Optional[str] = None,
+                            filter_type: Optional[str] = None) -> Optional[Dict]:
+        """
+        Fetch a page of older room events from the homeserver.
         
         Args:
             room_id (str): The ID of the room to get messages from
-            limit (int): Maximum number of messages to retrieve per request
-            since (str): Token to paginate from (for getting older messages)
-            filter_type (str): Optional filter for message types (e.g., 'm.text', 'm.image')
+            limit (int): Maximum number of events to retrieve
+            from_token (Optional[str]): Pagination token to start from, None for the newest events
+            filter_type (Optional[str]): Optional filter for message types (e.g., 'm.text', 'm.image')
             
         Returns:
-            list: List of messages from the room
+            Optional[Dict]: The /messages response with 'chunk' and 'end' if successful, None if failed
         """
-        if not self.access_token:
-            print("Not logged in. Please login first.")
-            return []
-
         try:
             # Prepare the request parameters
             params = {
@@ -571,9 +1091,9 @@ class MatrixLogin:
                 "access_token": self.access_token
             }
             
-            # Add since token if provided
-            if since:
-                params["from"] = since
+            # Add pagination token if provided
+            if from_token:
+                params["from"] = from_token
                 
             # Add filter if provided
             if filter_type:
@@ -583,81 +1103,296 @@ class MatrixLogin:
                 })
             
             # Make the request
+            encoded_room = requests.utils.quote(room_id)
             response = self.session.get(
-                f"{self.homeserver_url}/_matrix/client/r0/rooms/{room_id}/messages",
+                f"{self.homeserver_url}/_matrix/client/r0/rooms/{encoded_room}/messages",
                 params=params
             )
             
             if response.status_code == 200:
-                data = response.json()
-                messages = data.get('chunk', [])
-                
-                # Process messages to include additional metadata
-                processed_messages = []
-                for msg in messages:
-                    # Add room_id to each message
-                    msg['room_id'] = room_id
-                    
-                    # Add timestamp if not present
-                    if 'origin_server_ts' not in msg:
-                        msg['origin_server_ts'] = int(time.time() * 1000)
-                    
-                    processed_messages.append(msg)
-                
-                return processed_messages
+                return self.decode_response(response)
             else:
                 print(f"Failed to get room messages. Status code: {response.status_code}")
                 print(f"Response: {response.text}")
-                return []
+                return None
                 
         except requests.exceptions.RequestException as e:
             print(f"Error getting room messages: {str(e)}")
-            return []
+            return None
         except Exception as e:
             print(f"Unexpected error getting room messages: {str(e)}")
+            return None
+
+    def get_room_messages_page(self, room_id: str, limit: int = 50, from_token: Optional[str] = None) -> Optional[Dict]:
+        """
+        Get a page of room events going back in time, with its pagination tokens.
+        
+        Events already in the local event store are served from it and only the
+        events below the stored span are fetched from the homeserver. Tokens for
+        positions inside the store are local tokens, other tokens are passed to
+        the homeserver as they are. Until the first sync of the session, stored
+        events may be stale, so the newest page is fetched from the homeserver
+        and stored above them, with a gap if the two don't meet.
+        
+        Args:
+            room_id (str): The ID of the room to get messages from
+            limit (int): Maximum number of events to retrieve
+            from_token (Optional[str]): The 'end' token of the previous page, None for the newest events
+            
+        Returns:
+            Optional[Dict]: The page with 'chunk' (Events, newest first), 'start' and 'end', where 'end' is
+                None at the start of the room. None if the request failed.
+        """
+        if not self.access_token:
+            print("Not logged in. Please login first.")
+            return None
+
+        store = self.get_event_store()
+        room = store.get_room(room_id)
+        
+        if from_token is None and room is not None and not self.sync_engine.synced:
+            data = self.fetch_room_messages(room_id, limit)
+            if data is not None:
+                # Newest first, stored like a limited sync timeline
+                store.add_timeline(room_id, data.get('chunk', [])[::-1], data.get('end'), limited=True)
+                room = store.get_room(room_id)
+        
+        if from_token and not from_token.startswith(LOCAL_TOKEN_PREFIX):
+            # A homeserver token, fetch it and add the page to the store if it continues the span
+            data = self.fetch_room_messages(room_id, limit, from_token)
+            if data is None:
+                return None
+            chunk = data.get('chunk', [])
+            if room is not None and from_token == room[2]:
+                store.add_history(room_id, chunk, data.get('end'))
+            end = data.get('end') if chunk else None
+            page = {"chunk": chunk, "start": from_token, "end": end}
+        else:
+            before = int(from_token[len(LOCAL_TOKEN_PREFIX):]) if from_token else None
+            rows = store.get_events(room_id, limit, before)
+            chunk = [event for _, event in rows]
+            gap = store.get_gap(room_id, before) if len(chunk) < limit else None
+            
+            data = None
+            if gap is not None:
+                # Fill the gap a limited sync left below the returned events from the homeserver
+                gap_ordering, gap_token = gap
+                data = self.fetch_room_messages(room_id, limit - len(chunk), gap_token)
+                if data is None and not chunk:
+                    return None
+                filled = []
+                if data is not None:
+                    filled = store.fill_gap(room_id, gap_ordering, data.get('chunk', []), data.get('end'))
+                    chunk.extend(filled)
+                end = f"{LOCAL_TOKEN_PREFIX}{gap_ordering - len(filled)}"
+            else:
+                # Fill the gap below the stored events from the homeserver
+                if len(chunk) < limit and (room is None or (room[2] and not room[3])):
+                    data = self.fetch_room_messages(room_id, limit - len(chunk), room[2] if room else None)
+                    if data is None and not chunk:
+                        return None
+                    if data is not None:
+                        store.add_history(room_id, data.get('chunk', []), data.get('end'))
+                        seen = {event.get('event_id') for event in chunk}
+                        chunk.extend(event for event in data.get('chunk', []) if event.get('event_id') not in seen)
+                        room = store.get_room(room_id)
+                
+                # Continue below the oldest returned event, or stop at the start of the room
+                if data is not None:
+                    end = None if room[3] else f"{LOCAL_TOKEN_PREFIX}{room[0]}"
+                elif rows and not (room[3] and rows[-1][0] <= room[0]):
+                    end = f"{LOCAL_TOKEN_PREFIX}{rows[-1][0]}"
+                else:
+                    end = None
+            page = {"chunk": chunk, "start": from_token, "end": end}
+        
+        # Hand out compact events, which also carry their room
+        page["chunk"] = [Event.from_wire(event, room_id) for event in page["chunk"]]
+        
+        self.pagination_tokens[room_id] = {"start": page["start"], "end": page["end"]}
+        return page
+
+    def has_missing_events_after(self, room_id: str, event_id: str) -> bool:
+        """
+        Check whether events after a stored event are missing because of a gap in sync.
+        
+        Args:
+            room_id (str): The ID of the room
+            event_id (str): The ID of the event
+            
+        Returns:
+            bool: True if a limited sync left out events somewhere after the event
+        """
+        store = self.get_event_store()
+        ordering = store.get_ordering(event_id) if event_id else None
+        return ordering is not None and store.has_gap_after(room_id, ordering)
+
+    def get_history_token(self, room_id: str, event_id: str) -> Optional[str]:
+        """
+        Get a token to page back through a room's history from just below a stored event.
+        
+        Args:
+            room_id (str): The ID of the room
+            event_id (str): The ID of the event
+            
+        Returns:
+            Optional[str]: A local token for get_room_messages_page, None if the event isn't stored
+        """
+        ordering = self.get_event_store().get_ordering(event_id) if event_id else None
+        if ordering is None:
+            return None
+        return f"{LOCAL_TOKEN_PREFIX}{ordering}"
+
+    def get_newer_room_messages(self, room_id: str, event_id: str, limit: int = 50) -> Optional[list]:
+        """
+        Get the stored events of a room that came after an event.
+        
+        Every event received through sync is stored, so these are served from the
+        local event store only. Newer events can't be continued from across a
+        gap a limited sync left in the stored span.
+        
+        Args:
+            room_id (str): The ID of the room
+            event_id (str): The ID of the event to continue after
+            limit (int): Maximum number of events to return
+            
+        Returns:
+            Optional[list]: The Events, oldest first. None if the event isn't stored or
+                events after it are missing because of a gap in sync since.
+        """
+        store = self.get_event_store()
+        ordering = store.get_ordering(event_id) if event_id else None
+        if ordering is None or store.has_gap_after(room_id, ordering):
+            return None
+        
+        return [Event.from_wire(event, room_id) for _, event in store.get_events_after(room_id, ordering, limit)]
+
+    def get_room_messages(self, room_id: str, limit: int = 50, since: str = None, filter_type: str = None) -> list:
+        """
+        Get messages from a room with improved functionality.
+        
+        The pagination tokens of the returned page are kept in pagination_tokens[room_id].
+        
+        Args:
+            room_id (str): The ID of the room to get messages from
+            limit (int): Maximum number of messages to retrieve per request
+            since (str): Token to paginate from (for getting older messages)
+            filter_type (str): Optional filter for message types (e.g., 'm.text', 'm.image')
+            
+        Returns:
+            list: List of messages from the room as Events, newest first
+        """
+        if not self.access_token:
+            print("Not logged in. Please login first.")
             return []
 
+        if not filter_type:
+            page = self.get_room_messages_page(room_id, limit, since)
+            return page["chunk"] if page else []
+        
+        # Filtered pages can't be served from the store
+        data = self.fetch_room_messages(room_id, limit, since, filter_type)
+        if data is None:
+            return []
+        
+        messages = [Event.from_wire(event, room_id) for event in data.get('chunk', [])]
+        
+        self.pagination_tokens[room_id] = {"start": since, "end": data.get('end') if messages else None}
+        return messages
+
+    def iter_room_history(self, room_id: str, page_size: int = 50, from_token: Optional[str] = None) -> Iterator[Event]:
+        """
+        Iterate over the events of a room going back in time.
+        
+        While the events of one page are being consumed the next page is already
+        fetched in the background. A page that fails is fetched again with
+        backoff, iteration only ends early by raising, so running out of events
+        always means the start of the room was reached.
+        
+        Args:
+            room_id (str): The ID of the room
+            page_size (int): Number of events to fetch per page
+            from_token (Optional[str]): Token to start from, None for the newest events
+            
+        Returns:
+            Iterator[Event]: The room's events, newest first
+            
+        Raises:
+            HistoryPageError: If a page still failed after HISTORY_PAGE_RETRIES retries
+        """
+        executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            token = from_token
+            retries = 0
+            future = executor.submit(self.get_room_messages_page, room_id, page_size, token)
+            while future is not None:
+                page = future.result()
+                if page is None:
+                    if retries == HISTORY_PAGE_RETRIES:
+                        raise HistoryPageError(room_id, token)
+                    time.sleep(2 ** retries)
+                    retries += 1
+                    future = executor.submit(self.get_room_messages_page, room_id, page_size, token)
+                    continue
+                retries = 0
+                
+                # Prefetch the next page while this one is consumed
+                token = page.get("end")
+                future = executor.submit(self.get_room_messages_page, room_id, page_size, token) if token else None
+                
+                for event in page["chunk"]:
+                    yield event
+        finally:
+            executor.shutdown(wait=False)
+
 def main():
     # Example usage
     homeserver = "https://matrix.org"
     
-    # Ask user if they want to register or login
-    action = input("Do you want to (1) Register or (2) Login? Enter 1 or 2: ")
-    
-    matrix_client = MatrixLogin(homeserver)
+    # Resume the previous session if there is one
+    matrix_client = MatrixLogin.from_session(DEFAULT_DATA_DIR)
     
-    if action == "1":
-        # Registration flow
-        # WARNING: AN HOMESERVER IS NEEDED THAT DOES NOT REQUIRE EMAIL VERIFICATION OR PHONE NUMBER VERIFICATION
-        # TODO a resgistration function that allows for email and phone number verification.
-        username = input("Enter desired username (without @ and homeserver): ")
-        password = input("Enter desired password: ")
-        display_name = input("Enter display name (optional, press Enter to skip): ")
-        
-        response = matrix_client.register(username, password, display_name if display_name else None)
-        
-        if response:
-            print("\nRegistration successful!")
-            print(f"User ID: {response.get('user_id')}")
-            print(f"Access Token: {response.get('access_token')[:20]}...")  # Only show first 20 chars of token
-        else:
-            print("\nRegistration failed. Please try again.")
-            return
+    if matrix_client:
+        print(f"\nResumed session for {matrix_client.user_id}")
     else:
-        # Login flow
-        username = input("Enter your Matrix username (e.g., @user:matrix.org): ")
-        password = input("Enter your password: ")
+        # Ask user if they want to register or login
+        action = input("Do you want to (1) Register or (2) Login? Enter 1 or 2: ")
         
-        response = matrix_client.login(username, password)
+        matrix_client = MatrixLogin(homeserver, data_dir=DEFAULT_DATA_DIR)
         
-        if not response:
-            print("\nLogin failed. Please check your credentials and try again.")
-            return
-    
-    # After successful registration or login, continue with room operations
-    print("\nLogin successful!")
-    print(f"User ID: {response.get('user_id')}")
-    print(f"Access Token: {response.get('access_token')[:20]}...")  # Only show first 20 chars of token
+        if action == "1":
+            # Registration flow
+            # WARNING: AN HOMESERVER IS NEEDED THAT DOES NOT REQUIRE EMAIL VERIFICATION OR PHONE NUMBER VERIFICATION
+            # TODO a resgistration function that allows for email and phone number verification.
+            username = input("Enter desired username (without @ and homeserver): ")
+            password = input("Enter desired password: ")
+            display_name = input("Enter display name (optional, press Enter to skip): ")
+            
+            response = matrix_client.register(username, password, display_name if display_name else None)
+            
+            if response:
+                print("\nRegistration successful!")
+                print(f"User ID: {response.get('user_id')}")
+                print(f"Access Token: {response.get('access_token')[:20]}...")  # Only show first 20 chars of token
+            else:
+                print("\nRegistration failed. Please try again.")
+                return
+        else:
+            # Login flow
+            username = input("Enter your Matrix username (e.g., @user:matrix.org): ")
+            password = input("Enter your password: ")
+            
+            response = matrix_client.login(username, password)
+            
+            if not response:
+                print("\nLogin failed. Please check your credentials and try again.")
+                return
+        
+        # After successful registration or login, continue with room operations
+        print("\nLogin successful!")
+        print(f"User ID: {response.get('user_id')}")
+        print(f"Access Token: {response.get('access_token')[:20]}...")  # Only show first 20 chars of token
+        matrix_client.save_session()
     
     # Example of joining a room
     room_id = input("\nEnter room ID or alias to join (e.g., !room:matrix.org or #room:matrix.org): ")
@@ -693,6 +1428,7 @@ def main():
         
         # Stop listening when done
         matrix_client.stop_listening()
+        matrix_client.save_session()
     
     # Get list of joined rooms
     print("\nFetching list of joined rooms...")
@@ -0,0 +1,188 @@
+import os
+import hashlib
+from collections import OrderedDict
+from typing import Optional
+import threading
+
+# Default byte budgets of the media cache tiers
+DEFAULT_MEMORY_BUDGET = 64 * 1024 * 1024
+DEFAULT_DISK_BUDGET = 512 * 1024 * 1024
+
+
+class MediaCache:
+    def __init__(self, memory_budget: int = DEFAULT_MEMORY_BUDGET, disk_dir: Optional[str] = None,
+                 disk_budget: int = DEFAULT_DISK_BUDGET):
+        """
+        Initialize the two-tier media cache.
+
+        Media is kept in an in-memory LRU bounded by memory_budget bytes, backed by
+        content files in disk_dir named after the hash of their key. The disk tier
+        evicts the least recently used files once it grows past disk_budget bytes.
+        MXC content never changes, so cached entries are never revalidated.
+
+        Args:
+            memory_budget (int): Maximum number of bytes kept in memory
+            disk_dir (Optional[str]): Directory for the disk tier, None for memory only
+            disk_budget (int): Maximum number of bytes kept on disk
+        """
+        self.memory_budget = memory_budget
+        self.disk_dir = disk_dir
+        self.disk_budget = disk_budget
+        self.memory = OrderedDict()  # key -> bytes, least recently used first
+        self.memory_size = 0
+        self.disk_size = None  # Computed on first use
+        self.lock = threading.Lock()
+
+    def __contains__(self, key: str) -> bool:
+        with self.lock:
+            if key in self.memory:
+                return True
+        path = self.get_disk_path(key)
+        return path is not None and os.path.exists(path)
+
+    def get_disk_path(self, key: str) -> Optional[str]:
+        """
+        Get the path of the disk file for a key.
+
+        Args:
+            key (str): The cache key, e.g. an MXC URI
+
+        Returns:
+            Optional[str]: The file path, None if the cache has no disk tier
+        """
+        if not self.disk_dir:
+            return None
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.disk_dir, digest[:2], digest)
+
+    def get(self, key: str) -> Optional[bytes]:
+        """
+        Get cached media.
+
+        Args:
+            key (str): The cache key, e.g. an MXC URI
+
+        Returns:
+            Optional[bytes]: The media data, None if it isn't cached
+        """
+        with self.lock:
+            data = self.memory.get(key)
+            if data is not None:
+                self.memory.move_to_end(key)
+                return data
+
+        path = self.get_disk_path(key)
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+            os.utime(path)  # Mark as recently used for disk eviction
+        except OSError:
+            return None
+
+        self.put_memory(key, data)
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        """
+        Add media to both cache tiers.
+
+        Args:
+            key (str): The cache key, e.g. an MXC URI
+            data (bytes): The media data
+        """
+        self.put_memory(key, data)
+        self.put_disk(key, data)
+
+    def put_memory(self, key: str, data: bytes) -> None:
+        """
+        Add media to the memory tier, evicting the least recently used entries.
+
+        Args:
+            key (str): The cache key
+            data (bytes): The media data
+        """
+        if len(data) > self.memory_budget:
+            return
+        with self.lock:
+            old = self.memory.pop(key, None)
+            if old is not None:
+                self.memory_size -= len(old)
+            self.memory[key] = data
+            self.memory_size += len(data)
+            while self.memory_size > self.memory_budget:
+                _, evicted = self.memory.popitem(last=False)
+                self.memory_size -= len(evicted)
+
+    def put_disk(self, key: str, data: bytes) -> None:
+        """
+        Add media to the disk tier, evicting the least recently used files.
+
+        Args:
+            key (str): The cache key
+            data (bytes): The media data
+        """
+        path = self.get_disk_path(key)
+        if path is None or len(data) > self.disk_budget:
+            return
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            existed = os.path.exists(path)
+            temp_path = f"{path}.tmp"
+            with open(temp_path, 'wb') as file:
+                file.write(data)
+            os.replace(temp_path, path)
+        except OSError as e:
+            print(f"Error writing media cache: {str(e)}")
+            return
+
+        with self.lock:
+            if self.disk_size is None:
+                self.disk_size = sum(size for _, _, size in self.list_disk_files())
+            elif not existed:
+                self.disk_size += len(data)
+            if self.disk_size > self.disk_budget:
+                self.evict_disk()
+
+    def list_disk_files(self):
+        """
+        List the files of the disk tier.
+
+        Returns:
+            list: Tuples of (last use time, path, size) for every cached file
+        """
+        files = []
+        for root, _, names in os.walk(self.disk_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, path, stat.st_size))
+        return files
+
+    def evict_disk(self) -> None:
+        """
+        Remove the least recently used files until the disk tier fits its budget.
+        The caller holds the lock.
+        """
+        files = sorted(self.list_disk_files())
+        self.disk_size = sum(size for _, _, size in files)
+        for _, path, size in files:
+            if self.disk_size <= self.disk_budget:
+                break
+            try:
+                os.remove(path)
+                self.disk_size -= size
+            except OSError:
+                continue
+
+    def clear(self) -> None:
+        """
+        Empty the memory tier.
+        """
+        with self.lock:
+            self.memory.clear()
+            self.memory_size = 0
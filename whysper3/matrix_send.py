@@ -0,0 +1,169 @@
+import requests
+from typing import Dict, Optional
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import itertools
+import threading
+import time
+import uuid
+
+
+class SendQueue:
+    def __init__(self, matrix_client, max_in_flight: int = 4, max_retries: int = 5):
+        """
+        Initialize the outbound event queue of a Matrix client.
+
+        Events are sent in order per room, while up to max_in_flight rooms send
+        at the same time. Every event gets a unique transaction ID when it is
+        queued and keeps it across retries, so the homeserver deduplicates a
+        retried request instead of sending the event twice.
+
+        Args:
+            matrix_client (MatrixLogin): The logged in client to send with
+            max_in_flight (int): Maximum number of requests in flight at once
+            max_retries (int): Number of times a request failing with a server or network error
+                is retried, rate limited requests are retried until the server accepts them
+        """
+        self.matrix_client = matrix_client
+        self.max_retries = max_retries
+        self.executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        self.lock = threading.Lock()
+        self.rooms = {}  # room_id -> deque of (txn_id, event_type, content, future)
+        self.txn_prefix = uuid.uuid4().hex[:12]
+        self.txn_counter = itertools.count(1)
+        self.retry_at = 0.0  # Rate limits apply to the whole account
+
+    def next_txn_id(self) -> str:
+        """
+        Create a new transaction ID.
+
+        Returns:
+            str: A transaction ID unique to this queue
+        """
+        with self.lock:
+            return f"{self.txn_prefix}.{next(self.txn_counter)}"
+
+    def send(self, room_id: str, event_type: str, content: Dict, txn_id: Optional[str] = None) -> Future:
+        """
+        Queue an event to be sent to a room.
+
+        Args:
+            room_id (str): The room ID to send the event to
+            event_type (str): The event type (e.g., 'm.room.message')
+            content (Dict): The event content
+            txn_id (Optional[str]): The transaction ID to use, None to create one
+
+        Returns:
+            Future: Resolves to the send response, or None if sending failed.
+                The transaction ID is available as its txn_id attribute.
+        """
+        future = Future()
+        future.txn_id = txn_id or self.next_txn_id()
+
+        with self.lock:
+            pending = self.rooms.get(room_id)
+            start = pending is None
+            if start:
+                pending = self.rooms[room_id] = deque()
+            pending.append((future.txn_id, event_type, content, future))
+
+        if start:
+            self.executor.submit(self.drain, room_id)
+        return future
+
+    def drain(self, room_id: str) -> None:
+        """
+        Send the queued events of a room one after another until none are left.
+
+        Args:
+            room_id (str): The room ID
+        """
+        while True:
+            with self.lock:
+                pending = self.rooms[room_id]
+                if not pending:
+                    del self.rooms[room_id]
+                    return
+                txn_id, event_type, content, future = pending.popleft()
+
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(self.send_with_retries(room_id, event_type, content, txn_id))
+            except Exception as e:
+                future.set_exception(e)
+
+    def send_with_retries(self, room_id: str, event_type: str, content: Dict, txn_id: str) -> Optional[Dict]:
+        """
+        Send an event, retrying with the same transaction ID when rate limited or failing.
+
+        Args:
+            room_id (str): The room ID
+            event_type (str): The event type
+            content (Dict): The event content
+            txn_id (str): The transaction ID
+
+        Returns:
+            Optional[Dict]: The send response if successful, None if failed
+        """
+        client = self.matrix_client
+        encoded_room = requests.utils.quote(room_id)
+        encoded_type = requests.utils.quote(event_type)
+        encoded_txn = requests.utils.quote(txn_id)
+        send_url = (f"{client.homeserver_url}/_matrix/client/r0/rooms/{encoded_room}"
+                    f"/send/{encoded_type}/{encoded_txn}")
+
+        headers = {
+            "Authorization": f"Bearer {client.access_token}",
+            "Content-Type": "application/json"
+        }
+
+        attempt = 0  # Failed attempts, rate limits don't count
+        rate_limits = 0
+        while True:
+            # Wait out a rate limit seen by any room
+            delay = self.retry_at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            try:
+                response = client.session.put(send_url, json=content, headers=headers)
+
+                if response.status_code == 200:
+                    return response.json()
+                elif response.status_code == 429:
+                    # The server asked to retry later, so this doesn't use up the retries
+                    try:
+                        retry_after_ms = response.json().get("retry_after_ms")
+                    except ValueError:
+                        retry_after_ms = None
+                    backoff = retry_after_ms / 1000 if retry_after_ms is not None else min(2 ** rate_limits, 30)
+                    rate_limits += 1
+                    with self.lock:
+                        self.retry_at = max(self.retry_at, time.monotonic() + backoff)
+                    print(f"Rate limited sending to {room_id}, retrying in {backoff:.1f}s")
+                    continue
+                elif response.status_code < 500:
+                    print(f"Failed to send event with status code: {response.status_code}")
+                    print(f"Response: {response.text}")
+                    return None
+                else:
+                    print(f"Server error sending event with status code: {response.status_code}")
+
+            except requests.exceptions.RequestException as e:
+                print(f"Error sending event: {str(e)}")
+
+            if attempt >= self.max_retries:
+                print(f"Giving up sending event {txn_id} to {room_id}")
+                return None
+            time.sleep(min(2 ** attempt, 30))
+            attempt += 1
+
+    def shutdown(self, wait: bool = True) -> None:
+        """
+        Stop the queue's workers.
+
+        Args:
+            wait (bool): Whether to wait for the queued events to be sent
+        """
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,379 @@
+import sqlite3
+from typing import Dict, List, Optional, Tuple
+import threading
+from matrix_json import JsonCodec, get_codec
+
+# Orderings left free below the events after a gap in sync, for the missing
+# events to be filled into as history is paged through
+GAP_ORDERINGS = 1 << 32
+
+
+class EventStore:
+    def __init__(self, path: str = ":memory:", codec: Optional[JsonCodec] = None):
+        """
+        Initialize the local event store.
+
+        Events are kept per room as one contiguous span of the timeline, ordered
+        by a local ordering number: events from sync are appended after the
+        newest stored event and events from history pagination are prepended
+        before the oldest one. The backfill token of a room is the pagination
+        token to continue fetching from below the oldest stored event.
+
+        A limited sync timeline leaves out events between the stored ones and
+        the new ones. The stored events are kept and the new ones are appended
+        GAP_ORDERINGS further up, with a gap recorded below the first of them.
+        The gap holds the token to page back into the missing events from, and
+        is filled from the top down until it reaches the stored events again.
+
+        Args:
+            path (str): Path of the SQLite database file, ':memory:' for a temporary store
+            codec (Optional[JsonCodec]): Codec the events are stored with, None for the fastest one installed
+        """
+        self.path = path
+        self.codec = codec or get_codec()
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS events (
+                event_id TEXT PRIMARY KEY,
+                room_id TEXT NOT NULL,
+                ordering INTEGER NOT NULL,
+                origin_server_ts INTEGER,
+                type TEXT,
+                sender TEXT,
+                json TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS events_room_ordering ON events (room_id, ordering);
+            CREATE INDEX IF NOT EXISTS events_room_ts ON events (room_id, origin_server_ts);
+            CREATE TABLE IF NOT EXISTS rooms (
+                room_id TEXT PRIMARY KEY,
+                min_ordering INTEGER NOT NULL,
+                max_ordering INTEGER NOT NULL,
+                backfill_token TEXT,
+                complete INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS gaps (
+                room_id TEXT NOT NULL,
+                ordering INTEGER NOT NULL,
+                token TEXT NOT NULL,
+                PRIMARY KEY (room_id, ordering)
+            );
+        """)
+        self.connection.commit()
+
+    def close(self) -> None:
+        """
+        Close the database connection.
+        """
+        with self.lock:
+            self.connection.close()
+
+    def get_room(self, room_id: str) -> Optional[Tuple[int, int, Optional[str], bool]]:
+        """
+        Get the stored span of a room.
+
+        Args:
+            room_id (str): The room ID
+
+        Returns:
+            Optional[Tuple[int, int, Optional[str], bool]]: The minimum and maximum ordering,
+                the backfill token and whether the start of the room is reached, None if unknown
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT min_ordering, max_ordering, backfill_token, complete FROM rooms WHERE room_id = ?",
+                (room_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1], row[2], bool(row[3])
+
+    def add_timeline(self, room_id: str, events: List[Dict], prev_batch: Optional[str] = None,
+                     limited: bool = False) -> None:
+        """
+        Append events received through sync to the room's span.
+
+        A limited timeline means there is a gap between the stored events and the
+        new ones. The stored events are kept and the gap is recorded with
+        prev_batch as the token to fill it from.
+
+        Args:
+            room_id (str): The room ID
+            events (List[Dict]): The timeline events, oldest first
+            prev_batch (Optional[str]): Token to paginate back from the first event
+            limited (bool): Whether the server left out events before this timeline
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT max_ordering FROM rooms WHERE room_id = ?", (room_id,)
+            ).fetchone()
+
+            # No gap if the timeline starts with an event that is stored already
+            gap = row is not None and limited and bool(events) and prev_batch is not None and \
+                self.connection.execute(
+                    "SELECT 1 FROM events WHERE event_id = ?", (events[0].get("event_id"),)
+                ).fetchone() is None
+
+            if row is None:
+                if not events:
+                    return
+                self.connection.execute(
+                    "INSERT INTO rooms (room_id, min_ordering, max_ordering, backfill_token) VALUES (?, 1, 0, ?)",
+                    (room_id, prev_batch)
+                )
+                ordering = 0
+            else:
+                ordering = row[0]
+
+            if gap:
+                ordering += GAP_ORDERINGS - 1
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO gaps (room_id, ordering, token) VALUES (?, ?, ?)",
+                    (room_id, ordering + 1, prev_batch)
+                )
+
+            for event in events:
+                ordering += 1
+                if not self.insert_event(room_id, ordering, event):
+                    ordering -= 1
+
+            self.connection.execute(
+                "UPDATE rooms SET max_ordering = ? WHERE room_id = ?", (ordering, room_id)
+            )
+            self.connection.commit()
+
+    def add_history(self, room_id: str, events: List[Dict], end_token: Optional[str]) -> None:
+        """
+        Prepend events received through history pagination to the room's span.
+
+        Args:
+            room_id (str): The room ID
+            events (List[Dict]): The events, newest first as returned by /messages
+            end_token (Optional[str]): Token to continue paginating back from, None at the start of the room
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT min_ordering FROM rooms WHERE room_id = ?", (room_id,)
+            ).fetchone()
+
+            if row is None:
+                self.connection.execute(
+                    "INSERT INTO rooms (room_id, min_ordering, max_ordering) VALUES (?, 1, 0)",
+                    (room_id,)
+                )
+                ordering = 1
+            else:
+                ordering = row[0]
+
+            for event in events:
+                ordering -= 1
+                if not self.insert_event(room_id, ordering, event):
+                    ordering += 1
+
+            self.connection.execute(
+                "UPDATE rooms SET min_ordering = ?, backfill_token = ?, complete = ? WHERE room_id = ?",
+                (ordering, end_token, int(not events or end_token is None), room_id)
+            )
+            self.connection.commit()
+
+    def insert_event(self, room_id: str, ordering: int, event: Dict) -> bool:
+        """
+        Insert a single event. The caller holds the lock and commits.
+
+        Args:
+            room_id (str): The room ID
+            ordering (int): The event's position in the room's span
+            event (Dict): The event
+
+        Returns:
+            bool: True if the event was inserted, False if it was already stored
+        """
+        event_id = event.get("event_id")
+        if not event_id:
+            return False
+        cursor = self.connection.execute(
+            "INSERT OR IGNORE INTO events (event_id, room_id, ordering, origin_server_ts, type, sender, json) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (event_id, room_id, ordering, event.get("origin_server_ts"), event.get("type"),
+             event.get("sender"), self.codec.dumps(event))
+        )
+        return cursor.rowcount == 1
+
+    def fill_gap(self, room_id: str, ordering: int, events: List[Dict], end_token: Optional[str]) -> List[Dict]:
+        """
+        Insert events paged back from a gap's token into the gap.
+
+        The gap moves down below the inserted events, or is closed once the
+        events reach ones stored below it or the start of the room.
+
+        Args:
+            room_id (str): The room ID
+            ordering (int): The ordering of the gap, as returned by get_gap
+            events (List[Dict]): The events, newest first as returned by /messages
+            end_token (Optional[str]): Token to continue paginating back from, None at the start of the room
+
+        Returns:
+            List[Dict]: The events that were missing and are stored now, newest first
+        """
+        with self.lock:
+            inserted = []
+            closed = not events or end_token is None
+            for event in events:
+                if not event.get("event_id"):
+                    continue
+                if not self.insert_event(room_id, ordering - len(inserted) - 1, event):
+                    # Reached the events stored below the gap
+                    closed = True
+                    break
+                inserted.append(event)
+
+            self.connection.execute("DELETE FROM gaps WHERE room_id = ? AND ordering = ?", (room_id, ordering))
+            if not closed:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO gaps (room_id, ordering, token) VALUES (?, ?, ?)",
+                    (room_id, ordering - len(inserted), end_token)
+                )
+            self.connection.commit()
+        return inserted
+
+    def get_gap(self, room_id: str, before: Optional[int] = None) -> Optional[Tuple[int, str]]:
+        """
+        Get the nearest gap below a position in a room's span.
+
+        Args:
+            room_id (str): The room ID
+            before (Optional[int]): The position, None for the newest end of the span
+
+        Returns:
+            Optional[Tuple[int, str]]: The ordering of the event just above the gap and the
+                token to fill it from, None if the span has no gap there
+        """
+        with self.lock:
+            return self.find_gap(room_id, before)
+
+    def find_gap(self, room_id: str, before: Optional[int]) -> Optional[Tuple[int, str]]:
+        """
+        Find the nearest gap below a position. The caller holds the lock.
+
+        Args:
+            room_id (str): The room ID
+            before (Optional[int]): The position, None for the newest end of the span
+
+        Returns:
+            Optional[Tuple[int, str]]: The gap's ordering and token, None if there is none
+        """
+        if before is None:
+            row = self.connection.execute(
+                "SELECT ordering, token FROM gaps WHERE room_id = ? ORDER BY ordering DESC LIMIT 1",
+                (room_id,)
+            ).fetchone()
+        else:
+            row = self.connection.execute(
+                "SELECT ordering, token FROM gaps WHERE room_id = ? AND ordering <= ? "
+                "ORDER BY ordering DESC LIMIT 1",
+                (room_id, before)
+            ).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def has_gap_after(self, room_id: str, after: int) -> bool:
+        """
+        Check whether events are missing somewhere above a position in a room's span.
+
+        Args:
+            room_id (str): The room ID
+            after (int): The position
+
+        Returns:
+            bool: True if there is a gap above the position
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT 1 FROM gaps WHERE room_id = ? AND ordering > ? LIMIT 1", (room_id, after)
+            ).fetchone()
+        return row is not None
+
+    def get_events(self, room_id: str, limit: int, before: Optional[int] = None) -> List[Tuple[int, Dict]]:
+        """
+        Get stored events of a room, newest first.
+
+        Only the events down to the nearest gap are returned, the events below
+        it aren't contiguous with them.
+
+        Args:
+            room_id (str): The room ID
+            limit (int): Maximum number of events to return
+            before (Optional[int]): Only return events older than this ordering
+
+        Returns:
+            List[Tuple[int, Dict]]: The ordering and event of each stored event
+        """
+        with self.lock:
+            gap = self.find_gap(room_id, before)
+            lowest = gap[0] if gap else None
+            if before is None:
+                rows = self.connection.execute(
+                    "SELECT ordering, json FROM events WHERE room_id = ? AND ordering >= COALESCE(?, ordering) "
+                    "ORDER BY ordering DESC LIMIT ?",
+                    (room_id, lowest, limit)
+                ).fetchall()
+            else:
+                rows = self.connection.execute(
+                    "SELECT ordering, json FROM events WHERE room_id = ? AND ordering < ? "
+                    "AND ordering >= COALESCE(?, ordering) ORDER BY ordering DESC LIMIT ?",
+                    (room_id, before, lowest, limit)
+                ).fetchall()
+        return [(ordering, self.codec.loads(data)) for ordering, data in rows]
+
+    def get_events_after(self, room_id: str, after: int, limit: int) -> List[Tuple[int, Dict]]:
+        """
+        Get stored events of a room newer than an ordering, oldest first.
+        
+        Args:
+            room_id (str): The room ID
+            after (int): Only return events newer than this ordering
+            limit (int): Maximum number of events to return
+            
+        Returns:
+            List[Tuple[int, Dict]]: The ordering and event of each stored event
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT ordering, json FROM events WHERE room_id = ? AND ordering > ? "
+                "ORDER BY ordering ASC LIMIT ?",
+                (room_id, after, limit)
+            ).fetchall()
+        return [(ordering, self.codec.loads(data)) for ordering, data in rows]
+
+    def get_ordering(self, event_id: str) -> Optional[int]:
+        """
+        Get the position of a stored event in its room's span.
+        
+        Args:
+            event_id (str): The event ID
+            
+        Returns:
+            Optional[int]: The event's ordering, None if it isn't stored
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT ordering FROM events WHERE event_id = ?", (event_id,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def get_event(self, event_id: str) -> Optional[Dict]:
+        """
+        Get a stored event by its ID.
+
+        Args:
+            event_id (str): The event ID
+
+        Returns:
+            Optional[Dict]: The event, None if it isn't stored
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT json FROM events WHERE event_id = ?", (event_id,)
+            ).fetchone()
+        return self.codec.loads(row[0]) if row else None
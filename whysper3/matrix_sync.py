@@ -0,0 +1,356 @@
+import requests
+from typing import Dict, Optional, Callable
+from collections import deque
+import threading
+from matrix_event import Event
+
+# Default /sync filter. The client only renders m.room.message events, so
+# presence, account data, typing notifications and receipts are dropped and
+# room state is limited to lazily loaded members of the timeline senders.
+DEFAULT_SYNC_FILTER = {
+    "presence": {
+        "types": []
+    },
+    "account_data": {
+        "types": []
+    },
+    "room": {
+        "timeline": {
+            "limit": 10,
+            "types": ["m.room.message"]
+        },
+        "state": {
+            "types": ["m.room.member"],
+            "lazy_load_members": True
+        },
+        "ephemeral": {
+            "types": []
+        },
+        "account_data": {
+            "types": []
+        }
+    }
+}
+
+# Default number of messages the client's message queue holds
+DEFAULT_MESSAGE_QUEUE_SIZE = 1000
+
+# What the message queue does with a message when it is full
+OVERFLOW_BLOCK = "block"  # Wait for room, holding up the sync loop
+OVERFLOW_DROP_OLDEST = "drop_oldest"  # Drop the oldest queued message
+OVERFLOW_DROP_NEWEST = "drop_newest"  # Drop the new message
+
+# Seconds a blocked put waits at a time before checking whether it should give up
+BLOCK_POLL_INTERVAL = 0.5
+
+
+class MessageQueue:
+    def __init__(self, maxsize: int = DEFAULT_MESSAGE_QUEUE_SIZE, overflow: str = OVERFLOW_DROP_OLDEST):
+        """
+        Initialize a bounded queue of received messages.
+
+        The queue holds at most maxsize messages, and the overflow policy
+        decides what happens to a message that arrives while it is full. The
+        number of dropped messages and the largest number of messages queued at
+        once are counted, so a consumer can tell whether it keeps up.
+
+        Args:
+            maxsize (int): Maximum number of queued messages
+            overflow (str): OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST or OVERFLOW_DROP_NEWEST
+        """
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1")
+        if overflow not in (OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST):
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.messages = deque()
+        self.condition = threading.Condition()
+        self.dropped = 0
+        self.high_water = 0
+        self.closed = False
+
+    def __len__(self) -> int:
+        with self.condition:
+            return len(self.messages)
+
+    def put(self, message: Dict, cancel: Optional[threading.Event] = None) -> bool:
+        """
+        Add a message, applying the overflow policy if the queue is full.
+
+        Args:
+            message (Dict): The message
+            cancel (Optional[threading.Event]): Makes a blocked put give up and drop the message when set
+
+        Returns:
+            bool: True if the message was queued, False if it was dropped
+        """
+        with self.condition:
+            if self.closed:
+                return False
+            if len(self.messages) >= self.maxsize:
+                if self.overflow == OVERFLOW_DROP_NEWEST:
+                    self.dropped += 1
+                    return False
+                elif self.overflow == OVERFLOW_DROP_OLDEST:
+                    self.messages.popleft()
+                    self.dropped += 1
+                else:
+                    while len(self.messages) >= self.maxsize and not self.closed:
+                        if cancel is not None and cancel.is_set():
+                            self.dropped += 1
+                            return False
+                        self.condition.wait(BLOCK_POLL_INTERVAL)
+                    if self.closed:
+                        return False
+
+            self.messages.append(message)
+            self.high_water = max(self.high_water, len(self.messages))
+            self.condition.notify_all()
+            return True
+
+    def get(self, timeout: Optional[float] = None) -> Optional[Dict]:
+        """
+        Take the oldest message, waiting for one if the queue is empty.
+
+        Args:
+            timeout (Optional[float]): Timeout in seconds, None to wait until a message arrives
+
+        Returns:
+            Optional[Dict]: The message, None if the timeout passed
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.messages, timeout):
+                return None
+            message = self.messages.popleft()
+            self.condition.notify_all()
+            return message
+
+    def close(self) -> None:
+        """
+        Release the queued messages and stop accepting new ones, waking up a blocked put.
+        """
+        with self.condition:
+            self.closed = True
+            self.messages.clear()
+            self.condition.notify_all()
+
+    def stats(self) -> Dict:
+        """
+        Get the queue's counters.
+
+        Returns:
+            Dict: The number of queued messages, the number of dropped messages and the high-water mark
+        """
+        with self.condition:
+            return {
+                "size": len(self.messages),
+                "dropped": self.dropped,
+                "high_water": self.high_water
+            }
+
+
+class SyncEngine:
+    def __init__(self, matrix_client):
+        """
+        Initialize the sync engine for a Matrix client.
+
+        The engine owns the single /sync long-poll loop and the next_batch token
+        for its client, and dispatches received events to per-room subscribers.
+        Subscribing or unsubscribing only touches local state, so the number of
+        rooms being watched never changes the amount of sync traffic.
+
+        Args:
+            matrix_client (MatrixLogin): The logged in client to sync for
+        """
+        self.matrix_client = matrix_client
+        self.next_batch = None
+        self.synced = False  # True once a sync response of this session was dispatched
+        self.stop_event = threading.Event()
+        self.subscribers = {}  # room_id -> list of callbacks
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def subscribe(self, room_id: str, callback: Callable[[Dict], None]) -> None:
+        """
+        Subscribe a callback to the messages of a room.
+
+        Args:
+            room_id (str): The room ID to receive messages for
+            callback (Callable[[Dict], None]): Called with each received message
+        """
+        with self.lock:
+            callbacks = self.subscribers.setdefault(room_id, [])
+            if callback not in callbacks:
+                callbacks.append(callback)
+
+    def unsubscribe(self, room_id: str, callback: Optional[Callable[[Dict], None]] = None) -> None:
+        """
+        Remove a subscription from a room.
+
+        Args:
+            room_id (str): The room ID to stop receiving messages for
+            callback (Optional[Callable[[Dict], None]]): The callback to remove, None to remove all
+        """
+        with self.lock:
+            callbacks = self.subscribers.get(room_id)
+            if callbacks is None:
+                return
+            if callback is None:
+                callbacks.clear()
+            elif callback in callbacks:
+                callbacks.remove(callback)
+            if not callbacks:
+                del self.subscribers[room_id]
+
+    def is_running(self) -> bool:
+        """
+        Check whether the sync loop is running.
+
+        Returns:
+            bool: True if the sync thread is alive
+        """
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self) -> None:
+        """
+        Start the sync loop if it is not already running.
+
+        A loop that was stopped but is still waiting for its long-poll to
+        return doesn't count as running. A new loop is started next to it and
+        the old one exits without dispatching when its request returns.
+        """
+        if self.is_running() and not self.stop_event.is_set():
+            return
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(self.stop_event,), daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        """
+        Stop the sync loop. The current long-poll is abandoned when it returns.
+        """
+        self.stop_event.set()
+
+    def run(self, stop_event: threading.Event) -> None:
+        """
+        Run the sync loop until the stop event is set.
+
+        Args:
+            stop_event (threading.Event): Event that ends the loop when set
+        """
+        while not stop_event.is_set():
+            try:
+                self.sync_once(stop_event=stop_event)
+            except requests.exceptions.RequestException as e:
+                print(f"Error during sync: {str(e)}")
+                stop_event.wait(5)  # Wait before retrying
+            except Exception as e:
+                print(f"Unexpected error: {str(e)}")
+                stop_event.wait(5)  # Wait before retrying
+
+    def sync_once(self, timeout: int = 30000, stop_event: Optional[threading.Event] = None) -> Optional[Dict]:
+        """
+        Perform a single /sync request, dispatch the response and advance next_batch.
+
+        next_batch is only advanced and saved once the response is stored and
+        dispatched. A response that arrives after the loop was stopped is
+        dropped without advancing, so a crash or a stop never skips events:
+        the same batch is fetched again on the next start.
+
+        Args:
+            timeout (int): Long-poll timeout in milliseconds
+            stop_event (Optional[threading.Event]): Stop event of the loop making the request,
+                None for the engine's current one
+
+        Returns:
+            Optional[Dict]: The sync response if it was dispatched, None if failed or stopped
+        """
+        if stop_event is None:
+            stop_event = self.stop_event
+        client = self.matrix_client
+        sync_url = f"{client.homeserver_url}/_matrix/client/r0/sync"
+        params = {
+            "access_token": client.access_token,
+            "timeout": timeout,
+            "filter": client.get_sync_filter()
+        }
+
+        if self.next_batch:
+            params["since"] = self.next_batch
+
+        response = client.session.get(sync_url, params=params)
+
+        if response.status_code == 200:
+            data = client.decode_response(response)
+            if stop_event.is_set():
+                # Stopped during the long-poll, the batch is fetched again from the old token
+                return None
+            self.update_joined_rooms(data)
+            self.dispatch(data)
+            self.synced = True
+            self.next_batch = data.get("next_batch", self.next_batch)
+            client.save_session()
+            return data
+        elif response.status_code == 401:
+            # The access token was revoked or has expired, a resumed session can't continue
+            print("Sync failed: access token rejected. Please login again.")
+            client.clear_session()
+            stop_event.set()
+            if client.on_session_expired:
+                client.on_session_expired()
+            return None
+        else:
+            print(f"Sync failed with status code: {response.status_code}")
+            print(f"Response: {response.text}")
+            stop_event.wait(5)  # Wait before retrying
+            return None
+
+    def update_joined_rooms(self, data: Dict) -> None:
+        """
+        Update the client's joined room list from a sync response.
+
+        Args:
+            data (Dict): The sync response
+        """
+        rooms = data.get("rooms", {})
+        joined_rooms = self.matrix_client.joined_rooms
+        for room_id in rooms.get("join", {}):
+            if room_id not in joined_rooms:
+                joined_rooms.append(room_id)
+        for room_id in rooms.get("leave", {}):
+            if room_id in joined_rooms:
+                joined_rooms.remove(room_id)
+
+    def dispatch(self, data: Dict) -> None:
+        """
+        Store the timeline events of a sync response and dispatch its messages
+        to the room subscribers.
+
+        Args:
+            data (Dict): The sync response
+        """
+        store = self.matrix_client.get_event_store()
+
+        for room_id, room_data in data.get("rooms", {}).get("join", {}).items():
+            with self.lock:
+                callbacks = list(self.subscribers.get(room_id, ()))
+
+            timeline = room_data.get("timeline", {})
+            store.add_timeline(room_id, timeline.get("events", []), timeline.get("prev_batch"),
+                               timeline.get("limited", False))
+
+            for event in timeline.get("events", []):
+                if event.get("type") == "m.room.message":
+                    message = Event.from_wire(event, room_id)
+
+                    # Only queued for clients that consume the queue
+                    message_queue = self.matrix_client.message_queue
+                    if message_queue is not None:
+                        message_queue.put(message, self.stop_event)
+
+                    for callback in callbacks:
+                        try:
+                            callback(message)
+                        except Exception as e:
+                            print(f"Error in message callback: {str(e)}")
@@ -0,0 +1,548 @@
+from PyQt5.QtWidgets import QTreeView, QStyledItemDelegate, QAbstractItemView, QStyle
+from PyQt5.QtCore import Qt, QAbstractListModel, QModelIndex, QRect, QSize, QTimer
+from PyQt5.QtGui import QColor, QFont, QFontMetrics
+from collections import OrderedDict
+from matrix_event import as_event
+
+# Data role returning the Event of a row
+MessageRole = Qt.UserRole + 1
+
+# Space in pixels around each message
+MESSAGE_PADDING = 6
+
+# Size in pixels image previews are scaled to fit
+PREVIEW_SIZE = 300
+
+# Default byte budget of the rendered image cache
+DEFAULT_PIXMAP_BUDGET = 32 * 1024 * 1024
+
+# Send states of local echoes, kept in the send_status of the event
+SEND_PENDING = "sending"
+SEND_FAILED = "failed"
+
+
+class PixmapCache:
+    def __init__(self, budget=DEFAULT_PIXMAP_BUDGET):
+        """
+        Initialize the cache of rendered images.
+
+        Pixmaps are keyed by the image URI and the size they were rendered at,
+        so every message showing the same image shares one pixmap. The least
+        recently used pixmaps are dropped once their pixel data grows past
+        budget bytes. Pixmaps belong to the GUI thread, so the cache isn't
+        locked.
+
+        Args:
+            budget (int): Maximum number of bytes of pixel data kept
+        """
+        self.budget = budget
+        self.pixmaps = OrderedDict()  # (URI, size) -> QPixmap, least recently used first
+        self.size = 0
+
+    def cost(self, pixmap):
+        """
+        Get the number of bytes of pixel data of a pixmap.
+
+        Args:
+            pixmap (QPixmap): The pixmap
+
+        Returns:
+            int: The size of its pixel data
+        """
+        return pixmap.width() * pixmap.height() * pixmap.depth() // 8
+
+    def get(self, uri, size):
+        """
+        Get a rendered image.
+
+        Args:
+            uri (str): The image URI, e.g. an MXC URI
+            size (int): The size the image was rendered at
+
+        Returns:
+            QPixmap: The pixmap, None if it isn't cached
+        """
+        pixmap = self.pixmaps.get((uri, size))
+        if pixmap is not None:
+            self.pixmaps.move_to_end((uri, size))
+        return pixmap
+
+    def put(self, uri, size, pixmap):
+        """
+        Add a rendered image, evicting the least recently used ones.
+
+        Args:
+            uri (str): The image URI, e.g. an MXC URI
+            size (int): The size the image was rendered at
+            pixmap (QPixmap): The pixmap
+        """
+        cost = self.cost(pixmap)
+        if cost > self.budget:
+            return
+        old = self.pixmaps.pop((uri, size), None)
+        if old is not None:
+            self.size -= self.cost(old)
+        self.pixmaps[(uri, size)] = pixmap
+        self.size += cost
+        while self.size > self.budget:
+            _, evicted = self.pixmaps.popitem(last=False)
+            self.size -= self.cost(evicted)
+
+    def clear(self):
+        """
+        Remove all pixmaps.
+        """
+        self.pixmaps.clear()
+        self.size = 0
+
+
+class TimelineModel(QAbstractListModel):
+    def __init__(self, parent=None):
+        """
+        Initialize the timeline model of a room.
+
+        Rows are kept in two lists so both appending newer messages and
+        prepending older ones is O(1) whatever the length of the history:
+        'older' holds prepended messages newest first, 'newer' holds the rest
+        oldest first. Every message gets a sequence number that stays valid
+        while rows are prepended, which maps media back to its row. Removing
+        rows renumbers the remaining ones, so rows are removed a batch at a time.
+        Messages carrying a transaction ID, like the local echo of a message
+        being sent, are indexed by it so the event coming back from the server
+        can take over their row. Rows are kept as Event objects, messages
+        added as dicts are converted.
+
+        Args:
+            parent (QObject): The parent object
+        """
+        super().__init__(parent)
+        self.older = []
+        self.newer = []
+        self.media_rows = {}  # MXC URI -> sequence numbers of the rows showing it
+        self.event_ids = set()
+        self.transactions = {}  # transaction ID -> sequence number of its row
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.older) + len(self.newer)
+
+    def message(self, row):
+        """
+        Get the message of a row.
+
+        Args:
+            row (int): The row
+
+        Returns:
+            Event: The message
+        """
+        if row < len(self.older):
+            return self.older[-1 - row]
+        return self.newer[row - len(self.older)]
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        message = self.message(index.row())
+        if role == MessageRole:
+            return message
+        if role == Qt.DisplayRole:
+            return f"{message.sender}: {message.body or ''}"
+        return None
+
+    def append_messages(self, messages):
+        """
+        Add messages after the newest row.
+
+        Args:
+            messages (list): The messages, oldest first
+        """
+        if not messages:
+            return
+        first = self.rowCount()
+        self.beginInsertRows(QModelIndex(), first, first + len(messages) - 1)
+        for message in messages:
+            message = as_event(message)
+            self.track_message(message, len(self.newer))
+            self.newer.append(message)
+        self.endInsertRows()
+
+    def prepend_messages(self, messages):
+        """
+        Add messages before the oldest row.
+
+        Args:
+            messages (list): The messages, newest first
+        """
+        if not messages:
+            return
+        self.beginInsertRows(QModelIndex(), 0, len(messages) - 1)
+        for message in messages:
+            message = as_event(message)
+            self.older.append(message)
+            self.track_message(message, -len(self.older))
+        self.endInsertRows()
+
+    def clear(self):
+        """
+        Remove all rows.
+        """
+        self.beginResetModel()
+        self.older = []
+        self.newer = []
+        self.media_rows = {}
+        self.event_ids = set()
+        self.transactions = {}
+        self.endResetModel()
+
+    def remove_oldest(self, count):
+        """
+        Remove rows from the top.
+
+        Args:
+            count (int): Number of rows to remove
+        """
+        count = min(count, self.rowCount())
+        if count <= 0:
+            return
+        self.beginRemoveRows(QModelIndex(), 0, count - 1)
+        self.set_rows([self.message(row) for row in range(count, self.rowCount())])
+        self.endRemoveRows()
+
+    def remove_newest(self, count):
+        """
+        Remove rows from the bottom.
+
+        Args:
+            count (int): Number of rows to remove
+        """
+        count = min(count, self.rowCount())
+        if count <= 0:
+            return
+        rows = self.rowCount()
+        self.beginRemoveRows(QModelIndex(), rows - count, rows - 1)
+        self.set_rows([self.message(row) for row in range(rows - count)])
+        self.endRemoveRows()
+
+    def set_rows(self, messages):
+        """
+        Replace the stored rows and renumber them. The caller notifies the view.
+
+        Args:
+            messages (list): The messages, oldest first
+        """
+        self.older = []
+        self.newer = []
+        self.media_rows = {}
+        self.event_ids = set()
+        self.transactions = {}
+        for message in messages:
+            self.track_message(message, len(self.newer))
+            self.newer.append(message)
+
+    def has_event(self, event_id):
+        """
+        Check whether a row shows an event.
+
+        Args:
+            event_id (str): The event ID
+
+        Returns:
+            bool: True if the event is in the timeline
+        """
+        return event_id is not None and event_id in self.event_ids
+
+    def track_message(self, message, sequence):
+        """
+        Remember which row shows a message's event and media.
+
+        Args:
+            message (Event): The message
+            sequence (int): The message's sequence number
+        """
+        if message.event_id:
+            self.event_ids.add(message.event_id)
+        if message.txn_id:
+            self.transactions[message.txn_id] = sequence
+        mxc_uri = message.url
+        if mxc_uri:
+            sequences = self.media_rows.setdefault(mxc_uri, [])
+            if sequence not in sequences:
+                sequences.append(sequence)
+
+    def transaction_row(self, txn_id):
+        """
+        Find the row of the message sent with a transaction ID.
+
+        Args:
+            txn_id (str): The transaction ID
+
+        Returns:
+            Optional[int]: The row, None if no row has the transaction ID
+        """
+        sequence = self.transactions.get(txn_id) if txn_id else None
+        if sequence is None:
+            return None
+        return sequence + len(self.older)
+
+    def replace_message(self, row, message):
+        """
+        Show another message in a row, e.g. the server's event in place of its local echo.
+
+        Args:
+            row (int): The row
+            message (Union[Event, dict]): The message
+        """
+        message = as_event(message)
+        if row < len(self.older):
+            self.older[-1 - row] = message
+        else:
+            self.newer[row - len(self.older)] = message
+        self.track_message(message, row - len(self.older))
+        index = self.index(row)
+        self.dataChanged.emit(index, index, [MessageRole])
+
+    def media_changed(self, mxc_uri):
+        """
+        Notify the view that the media of some rows finished loading.
+
+        Args:
+            mxc_uri (str): The MXC URI of the media
+        """
+        for sequence in self.media_rows.get(mxc_uri, ()):
+            index = self.index(sequence + len(self.older))
+            self.dataChanged.emit(index, index, [MessageRole])
+
+
+class MessageDelegate(QStyledItemDelegate):
+    def __init__(self, format_timestamp, pixmap_cache, request_preview, parent=None, failed_previews=()):
+        """
+        Initialize the delegate painting timeline messages.
+
+        Args:
+            format_timestamp (Callable[[int], str]): Formats a message timestamp
+            pixmap_cache (PixmapCache): The cache previews are looked up in
+            request_preview (Callable[[str], None]): Called with the URI of a
+                painted image whose preview isn't cached
+            parent (QObject): The parent object
+            failed_previews (Container[str]): URIs of the images whose preview failed to load,
+                these are shown as text instead
+        """
+        super().__init__(parent)
+        self.format_timestamp = format_timestamp
+        self.pixmap_cache = pixmap_cache
+        self.request_preview = request_preview
+        self.failed_previews = failed_previews
+
+    def shows_preview(self, message):
+        """
+        Check whether a message is shown as an image preview rather than as text.
+
+        Args:
+            message (Event): The message
+
+        Returns:
+            bool: True for images, unless their preview failed to load
+        """
+        return message.msgtype == "m.image" and bool(message.url) and message.url not in self.failed_previews
+
+    def layout(self, option, message):
+        """
+        Work out the header and body rectangles of a message.
+
+        Args:
+            option (QStyleOptionViewItem): The style option of the row
+            message (Event): The message
+
+        Returns:
+            tuple: The header rect, the body rect and the preview pixmap or None
+        """
+        width = option.rect.width() if option.rect.width() > 0 else 400
+        content_width = max(width - 2 * MESSAGE_PADDING, 1)
+        metrics = QFontMetrics(option.font)
+        header = QRect(MESSAGE_PADDING, MESSAGE_PADDING, content_width, metrics.height())
+
+        pixmap = None
+        if self.shows_preview(message):
+            pixmap = self.pixmap_cache.get(message.url, PREVIEW_SIZE)
+            if pixmap is not None:
+                size = pixmap.size()
+            else:
+                size = self.placeholder_size(message.info)
+            body = QRect(MESSAGE_PADDING, header.bottom() + 1 + MESSAGE_PADDING // 2,
+                         min(size.width(), content_width), size.height())
+        else:
+            text = self.body_text(message)
+            bounds = metrics.boundingRect(QRect(0, 0, content_width, 1 << 20), Qt.TextWordWrap, text)
+            body = QRect(MESSAGE_PADDING, header.bottom() + 1, content_width, bounds.height())
+        return header, body, pixmap
+
+    def placeholder_size(self, info):
+        """
+        Get the size of the placeholder shown while a preview loads.
+
+        Args:
+            info (dict): The image's info block, used for its dimensions when present
+
+        Returns:
+            QSize: The expected preview size
+        """
+        width, height = info.get("w"), info.get("h")
+        if isinstance(width, int) and isinstance(height, int) and width > 0 and height > 0:
+            return QSize(width, height).scaled(PREVIEW_SIZE, PREVIEW_SIZE, Qt.KeepAspectRatio)
+        return QSize(PREVIEW_SIZE, PREVIEW_SIZE * 2 // 3)
+
+    def body_text(self, message):
+        """
+        Get the text shown for a message.
+
+        Args:
+            message (Event): The message
+
+        Returns:
+            str: The message body, or a description of an image
+        """
+        if message.msgtype == "m.image":
+            return f"sent an image: {message.body or ''}"
+        return message.body or ""
+
+    def sizeHint(self, option, index):
+        header, body, _ = self.layout(option, index.data(MessageRole))
+        return QSize(option.rect.width(), body.bottom() + 1 + MESSAGE_PADDING)
+
+    def paint(self, painter, option, index):
+        message = index.data(MessageRole)
+        header, body, pixmap = self.layout(option, message)
+        header.translate(option.rect.topLeft())
+        body.translate(option.rect.topLeft())
+
+        painter.save()
+        if option.state & QStyle.State_MouseOver:
+            painter.fillRect(option.rect, QColor("#333333"))
+
+        # Sender in bold, then the timestamp in gray
+        bold = QFont(option.font)
+        bold.setBold(True)
+        painter.setFont(bold)
+        painter.setPen(QColor("#ffffff"))
+        sender = message.sender or ""
+        painter.drawText(header, Qt.AlignLeft | Qt.AlignVCenter, sender)
+        painter.setFont(option.font)
+        painter.setPen(QColor("gray"))
+        sender_width = QFontMetrics(bold).horizontalAdvance(sender + " ")
+        timestamp = self.format_timestamp(message.origin_server_ts)
+        status = message.send_status
+        if status == SEND_FAILED:
+            painter.setPen(QColor("#ff6666"))
+            timestamp = f"[{timestamp}] Failed to send" if timestamp else "Failed to send"
+        elif status == SEND_PENDING:
+            timestamp = f"[{timestamp}] Sending..." if timestamp else "Sending..."
+        elif timestamp:
+            timestamp = f"[{timestamp}]"
+        painter.drawText(header.adjusted(sender_width, 0, 0, 0), Qt.AlignLeft | Qt.AlignVCenter,
+                         timestamp or "")
+
+        if self.shows_preview(message):
+            if pixmap is not None:
+                painter.drawPixmap(body.topLeft(), pixmap)
+            else:
+                # Not loaded yet, or evicted from the cache since
+                painter.fillRect(body, QColor("#3a3a3a"))
+                self.request_preview(message.url)
+        else:
+            # Messages the server hasn't accepted yet are dimmed
+            painter.setPen(QColor("gray") if status else QColor("#ffffff"))
+            painter.drawText(body, Qt.TextWordWrap, self.body_text(message))
+        painter.restore()
+
+
+class TimelineView(QTreeView):
+    def __init__(self, parent=None):
+        """
+        Initialize the view showing a room's timeline.
+
+        A QTreeView without header or branches is used as the list because with
+        non-uniform row heights it only measures and paints the rows in the
+        viewport, while a QListView measures every row on each insert.
+
+        Args:
+            parent (QWidget): The parent widget
+        """
+        super().__init__(parent)
+        self.setHeaderHidden(True)
+        self.setRootIsDecorated(False)
+        self.setItemsExpandable(False)
+        self.setUniformRowHeights(False)
+        self.setWordWrap(True)
+        self.setSelectionMode(QAbstractItemView.NoSelection)
+        self.setFocusPolicy(Qt.NoFocus)
+        self.setVerticalScrollMode(QAbstractItemView.ScrollPerItem)
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.setMouseTracking(True)
+        
+        # Scrolling lays out the rows right away, so scrolls are merged into one
+        # per event loop iteration instead of one per appended message
+        self.scroll_target = None  # Row to scroll to, None for the bottom
+        self.scroll_timer = QTimer(self)
+        self.scroll_timer.setSingleShot(True)
+        self.scroll_timer.setInterval(0)
+        self.scroll_timer.timeout.connect(self.apply_scroll)
+    
+    def verticalOffset(self):
+        # Qt works the pixel offset out by measuring every row above the viewport,
+        # which is slow deep in a long history. The tree view's own painting and
+        # hit testing don't use it, only stylesheet backgrounds and rubber band
+        # selection do, so the scroll position in rows is good enough here.
+        return self.verticalScrollBar().value()
+    
+    def scroll_to_bottom(self):
+        """
+        Scroll to the newest message once control returns to the event loop.
+        """
+        self.scroll_target = None
+        self.scroll_timer.start()
+
+    def scroll_to(self, position):
+        """
+        Scroll to a position once control returns to the event loop and the rows are laid out.
+
+        Args:
+            position (int): The scroll bar value, i.e. the first row in view
+        """
+        self.scroll_target = position
+        self.scroll_timer.start()
+
+    def first_row(self):
+        """
+        Get the first row in view, or the one about to be after a pending scroll.
+
+        Returns:
+            int: The scroll bar value
+        """
+        if self.scroll_timer.isActive() and self.scroll_target is not None:
+            return self.scroll_target
+        return self.verticalScrollBar().value()
+
+    def apply_scroll(self):
+        """
+        Carry out the last requested scroll.
+        """
+        if self.scroll_target is None:
+            self.scrollToBottom()
+        else:
+            # The scroll range is only known once the model's rows are laid out
+            self.executeDelayedItemsLayout()
+            self.verticalScrollBar().setValue(self.scroll_target)
+
+    def is_at_bottom(self):
+        """
+        Check whether the newest message is in view.
+
+        Returns:
+            bool: True if the view is scrolled to the bottom, or about to be
+        """
+        if self.scroll_timer.isActive() and self.scroll_target is None:
+            return True
+        scrollbar = self.verticalScrollBar()
+        return scrollbar.value() >= scrollbar.maximum()
@@ -0,0 +1,140 @@
+import io
+import os
+import mimetypes
+from typing import Dict, Optional
+from PIL import Image, ImageOps
+
+# Longest side in pixels sent images are downscaled to
+MAX_IMAGE_DIMENSION = 2048
+
+# Images at least this many bytes are recompressed even if they aren't downscaled
+RECOMPRESS_MIN_BYTES = 1024 * 1024
+
+# Bounding box in pixels of the thumbnails uploaded with images
+THUMBNAIL_WIDTH = 800
+THUMBNAIL_HEIGHT = 600
+
+# JPEG quality of recompressed images and of thumbnails
+JPEG_QUALITY = 85
+THUMBNAIL_QUALITY = 75
+
+
+class PreparedMedia:
+    def __init__(self, data: bytes, mime_type: str, width: int, height: int):
+        """
+        Initialize encoded media ready to be uploaded.
+
+        Args:
+            data (bytes): The encoded media
+            mime_type (str): The media's MIME type
+            width (int): Width in pixels
+            height (int): Height in pixels
+        """
+        self.data = data
+        self.mime_type = mime_type
+        self.width = width
+        self.height = height
+
+    def info(self) -> Dict:
+        """
+        Get the info block describing the media in an event.
+
+        Returns:
+            Dict: The mimetype, size and dimensions
+        """
+        return {
+            "mimetype": self.mime_type,
+            "size": len(self.data),
+            "w": self.width,
+            "h": self.height
+        }
+
+
+class PreparedImage:
+    def __init__(self, image: PreparedMedia, thumbnail: Optional[PreparedMedia]):
+        """
+        Initialize an image prepared for sending.
+
+        Args:
+            image (PreparedMedia): The image to upload
+            thumbnail (Optional[PreparedMedia]): Its thumbnail, None if the image is small enough to be its own
+        """
+        self.image = image
+        self.thumbnail = thumbnail
+
+
+def encode_image(image: Image.Image, quality: int) -> PreparedMedia:
+    """
+    Encode an image as JPEG, or as PNG if it has transparency.
+
+    Args:
+        image (Image.Image): The image
+        quality (int): The JPEG quality
+
+    Returns:
+        PreparedMedia: The encoded image
+    """
+    output = io.BytesIO()
+    if image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info):
+        image.save(output, format="PNG", optimize=True)
+        mime_type = "image/png"
+    else:
+        image.convert("RGB").save(output, format="JPEG", quality=quality, optimize=True)
+        mime_type = "image/jpeg"
+    return PreparedMedia(output.getvalue(), mime_type, image.width, image.height)
+
+
+def prepare_image(image_path: str, downscale: bool = True, max_dimension: int = MAX_IMAGE_DIMENSION) -> Optional[PreparedImage]:
+    """
+    Prepare an image file for sending.
+
+    Images larger than max_dimension are downscaled and large files are
+    recompressed, but the result is only used if it is smaller than the
+    original. Images larger than the thumbnail size get a thumbnail, so
+    recipients can draw a preview without downloading the image. Animated
+    images are sent unchanged apart from their thumbnail. Decoding and
+    encoding take a while for camera-sized photos, so this is meant to be
+    called on a worker thread.
+
+    Args:
+        image_path (str): Path to the image file
+        downscale (bool): Whether to downscale and recompress the image
+        max_dimension (int): Longest side in pixels of a downscaled image
+
+    Returns:
+        Optional[PreparedImage]: The prepared image, None if the file can't be decoded
+    """
+    with open(image_path, 'rb') as file:
+        original = file.read()
+    mime_type, _ = mimetypes.guess_type(image_path)
+    if not mime_type:
+        mime_type = 'image/jpeg'  # Default to JPEG if type can't be determined
+
+    try:
+        with Image.open(io.BytesIO(original)) as source:
+            animated = getattr(source, "is_animated", False)
+            # Camera photos are often stored sideways with an orientation tag
+            image = ImageOps.exif_transpose(source) if not animated else source.copy()
+            image.load()
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        print(f"Error preparing image {os.path.basename(image_path)}: {str(e)}")
+        return None
+
+    prepared = PreparedMedia(original, mime_type, image.width, image.height)
+    if downscale and not animated:
+        oversized = max(image.width, image.height) > max_dimension
+        if oversized or len(original) >= RECOMPRESS_MIN_BYTES:
+            scaled = image
+            if oversized:
+                scaled = image.copy()
+                scaled.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+            recompressed = encode_image(scaled, JPEG_QUALITY)
+            if len(recompressed.data) < len(original):
+                prepared = recompressed
+
+    thumbnail = None
+    if image.width > THUMBNAIL_WIDTH or image.height > THUMBNAIL_HEIGHT:
+        small = image.copy()
+        small.thumbnail((THUMBNAIL_WIDTH, THUMBNAIL_HEIGHT), Image.LANCZOS)
+        thumbnail = encode_image(small, THUMBNAIL_QUALITY)
+    return PreparedImage(prepared, thumbnail)
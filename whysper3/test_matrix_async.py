@@ -0,0 +1,143 @@
+import unittest
+import asyncio
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from matrix_async import AsyncMatrixClient
+
+
+class StandInHomeserver:
+    """A minimal in-process homeserver answering the requests the client makes"""
+
+    def __init__(self):
+        self.sent = []
+        self.txn_ids = set()
+        self.sync_count = 0
+        self.rate_limits = 0  # Number of sends answered with 429 before accepting them
+        app = web.Application()
+        app.router.add_post('/_matrix/client/r0/login', self.login)
+        app.router.add_post('/_matrix/client/r0/register', self.register)
+        app.router.add_post('/_matrix/client/r0/user/{user_id}/filter', self.upload_filter)
+        app.router.add_get('/_matrix/client/r0/sync', self.sync)
+        app.router.add_put('/_matrix/client/r0/rooms/{room_id}/send/{event_type}/{txn_id}', self.send)
+        app.router.add_get('/_matrix/client/r0/rooms/{room_id}/messages', self.messages)
+        self.server = TestServer(app)
+
+    async def login(self, request):
+        body = await request.json()
+        if body['password'] != 'secret':
+            return web.json_response({'errcode': 'M_FORBIDDEN'}, status=403)
+        return web.json_response({'access_token': 'token', 'user_id': '@testuser:localhost',
+                                  'device_id': 'DEVICE'})
+
+    async def register(self, request):
+        body = await request.json()
+        return web.json_response({'access_token': 'new-token', 'user_id': f"@{body['username']}:localhost",
+                                  'device_id': 'NEWDEVICE'})
+
+    async def upload_filter(self, request):
+        return web.json_response({'filter_id': '1'})
+
+    async def sync(self, request):
+        self.sync_count += 1
+        events = [{
+            'type': 'm.room.message',
+            'sender': '@other:localhost',
+            'content': {'msgtype': 'm.text', 'body': f'Sync {self.sync_count}'},
+            'event_id': f'$sync{self.sync_count}',
+            'origin_server_ts': 1234567890000
+        }]
+        return web.json_response({
+            'next_batch': f's{self.sync_count}',
+            'rooms': {'join': {'!testroom:localhost': {'timeline': {'events': events}}}}
+        })
+
+    async def send(self, request):
+        if self.rate_limits:
+            self.rate_limits -= 1
+            return web.json_response({'errcode': 'M_LIMIT_EXCEEDED', 'retry_after_ms': 10}, status=429)
+        txn_id = request.match_info['txn_id']
+        if txn_id not in self.txn_ids:
+            self.txn_ids.add(txn_id)
+            self.sent.append((await request.json())['body'])
+        return web.json_response({'event_id': f'${txn_id}'})
+
+    async def messages(self, request):
+        chunk = [{'type': 'm.room.message', 'event_id': '$old', 'content': {'body': 'Old'}}]
+        return web.json_response({'chunk': chunk, 'start': request.query.get('from', 't0'), 'end': 't1'})
+
+
+class TestAsyncMatrixClient(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.homeserver = StandInHomeserver()
+        await self.homeserver.server.start_server()
+        self.client = AsyncMatrixClient(str(self.homeserver.server.make_url('')))
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        await self.homeserver.server.close()
+
+    async def test_login(self):
+        """Test logging in and a failed login"""
+        self.assertIsNone(await self.client.login('@testuser:localhost', 'wrong'))
+        response = await self.client.login('@testuser:localhost', 'secret')
+
+        self.assertEqual(response['user_id'], '@testuser:localhost')
+        self.assertEqual(self.client.access_token, 'token')
+
+    async def test_register_resets_filter(self):
+        """Test that registering another account doesn't reuse the previous account's filter"""
+        await self.client.login('@testuser:localhost', 'secret')
+        await self.client.sync(timeout=0)
+        self.assertEqual(self.client.sync_filter_id, '1')
+
+        response = await self.client.register('newuser', 'secret')
+
+        self.assertEqual(response['user_id'], '@newuser:localhost')
+        self.assertEqual(self.client.access_token, 'new-token')
+        self.assertIsNone(self.client.sync_filter_id)
+
+    async def test_concurrent_sends(self):
+        """Test that many concurrent sends all arrive once"""
+        await self.client.login('@testuser:localhost', 'secret')
+
+        results = await asyncio.gather(*[
+            self.client.send_message('!testroom:localhost', f'Message {i}') for i in range(200)
+        ])
+
+        self.assertTrue(all(results))
+        self.assertEqual(sorted(self.homeserver.sent), sorted(f'Message {i}' for i in range(200)))
+
+    async def test_rate_limited_send_is_retried(self):
+        """Test that a rate limited send is retried for longer than the retries of failed sends"""
+        await self.client.login('@testuser:localhost', 'secret')
+        self.homeserver.rate_limits = 8
+
+        self.assertIsNotNone(await self.client.send_message('!testroom:localhost', 'Hello'))
+        self.assertEqual(self.homeserver.sent, ['Hello'])
+
+    async def test_events_iterator(self):
+        """Test that sync events are yielded as they arrive"""
+        await self.client.login('@testuser:localhost', 'secret')
+
+        received = []
+        async for message in self.client.events():
+            received.append(message['content']['body'])
+            if len(received) == 3:
+                break
+
+        self.assertEqual(received, ['Sync 1', 'Sync 2', 'Sync 3'])
+        self.assertEqual(self.client.next_batch, 's3')
+
+    async def test_get_room_messages(self):
+        """Test fetching a page of room history"""
+        await self.client.login('@testuser:localhost', 'secret')
+
+        messages = await self.client.get_room_messages('!testroom:localhost', since='t0')
+
+        self.assertEqual(messages[0]['event_id'], '$old')
+        self.assertEqual(messages[0].room_id, '!testroom:localhost')
+        self.assertEqual(self.client.pagination_tokens['!testroom:localhost'], {'start': 't0', 'end': 't1'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import unittest
+from PyQt5.QtWidgets import QApplication
+from concurrent.futures import Future
+import sys
+import threading
+import time
+from matrix_commands import CommandDispatcher
+
+class TestCommandDispatcher(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.app = QApplication.instance() or QApplication(sys.argv)
+        
+    def setUp(self):
+        self.dispatcher = CommandDispatcher()
+        
+    def tearDown(self):
+        self.dispatcher.shutdown(wait=True)
+        
+    def wait_for_commands(self):
+        for _ in range(500):
+            QApplication.processEvents()
+            if not self.dispatcher.callbacks:
+                return
+            time.sleep(0.01)
+        self.fail('Commands did not finish')
+        
+    def test_result_delivered_on_gui_thread(self):
+        """Test a command runs on a worker and its result reaches the GUI thread"""
+        threads = []
+        results = []
+        
+        def command(value):
+            threads.append(threading.current_thread())
+            return value * 2
+        self.dispatcher.submit(None, command, 21,
+                               on_result=lambda result: results.append((result, threading.current_thread())))
+        self.wait_for_commands()
+        
+        self.assertEqual(results, [(42, threading.current_thread())])
+        self.assertNotEqual(threads[0], threading.current_thread())
+        
+    def test_duplicate_key_runs_once(self):
+        """Test submitting a command that is in flight returns the running one"""
+        release = threading.Event()
+        calls = []
+        
+        def command():
+            calls.append(1)
+            release.wait(5)
+            return 'done'
+        first = self.dispatcher.submit('join', command)
+        second = self.dispatcher.submit('join', command)
+        self.assertIs(first, second)
+        self.assertTrue(self.dispatcher.is_running('join'))
+        
+        release.set()
+        self.wait_for_commands()
+        self.assertEqual(len(calls), 1)
+        self.assertFalse(self.dispatcher.is_running('join'))
+        
+    def test_error_delivered(self):
+        """Test an exception raised by a command is handed to its error callback"""
+        errors = []
+        
+        def command():
+            raise ValueError('failed')
+        self.dispatcher.submit(None, command, on_error=errors.append)
+        self.wait_for_commands()
+        
+        self.assertEqual(len(errors), 1)
+        self.assertIsInstance(errors[0], ValueError)
+        
+    def test_cancel_drops_result(self):
+        """Test cancelling a running command drops its result"""
+        release = threading.Event()
+        results = []
+        self.dispatcher.submit('rooms', lambda: release.wait(5), on_result=results.append)
+        
+        self.assertTrue(self.dispatcher.cancel('rooms'))
+        self.assertFalse(self.dispatcher.cancel('rooms'))
+        release.set()
+        self.dispatcher.executor.shutdown(wait=True)
+        QApplication.processEvents()
+        self.assertEqual(results, [])
+        
+    def test_watched_future_not_cancelled(self):
+        """Test futures owned by someone else are only unwatched when cancelled"""
+        results = []
+        future = Future()
+        self.dispatcher.watch(future, 'send', on_result=results.append)
+        
+        self.dispatcher.cancel_all()
+        self.assertFalse(future.cancelled())
+        future.set_result('sent')
+        QApplication.processEvents()
+        self.assertEqual(results, [])
+        
+    def test_watched_future_result(self):
+        """Test the result of a watched future is delivered"""
+        results = []
+        future = Future()
+        self.dispatcher.watch(future, on_result=results.append)
+        future.set_result('sent')
+        self.wait_for_commands()
+        self.assertEqual(results, ['sent'])
+
+if __name__ == '__main__':
+    unittest.main()
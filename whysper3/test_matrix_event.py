@@ -0,0 +1,90 @@
+import unittest
+import json
+import tracemalloc
+from matrix_event import Event, as_event
+
+def make_wire_event(index, room_id='!testroom:matrix.org'):
+    return {
+        'type': 'm.room.message',
+        'sender': '@testuser:matrix.org',
+        'content': {'msgtype': 'm.text', 'body': f'Message {index}', 'format': 'org.matrix.custom.html',
+                    'formatted_body': f'<b>Message {index}</b>'},
+        'event_id': f'$event{index}',
+        'origin_server_ts': 1234567890000 + index,
+        'unsigned': {'age': 1234, 'transaction_id': f'txn{index}'},
+        'room_id': room_id
+    }
+
+class TestEvent(unittest.TestCase):
+    def test_from_wire(self):
+        """Test the fields and content of a wire event are kept"""
+        wire = make_wire_event(1)
+        event = Event.from_wire(wire)
+
+        self.assertEqual(event.event_id, '$event1')
+        self.assertEqual(event.sender, '@testuser:matrix.org')
+        self.assertEqual(event.msgtype, 'm.text')
+        self.assertEqual(event.body, 'Message 1')
+        self.assertIsNone(event.url)
+        self.assertEqual(event.txn_id, 'txn1')
+        self.assertEqual(event.content, wire['content'])
+
+        # Converting doesn't touch the wire event
+        self.assertEqual(wire, make_wire_event(1))
+
+    def test_room_and_sender_interned(self):
+        """Test events repeating a room or sender share one string"""
+        first = Event.from_wire(json.loads(json.dumps(make_wire_event(1))))
+        second = Event.from_wire(json.loads(json.dumps(make_wire_event(2))))
+
+        self.assertIs(first.room_id, second.room_id)
+        self.assertIs(first.sender, second.sender)
+        self.assertIs(first.msgtype, second.msgtype)
+
+    def test_read_like_a_dict(self):
+        """Test events answer the lookups code written against wire events makes"""
+        event = Event.from_wire(make_wire_event(1), '!other:matrix.org')
+
+        self.assertEqual(event['room_id'], '!other:matrix.org')
+        self.assertEqual(event.get('content', {}).get('body'), 'Message 1')
+        self.assertEqual(event['unsigned'], {'transaction_id': 'txn1'})
+        self.assertIn('event_id', event)
+        self.assertNotIn('send_status', event)
+        self.assertEqual(event.get('send_status', 'sent'), 'sent')
+        with self.assertRaises(KeyError):
+            event['send_status']
+
+    def test_to_dict_round_trip(self):
+        """Test an event converts back to its wire form, less the unsigned data it drops"""
+        wire = make_wire_event(1)
+        wire['unsigned'] = {'transaction_id': 'txn1'}
+
+        self.assertEqual(Event.from_wire(wire).to_dict(), wire)
+
+    def test_as_event(self):
+        """Test events are passed through and dicts converted"""
+        event = Event('!testroom:matrix.org', '@testuser:matrix.org', {'msgtype': 'm.text', 'body': 'Hi'})
+
+        self.assertIs(as_event(event), event)
+        self.assertEqual(as_event(make_wire_event(1)).event_id, '$event1')
+
+    def test_smaller_than_dicts(self):
+        """Test cached events take a fraction of the memory of decoded wire events"""
+        data = [json.dumps(make_wire_event(i)) for i in range(1000)]
+
+        tracemalloc.start()
+        dicts = [json.loads(text) for text in data]
+        dict_size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del dicts
+
+        tracemalloc.start()
+        events = [Event.from_wire(json.loads(text)) for text in data]
+        event_size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        self.assertEqual(len(events), 1000)
+        self.assertLess(event_size * 2, dict_size)
+
+if __name__ == '__main__':
+    unittest.main()
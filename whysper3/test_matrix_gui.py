@@ -1,13 +1,27 @@
 import unittest
+import json
 from unittest.mock import MagicMock, patch
-from PyQt5.QtWidgets import QApplication
+from concurrent.futures import Future
+import threading
+from PyQt5.QtWidgets import QApplication, QListWidgetItem
 from PyQt5.QtCore import Qt, QByteArray, QBuffer, QIODevice
-from PyQt5.QtGui import QPixmap, QImage
+from PyQt5.QtGui import QImage, QColor
+from PIL import Image
 import sys
+import io
+import time
 import os
-import base64
-from matrix_gui import MatrixGUI
-from matrix_login import MatrixLogin
+import tempfile
+from matrix_gui import MatrixGUI, decode_image
+from matrix_timeline import TimelineModel, PREVIEW_SIZE
+from matrix_login import MatrixLogin, HistoryPageError, serialise_filter
+from matrix_sync import DEFAULT_SYNC_FILTER
+
+class RecordingTimelineModel(TimelineModel):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.inserted = []
+        self.rowsInserted.connect(lambda parent, first, last: self.inserted.append((first, last)))
 
 class TestMatrixGUI(unittest.TestCase):
     @classmethod
@@ -19,6 +33,8 @@ class TestMatrixGUI(unittest.TestCase):
         # Create a mock Matrix client
         self.mock_client = MagicMock(spec=MatrixLogin)
         self.mock_client.login.return_value = True
+        self.mock_client.has_missing_events_after.return_value = False
+        self.mock_client.user_id = '@me:matrix.org'
         self.mock_client.get_joined_rooms.return_value = {'joined_rooms': ['!testroom:matrix.org']}
         self.mock_client.get_room_messages.return_value = [
             {
@@ -35,6 +51,25 @@ class TestMatrixGUI(unittest.TestCase):
         self.gui = MatrixGUI()
         self.gui.matrix_client = self.mock_client
         
+    def wait_for_history(self):
+        """Wait for the history loaded in the background to be shown"""
+        self.gui.history_pool.waitForDone()
+        QApplication.processEvents()
+        
+    def wait_for_commands(self):
+        """Wait for the commands running on workers to hand over their results"""
+        for _ in range(500):
+            QApplication.processEvents()
+            if not self.gui.commands.callbacks:
+                return
+            time.sleep(0.01)
+        self.fail('Commands did not finish')
+        
+    def timeline_text(self):
+        """Get the text of every row in the timeline"""
+        model = self.gui.timeline_model
+        return "\n".join(model.index(row).data() for row in range(model.rowCount()))
+        
     def test_handle_message_text(self):
         """Test handling of text messages"""
         message = {
@@ -48,8 +83,8 @@ class TestMatrixGUI(unittest.TestCase):
         
         self.gui.handle_message(message)
         
-        # Check if message was added to chat display
-        self.assertIn('Test message', self.gui.chat_display.toPlainText())
+        # Check if message was added to the timeline
+        self.assertIn('Test message', self.timeline_text())
         
     def test_handle_message_image(self):
         """Test handling of image messages"""
@@ -64,8 +99,8 @@ class TestMatrixGUI(unittest.TestCase):
         image.save(buffer, "PNG")
         image_data = byte_array.data()
         
-        # Mock the download_media method to return the image data
-        self.mock_client.download_media.return_value = image_data
+        # Mock the download_thumbnail method to return the image data
+        self.mock_client.download_thumbnail.return_value = image_data
         
         message = {
             'sender': '@testuser:matrix.org',
@@ -79,25 +114,257 @@ class TestMatrixGUI(unittest.TestCase):
         
         self.gui.handle_message(message)
         
-        # Check if image HTML was added to chat display
-        html_content = self.gui.chat_display.toHtml()
-        self.assertIn('data:image/png;base64', html_content)
+        # Check the message was added to the timeline right away, with its preview still loading
+        self.assertEqual(self.gui.timeline_model.rowCount(), 1)
+        self.assertIn('mxc://test.com/testimage', self.gui.pending_previews)
+        
+        # Wait for the worker to load the image, then check it is shown as the preview
+        self.gui.media_pool.waitForDone()
+        QApplication.processEvents()
+        self.assertEqual(self.gui.pending_previews, set())
+        preview = self.gui.pixmap_cache.get('mxc://test.com/testimage', 300)
+        self.assertEqual(preview.toImage().pixelColor(0, 0), QColor(Qt.blue))
+        
+        # Only the thumbnail is downloaded for the preview
+        self.mock_client.download_thumbnail.assert_called_once_with('mxc://test.com/testimage', 300, 300)
+        self.mock_client.download_media.assert_not_called()
+        
+    def test_failed_preview(self):
+        """Test a preview that fails to load is shown as text and retried on click"""
+        message = {
+            'sender': '@testuser:matrix.org',
+            'content': {'msgtype': 'm.image', 'url': 'mxc://test.com/broken', 'body': 'broken.png'},
+            'origin_server_ts': 1234567890000
+        }
+        self.mock_client.download_thumbnail.return_value = None
+        self.mock_client.download_media.return_value = b'not an image'
+        self.gui.handle_message(message)
+        self.gui.media_pool.waitForDone()
+        QApplication.processEvents()
+        
+        # Without a thumbnail on the server the original is tried too
+        self.mock_client.download_media.assert_called_once_with('mxc://test.com/broken')
+        self.assertEqual(self.gui.pending_previews, set())
+        self.assertIn('mxc://test.com/broken', self.gui.failed_previews)
+        delegate = self.gui.timeline_view.itemDelegate()
+        self.assertFalse(delegate.shows_preview(self.gui.timeline_model.message(0)))
+        self.assertEqual(delegate.body_text(self.gui.timeline_model.message(0)), 'sent an image: broken.png')
+        
+        # Painting the row doesn't retry it, clicking it does
+        self.gui.load_preview('mxc://test.com/broken')
+        self.assertEqual(self.gui.pending_previews, set())
+        self.mock_client.download_media.return_value = self.encode_image(100, 100, 'PNG')
+        self.gui.message_clicked(self.gui.timeline_model.index(0))
+        self.gui.media_pool.waitForDone()
+        QApplication.processEvents()
+        self.assertNotIn('mxc://test.com/broken', self.gui.failed_previews)
+        self.assertIsNotNone(self.gui.pixmap_cache.get('mxc://test.com/broken', PREVIEW_SIZE))
+        self.assertTrue(delegate.shows_preview(self.gui.timeline_model.message(0)))
+        
+    def test_shared_preview(self):
+        """Test messages showing the same image share one preview"""
+        image = QImage(100, 100, QImage.Format_RGB32)
+        image.fill(Qt.blue)
+        byte_array = QByteArray()
+        buffer = QBuffer(byte_array)
+        buffer.open(QIODevice.WriteOnly)
+        image.save(buffer, "PNG")
+        self.mock_client.download_thumbnail.return_value = byte_array.data()
+        
+        message = {
+            'sender': '@testuser:matrix.org',
+            'content': {
+                'msgtype': 'm.image',
+                'url': 'mxc://test.com/testimage',
+                'body': 'Test image'
+            },
+            'origin_server_ts': 1234567890000
+        }
+        self.gui.handle_message(message)
+        self.gui.handle_message(dict(message))
+        self.gui.media_pool.waitForDone()
+        QApplication.processEvents()
+        
+        # The image is downloaded and kept in memory once
+        self.mock_client.download_thumbnail.assert_called_once()
+        self.assertEqual(len(self.gui.pixmap_cache.pixmaps), 1)
+        self.assertEqual(self.gui.timeline_model.rowCount(), 2)
+        
+    def encode_image(self, width, height, image_format):
+        """Encode a blank image of the given size"""
+        if image_format == 'GIF':
+            # Qt only reads GIF
+            output = io.BytesIO()
+            Image.new('RGB', (width, height), 'blue').save(output, 'GIF')
+            return output.getvalue()
+        image = QImage(width, height, QImage.Format_RGB32)
+        image.fill(Qt.blue)
+        byte_array = QByteArray()
+        buffer = QBuffer(byte_array)
+        buffer.open(QIODevice.WriteOnly)
+        image.save(buffer, image_format)
+        return byte_array.data()
+        
+    def test_decode_image_at_target_size(self):
+        """Test images are decoded at preview size whatever their format"""
+        for image_format in ('JPEG', 'PNG', 'BMP', 'GIF'):
+            image = decode_image(self.encode_image(1200, 600, image_format), 300)
+            self.assertEqual((image.width(), image.height()), (300, 150), image_format)
+        
+        # Small images aren't scaled up
+        image = decode_image(self.encode_image(100, 50, 'PNG'), 300)
+        self.assertEqual((image.width(), image.height()), (100, 50))
+        self.assertTrue(decode_image(b'not an image', 300).isNull())
+        
+    def test_decode_image_pixel_guard(self):
+        """Test images too large to decode at full size are refused or decoded smaller"""
+        with patch('matrix_gui.MAX_DECODE_PIXELS', 400 * 300):
+            # Scaled while decoding, so only the preview's pixels count
+            image = decode_image(self.encode_image(1200, 900, 'JPEG'), 300)
+            self.assertEqual((image.width(), image.height()), (300, 225))
+            
+            # Originals are decoded at the largest size the guard allows
+            image = decode_image(self.encode_image(1200, 900, 'JPEG'))
+            self.assertEqual((image.width(), image.height()), (400, 300))
+            
+            # Formats decoded at full size first are refused
+            self.assertTrue(decode_image(self.encode_image(1200, 900, 'BMP'), 300).isNull())
+            self.assertTrue(decode_image(self.encode_image(1200, 900, 'GIF'), 300).isNull())
         
     def test_send_message(self):
         """Test sending a message"""
         self.gui.current_room = '!testroom:matrix.org'
         self.gui.message_input.setText('Test message')
         
-        self.mock_client.send_message.return_value = True
+        future = Future()
+        self.mock_client.new_transaction_id.return_value = 'txn1'
+        self.mock_client.queue_message.return_value = future
         self.gui.send_message()
         
-        # Check if message was sent
-        self.mock_client.send_message.assert_called_once_with('!testroom:matrix.org', 'Test message')
+        # Check the message was queued without waiting for it to be sent
+        self.mock_client.queue_message.assert_called_once_with('!testroom:matrix.org', 'Test message', 'txn1')
         self.assertEqual(self.gui.message_input.text(), '')
         
+        # A failed send is reported once the queue gives up
+        with patch('matrix_gui.QMessageBox.critical') as critical:
+            future.set_result(None)
+            self.wait_for_commands()
+        critical.assert_called_once()
+        
+    def test_local_echo(self):
+        """Test a sent message shows right away and is replaced by the server's event"""
+        self.mock_client.iter_room_history.return_value = iter([])
+        self.mock_client.new_transaction_id.side_effect = ['txn1', 'txn2']
+        sent, failed = Future(), Future()
+        self.mock_client.queue_message.side_effect = [sent, failed]
+        self.gui.room_selected(QListWidgetItem('!testroom:matrix.org'))
+        self.wait_for_history()
+        model = self.gui.timeline_model
+        
+        self.gui.message_input.setText('Hello')
+        self.gui.send_message()
+        self.assertEqual(model.rowCount(), 1)
+        self.assertEqual(model.message(0)['send_status'], 'sending')
+        self.assertEqual(self.timeline_text(), '@me:matrix.org: Hello')
+        
+        # Accepted by the server before sync returns it
+        sent.set_result({'event_id': '$sent'})
+        self.wait_for_commands()
+        self.assertNotIn('send_status', model.message(0))
+        self.assertTrue(model.has_event('$sent'))
+        
+        # The event from sync takes over the echo's row instead of adding another
+        event = {
+            'sender': '@me:matrix.org',
+            'content': {'msgtype': 'm.text', 'body': 'Hello'},
+            'origin_server_ts': 1234567890000,
+            'event_id': '$sent',
+            'room_id': '!testroom:matrix.org',
+            'unsigned': {'transaction_id': 'txn1'}
+        }
+        self.gui.handle_message(event)
+        self.assertEqual(model.rowCount(), 1)
+        self.assertEqual(model.message(0).to_dict(), event)
+        
+        # Failures are shown on the message instead of in a dialog
+        self.gui.message_input.setText('Lost')
+        self.gui.send_message()
+        with patch('matrix_gui.QMessageBox.critical') as critical:
+            failed.set_result(None)
+            self.wait_for_commands()
+        critical.assert_not_called()
+        self.assertEqual(model.rowCount(), 2)
+        self.assertEqual(model.message(1)['send_status'], 'failed')
+        
+    def test_local_echo_reconciled_from_sync(self):
+        """Test the event of a sync response takes over the echo's row through its transaction ID"""
+        self.mock_client.iter_room_history.return_value = iter([])
+        self.mock_client.new_transaction_id.return_value = 'txn1'
+        self.mock_client.queue_message.return_value = Future()
+        self.gui.room_selected(QListWidgetItem('!testroom:matrix.org'))
+        self.wait_for_history()
+        model = self.gui.timeline_model
+        self.gui.message_input.setText('Hello')
+        self.gui.send_message()
+        self.assertEqual(model.transaction_row('txn1'), 0)
+        
+        # Deliver a sync response through the sync engine to the room's listener
+        client = MatrixLogin('https://matrix.org')
+        room_id, callback = self.mock_client.start_listening.call_args[0]
+        client.sync_engine.subscribe(room_id, callback)
+        client.sync_engine.dispatch({'rooms': {'join': {room_id: {'timeline': {'events': [{
+            'type': 'm.room.message',
+            'sender': '@me:matrix.org',
+            'content': {'msgtype': 'm.text', 'body': 'Hello'},
+            'origin_server_ts': 1234567890000,
+            'event_id': '$sent',
+            'unsigned': {'transaction_id': 'txn1'}
+        }]}}}}})
+        for _ in range(100):
+            QApplication.processEvents()
+            if model.has_event('$sent'):
+                break
+            time.sleep(0.01)
+        
+        self.assertEqual(model.rowCount(), 1)
+        self.assertEqual(model.transaction_row('txn1'), 0)
+        self.assertEqual(model.message(0).event_id, '$sent')
+        self.assertIsNone(model.message(0).send_status)
+        
+    def test_commands_run_off_gui_thread(self):
+        """Test client calls run on workers and double clicks are ignored"""
+        gui_thread = threading.current_thread()
+        threads = []
+        release = threading.Event()
+        
+        def join_room(room_id):
+            threads.append(threading.current_thread())
+            release.wait(5)
+            return {'room_id': room_id}
+        self.mock_client.join_room.side_effect = join_room
+        self.mock_client.get_joined_rooms.side_effect = lambda: {'joined_rooms': ['!testroom:matrix.org']}
+        dialog = MagicMock()
+        self.gui.room_input = MagicMock()
+        self.gui.room_input.text.return_value = '#test:matrix.org'
+        
+        # Both clicks return right away while the join is still running
+        self.gui.join_room(dialog)
+        self.gui.join_room(dialog)
+        self.assertTrue(self.gui.commands.is_running(('join', '#test:matrix.org')))
+        release.set()
+        self.wait_for_commands()
+        
+        self.mock_client.join_room.assert_called_once_with('#test:matrix.org')
+        self.assertNotEqual(threads[0], gui_thread)
+        dialog.close.assert_called_once()
+        self.assertEqual(self.gui.room_list.item(0).text(), '!testroom:matrix.org')
+        
     def test_send_image(self):
-        """Test sending an image"""
-        self.gui.current_room = '!testroom:matrix.org'
+        """Test sending an image shows its echo and reuses the local preview"""
+        self.mock_client.iter_room_history.return_value = iter([])
+        self.mock_client.new_transaction_id.return_value = 'txn1'
+        self.gui.room_selected(QListWidgetItem('!testroom:matrix.org'))
+        self.wait_for_history()
         
         # Create a test image file
         test_image_path = 'test_image.png'
@@ -105,38 +372,391 @@ class TestMatrixGUI(unittest.TestCase):
         image.fill(Qt.blue)
         image.save(test_image_path)
         
+        # The preview is decoded on a worker, never on the GUI thread
+        decode_threads = []
+        def decode(*args):
+            decode_threads.append(threading.current_thread())
+            return decode_image(*args)
+        
         # Mock the file dialog to return our test image
         with patch('PyQt5.QtWidgets.QFileDialog.getOpenFileName', 
-                  return_value=(test_image_path, 'Image Files (*.png *.jpg *.jpeg *.gif *.bmp)')):
-            self.mock_client.send_image.return_value = True
+                  return_value=(test_image_path, 'Image Files (*.png *.jpg *.jpeg *.gif *.bmp)')), \
+                patch('matrix_gui.decode_image', side_effect=decode):
+            self.mock_client.send_image.return_value = {'event_id': '$image'}
             self.gui.send_image()
+            self.wait_for_commands()
+            self.gui.media_pool.waitForDone()
+            QApplication.processEvents()
             
             # Check if image was sent
-            self.mock_client.send_image.assert_called_once()
+            self.mock_client.send_image.assert_called_once_with('!testroom:matrix.org', test_image_path, 'txn1')
+            
+        # The uploaded image takes over the preview of the local file
+        echo = self.gui.timeline_model.message(0)
+        self.assertEqual(echo['content']['info'], {'w': 100, 'h': 100})
+        self.assertEqual(len(decode_threads), 1)
+        self.assertIsNot(decode_threads[0], threading.main_thread())
+        self.assertIsNotNone(self.gui.pixmap_cache.get(echo.url, PREVIEW_SIZE))
+        self.gui.handle_message({
+            'sender': '@me:matrix.org',
+            'content': {'msgtype': 'm.image', 'body': test_image_path, 'url': 'mxc://test.com/sent'},
+            'event_id': '$image',
+            'room_id': '!testroom:matrix.org',
+            'unsigned': {'transaction_id': 'txn1'}
+        })
+        self.assertEqual(self.gui.timeline_model.rowCount(), 1)
+        self.assertIsNotNone(self.gui.pixmap_cache.get('mxc://test.com/sent', PREVIEW_SIZE))
+        self.mock_client.download_thumbnail.assert_not_called()
             
         # Clean up test image
         os.remove(test_image_path)
         
+    def test_room_selected_batch(self):
+        """Test opening a room adds its first page of history in one model operation"""
+        history = [
+            {
+                'sender': '@testuser:matrix.org',
+                'content': {
+                    'msgtype': 'm.image' if i % 10 == 0 else 'm.text',
+                    'url': f'mxc://test.com/image{i}',
+                    'body': f'Message {i}'
+                },
+                'origin_server_ts': 1234567890000 + i
+            }
+            for i in range(60, 0, -1)
+        ]
+        self.mock_client.iter_room_history.return_value = iter(history)
+        
+        with patch('matrix_gui.TimelineModel', RecordingTimelineModel):
+            self.gui.room_selected(QListWidgetItem('!testroom:matrix.org'))
+            self.wait_for_history()
+        
+        self.assertEqual(self.gui.timeline_model.inserted, [(0, 49)])
+        self.assertTrue(self.timeline_text().startswith('@testuser:matrix.org: Message 11\n'))
+        self.assertTrue(self.timeline_text().endswith('Message 60'))
+        self.assertTrue(self.gui.room_timelines['!testroom:matrix.org'].has_more)
+        
+        # Previews of history are only loaded once their rows are painted
+        self.mock_client.download_thumbnail.assert_not_called()
+        
+    def test_sync_events_batched(self):
+        """Test events arriving from the sync thread are shown in one model operation per frame"""
+        self.mock_client.iter_room_history.return_value = iter([])
+        with patch('matrix_gui.TimelineModel', RecordingTimelineModel):
+            self.gui.room_selected(QListWidgetItem('!testroom:matrix.org'))
+            self.wait_for_history()
+        room_id, callback = self.mock_client.start_listening.call_args[0]
+        self.assertEqual(room_id, '!testroom:matrix.org')
+        
+        sync_thread = threading.Thread(target=lambda: [callback(self.make_event(i)) for i in range(50)])
+        sync_thread.start()
+        sync_thread.join()
+        model = self.gui.timeline_model
+        for _ in range(100):
+            QApplication.processEvents()
+            if model.rowCount():
+                break
+            time.sleep(0.01)
+        
+        self.assertEqual(model.inserted, [(0, 49)])
+        self.assertEqual(model.message(49)['event_id'], '$event49')
+        
+        # Messages still collected when the room is closed are dropped
+        callback(self.make_event(50))
+        self.gui.room_timelines['!testroom:matrix.org'].listener.stop()
+        time.sleep(0.05)
+        QApplication.processEvents()
+        self.assertEqual(model.rowCount(), 50)
+        
+    def test_limited_sync_restarts_open_timeline(self):
+        """Test an open timeline starts over from the newest messages when a limited sync leaves a gap after it"""
+        self.mock_client.iter_room_history.return_value = iter([self.make_event(i) for i in range(59, -1, -1)])
+        self.gui.room_selected(QListWidgetItem('!testroom:matrix.org'))
+        self.wait_for_history()
+        self.assertEqual(self.gui.timeline_model.rowCount(), 50)
+        
+        self.mock_client.has_missing_events_after.return_value = True
+        self.mock_client.iter_room_history.return_value = iter([self.make_event(i) for i in range(159, 109, -1)])
+        self.gui.handle_messages([self.make_event(i) for i in range(150, 160)])
+        self.wait_for_history()
+        
+        self.mock_client.has_missing_events_after.assert_called_with('!testroom:matrix.org', '$event59')
+        model = self.gui.timeline_model
+        self.assertEqual([model.message(row).event_id for row in range(model.rowCount())],
+                         [f'$event{i}' for i in range(110, 160)])
+        
+    def test_limited_sync_after_warm_start(self):
+        """Test no events go missing when a limited sync arrives after a room opened from the store"""
+        room_id = '!testroom:matrix.org'
+        client = MatrixLogin('https://matrix.org')
+        client.access_token = 'token'
+        client.user_id = '@me:matrix.org'
+        client.sync_engine.start = MagicMock()
+        events = {i: dict(self.make_event(i), type='m.room.message') for i in range(160)}
+        # Stored in an earlier session
+        client.get_event_store().add_timeline(room_id, [events[i] for i in range(60)], prev_batch='p0')
+        pages = {
+            None: ([events[i] for i in range(159, 109, -1)], 't110'),
+            't110': ([events[i] for i in range(109, 59, -1)], 't60'),
+            't60': ([events[i] for i in range(59, 9, -1)], 't10')
+        }
+        
+        def get(url, params=None, **kwargs):
+            chunk, end = pages[params.get('from')]
+            return MagicMock(status_code=200, content=json.dumps({'chunk': chunk, 'end': end}).encode())
+        client.session.get = MagicMock(side_effect=get)
+        self.gui.matrix_client = client
+        
+        # The room is opened before the first sync of the session
+        self.gui.room_selected(QListWidgetItem(room_id))
+        self.wait_for_history()
+        client.sync_engine.dispatch({'rooms': {'join': {room_id: {'timeline': {
+            'events': [events[i] for i in range(150, 160)], 'limited': True, 'prev_batch': 't150'}}}}})
+        time.sleep(0.05)
+        QApplication.processEvents()
+        self.gui.load_more_messages()
+        self.wait_for_history()
+        
+        model = self.gui.timeline_model
+        self.assertEqual([model.message(row).event_id for row in range(model.rowCount())],
+                         [f'$event{i}' for i in range(60, 160)])
+        
+    def test_rejected_token_shows_login(self):
+        """Test a resumed session whose access token is rejected returns to the login dialog"""
+        with tempfile.TemporaryDirectory() as data_dir:
+            client = MatrixLogin('https://matrix.org', data_dir=data_dir)
+            client.access_token = 'revoked'
+            client.user_id = '@me:matrix.org'
+            client.sync_filter_id = 'filter'
+            client.sync_filter = serialise_filter(DEFAULT_SYNC_FILTER)
+            client.joined_rooms = ['!testroom:matrix.org']
+            self.assertTrue(client.save_session())
+            
+            with patch.object(MatrixGUI, 'show_login_dialog') as show_login_dialog:
+                gui = MatrixGUI(data_dir)
+                show_login_dialog.assert_not_called()
+                client = gui.matrix_client
+                self.assertIsNotNone(client)
+                client.start_listening = MagicMock()
+                client.stop_listening = MagicMock()
+                client.get_event_store().add_timeline('!testroom:matrix.org', [dict(self.make_event(0), type='m.room.message')])
+                client.sync_engine.synced = True
+                gui.room_selected(QListWidgetItem('!testroom:matrix.org'))
+                gui.history_pool.waitForDone()
+                QApplication.processEvents()
+                self.assertEqual(gui.timeline_model.rowCount(), 1)
+                
+                client.session.get = MagicMock(return_value=MagicMock(status_code=401))
+                sync_thread = threading.Thread(target=client.sync_engine.sync_once)
+                sync_thread.start()
+                sync_thread.join()
+                QApplication.processEvents()
+                
+                show_login_dialog.assert_called_once()
+            self.assertIsNone(gui.matrix_client)
+            self.assertEqual(gui.room_timelines, {})
+            self.assertEqual(gui.timeline_model.rowCount(), 0)
+            self.assertEqual(gui.room_list.count(), 0)
+            self.assertFalse(os.path.exists(client.get_session_path()))
+            client.get_event_store().close()
+            gui.close()
+        
+    def make_history(self, room_id, count):
+        return [
+            {
+                'room_id': room_id,
+                'sender': '@testuser:matrix.org',
+                'content': {'msgtype': 'm.text', 'body': f'{room_id} message {i}'},
+                'origin_server_ts': 1234567890000 + i
+            }
+            for i in range(count, 0, -1)
+        ]
+        
+    def test_room_switch_cached(self):
+        """Test switching back to a recently viewed room reuses its live timeline"""
+        self.mock_client.iter_room_history.side_effect = lambda room_id, page_size, from_token: iter(self.make_history(room_id, 3))
+        
+        self.gui.room_selected(QListWidgetItem('!a:matrix.org'))
+        self.wait_for_history()
+        room_a = self.gui.timeline_model
+        self.gui.room_selected(QListWidgetItem('!b:matrix.org'))
+        self.wait_for_history()
+        
+        # A message arriving for the room in the background only updates its model
+        self.gui.handle_message(self.make_history('!a:matrix.org', 4)[0])
+        self.assertEqual(room_a.rowCount(), 4)
+        self.assertEqual(self.gui.timeline_model.rowCount(), 3)
+        
+        # Switching back shows the same model without loading history again
+        self.gui.room_selected(QListWidgetItem('!a:matrix.org'))
+        self.wait_for_history()
+        self.assertIs(self.gui.timeline_view.model(), room_a)
+        self.assertEqual(self.mock_client.iter_room_history.call_count, 2)
+        self.assertTrue(self.timeline_text().endswith('!a:matrix.org message 4'))
+        self.mock_client.stop_listening.assert_not_called()
+        
+    def test_room_cache_eviction(self):
+        """Test the least recently viewed rooms are dropped once the cache is over budget"""
+        self.mock_client.iter_room_history.side_effect = lambda room_id, page_size, from_token: iter(self.make_history(room_id, 3))
+        
+        with patch('matrix_gui.TIMELINE_CACHE_SIZE', 6):
+            for room_id in ['!a:matrix.org', '!b:matrix.org', '!a:matrix.org', '!c:matrix.org']:
+                self.gui.room_selected(QListWidgetItem(room_id))
+                self.wait_for_history()
+        
+        self.assertEqual(list(self.gui.room_timelines), ['!a:matrix.org', '!c:matrix.org'])
+        self.mock_client.stop_listening.assert_called_once()
+        self.assertEqual(self.mock_client.stop_listening.call_args[0][0], '!b:matrix.org')
+        
+    def make_event(self, index, room_id='!testroom:matrix.org'):
+        return {
+            'room_id': room_id,
+            'sender': '@testuser:matrix.org',
+            'content': {'msgtype': 'm.text', 'body': f'Message {index}'},
+            'event_id': f'$event{index}',
+            'origin_server_ts': 1234567890000 + index
+        }
+        
+    @patch('matrix_gui.HISTORY_PAGE_SIZE', 5)
+    def test_failed_history_page_retried(self):
+        """Test a page of history that failed to load is tried again instead of ending the room"""
+        room_id = '!testroom:matrix.org'
+        
+        def iter_room_history(room_id, page_size, from_token):
+            if from_token is None:
+                yield from (self.make_event(i) for i in range(9, 4, -1))
+                raise HistoryPageError(room_id, 't5')
+            yield from (self.make_event(i) for i in range(4, 1, -1))
+        self.mock_client.iter_room_history.side_effect = iter_room_history
+        self.gui.room_selected(QListWidgetItem(room_id))
+        self.wait_for_history()
+        timeline = self.gui.room_timelines[room_id]
+        
+        self.gui.load_more_messages()
+        self.wait_for_history()
+        
+        self.assertTrue(timeline.has_more)
+        self.assertEqual(self.mock_client.iter_room_history.call_args[1]['from_token'], 't5')
+        
+        self.gui.load_more_messages()
+        self.wait_for_history()
+        
+        model = self.gui.timeline_model
+        self.assertEqual([model.message(row)['event_id'] for row in range(model.rowCount())],
+                         [f'$event{i}' for i in range(2, 10)])
+        self.assertFalse(timeline.has_more)
+        
+    @patch('matrix_gui.HISTORY_PAGE_SIZE', 5)
+    @patch('matrix_gui.MAX_TIMELINE_ROWS', 10)
+    def test_scrollback_releases_oldest(self):
+        """Test a room followed at the bottom releases its oldest messages and pages back to them"""
+        self.mock_client.iter_room_history.side_effect = (
+            lambda room_id, page_size, from_token: iter([self.make_event(i) for i in range(4, -1, -1)]))
+        self.mock_client.get_history_token.side_effect = lambda room_id, event_id: f'whysper:{event_id}'
+        self.gui.room_selected(QListWidgetItem('!testroom:matrix.org'))
+        self.wait_for_history()
+        
+        for i in range(5, 100):
+            self.gui.handle_message(self.make_event(i))
+        
+        # The timeline stays bounded and holds the newest messages
+        model = self.gui.timeline_model
+        self.assertLess(model.rowCount(), 15)
+        self.assertEqual(model.message(model.rowCount() - 1)['event_id'], '$event99')
+        
+        # Older messages are paged back in from below the oldest one still shown
+        oldest = model.message(0)['event_id']
+        self.assertEqual(self.mock_client.iter_room_history.call_args[1]['from_token'], f'whysper:{oldest}')
+        self.assertTrue(self.gui.room_timelines['!testroom:matrix.org'].has_more)
+        
+    @patch('matrix_gui.HISTORY_PAGE_SIZE', 5)
+    @patch('matrix_gui.MAX_TIMELINE_ROWS', 10)
+    def test_scrollback_releases_newest(self):
+        """Test a room scrolled back through history releases its newest messages and reloads them"""
+        self.mock_client.iter_room_history.side_effect = (
+            lambda room_id, page_size, from_token: iter([self.make_event(i) for i in range(99, -1, -1)]))
+        self.mock_client.get_history_token.return_value = 'whysper:1'
+        self.gui.resize(400, 200)
+        self.gui.show()
+        self.gui.room_selected(QListWidgetItem('!testroom:matrix.org'))
+        self.wait_for_history()
+        
+        # Load older messages while reading at the top
+        for _ in range(4):
+            QApplication.processEvents()
+            self.gui.timeline_view.verticalScrollBar().setValue(0)
+            self.gui.load_more_messages()
+            self.gui.history_pool.waitForDone()
+            QApplication.processEvents()
+        
+        model = self.gui.timeline_model
+        timeline = self.gui.room_timelines['!testroom:matrix.org']
+        self.assertLess(model.rowCount(), 15)
+        # Scrolling prefetches pages as well, so only check the newest ones were released
+        self.assertLessEqual(int(model.message(0)['event_id'][len('$event'):]), 75)
+        self.assertNotEqual(model.message(model.rowCount() - 1)['event_id'], '$event99')
+        self.assertTrue(timeline.has_newer)
+        
+        # New messages aren't shown below the gap, they are reloaded from the store with the rest
+        self.gui.handle_message(self.make_event(100))
+        self.assertFalse(model.has_event('$event100'))
+        
+        newest = int(model.message(model.rowCount() - 1)['event_id'][len('$event'):])
+        self.mock_client.get_newer_room_messages.return_value = [self.make_event(i) for i in range(newest + 1, 101)]
+        QApplication.processEvents()
+        scrollbar = self.gui.timeline_view.verticalScrollBar()
+        scrollbar.setValue(scrollbar.maximum())
+        
+        self.mock_client.get_newer_room_messages.assert_called_with('!testroom:matrix.org', f'$event{newest}', 5)
+        self.assertTrue(model.has_event('$event100'))
+        self.assertFalse(timeline.has_newer)
+        
     def test_load_more_messages(self):
         """Test loading more messages"""
-        self.gui.current_room = '!testroom:matrix.org'
-        self.gui.last_message_token = 'test_token'
-        
-        self.mock_client.get_room_messages.return_value = [
+        self.mock_client.iter_room_history.return_value = iter([
             {
                 'sender': '@testuser:matrix.org',
                 'content': {
                     'msgtype': 'm.text',
-                    'body': 'Older message'
+                    'body': 'Older message' if i == 50 else f'Message {i}'
                 },
-                'origin_server_ts': 1234567890
+                'origin_server_ts': 1234567890 + i
             }
-        ]
+            for i in range(51)
+        ])
+        self.gui.room_selected(QListWidgetItem('!testroom:matrix.org'))
+        self.wait_for_history()
         
         self.gui.load_more_messages()
+        self.gui.history_pool.waitForDone()
+        QApplication.processEvents()
+        
+        # Check if older messages were loaded above the others
+        self.assertTrue(self.timeline_text().startswith('@testuser:matrix.org: Older message\n'))
+        
+        # The history is exhausted, so there is nothing more to load
+        self.assertFalse(self.gui.room_timelines['!testroom:matrix.org'].has_more)
         
-        # Check if older messages were loaded
-        self.assertIn('Older message', self.gui.chat_display.toPlainText())
+    def test_scrolling_up_loads_history(self):
+        """Test nearing the oldest message loads older history in the background"""
+        self.mock_client.iter_room_history.return_value = iter(self.make_history('!testroom:matrix.org', 500))
+        self.gui.resize(400, 300)
+        self.gui.show()
+        self.gui.room_selected(QListWidgetItem('!testroom:matrix.org'))
+        self.wait_for_history()
+        QApplication.processEvents()
+        self.assertEqual(self.gui.timeline_model.rowCount(), 50)
+        
+        # Scroll up to the oldest message but one, the page is added above without moving the view
+        scrollbar = self.gui.timeline_view.verticalScrollBar()
+        scrollbar.setValue(1)
+        first = self.gui.timeline_model.message(1)
+        self.gui.history_pool.waitForDone()
+        QApplication.processEvents()
+        
+        self.assertEqual(self.gui.timeline_model.rowCount(), 100)
+        self.assertEqual(scrollbar.value(), 51)
+        self.assertIs(self.gui.timeline_model.message(scrollbar.value()), first)
         
     def test_format_timestamp(self):
         """Test timestamp formatting"""
@@ -147,20 +767,6 @@ class TestMatrixGUI(unittest.TestCase):
         # Check if timestamp was formatted correctly
         self.assertIn('2009', formatted)  # Year should be 2009
         self.assertIn(':', formatted)     # Should contain time separator
-        
-    def test_pixmap_to_base64(self):
-        """Test converting pixmap to base64"""
-        # Create a test image
-        image = QImage(100, 100, QImage.Format_RGB32)
-        image.fill(Qt.blue)
-        pixmap = QPixmap.fromImage(image)
-        
-        # Convert to base64
-        base64_str = self.gui.pixmap_to_base64(pixmap)
-        
-        # Check if conversion was successful
-        self.assertTrue(base64_str.startswith('iVBOR'))
-        self.assertTrue(len(base64_str) > 0)
 
 if __name__ == '__main__':
     unittest.main() 
\ No newline at end of file
@@ -0,0 +1,50 @@
+import unittest
+import json
+from unittest.mock import patch
+import matrix_json
+from matrix_json import JsonCodec, available_codecs, get_codec
+from matrix_store import EventStore
+
+EVENT = {
+    'type': 'm.room.message',
+    'sender': '@testuser:matrix.org',
+    'content': {'msgtype': 'm.text', 'body': 'Grüße 👋'},
+    'event_id': '$event1',
+    'origin_server_ts': 1234567890000
+}
+
+class TestJsonCodec(unittest.TestCase):
+    def test_round_trip(self):
+        """Test every installed codec decodes bytes and text and encodes to text"""
+        for name in available_codecs():
+            with self.subTest(codec=name):
+                codec = get_codec(name)
+                encoded = codec.dumps(EVENT)
+                self.assertIsInstance(encoded, str)
+                self.assertEqual(json.loads(encoded), EVENT)
+                self.assertEqual(codec.loads(encoded), EVENT)
+                self.assertEqual(codec.loads(json.dumps(EVENT).encode('utf-8')), EVENT)
+
+    def test_fallback_without_orjson(self):
+        """Test the standard library codec is used when orjson isn't installed"""
+        with patch.object(matrix_json, 'orjson', None):
+            self.assertEqual(available_codecs(), ['json'])
+            self.assertEqual(get_codec().name, 'json')
+            with self.assertRaises(ValueError):
+                get_codec('orjson')
+
+    def test_unknown_codec(self):
+        """Test asking for an unknown codec fails"""
+        with self.assertRaises(ValueError):
+            get_codec('yaml')
+
+    def test_store_codecs_compatible(self):
+        """Test events stored with one codec are read back by the other"""
+        store = EventStore(codec=get_codec())
+        store.add_timeline('!testroom:matrix.org', [EVENT])
+        store.codec = JsonCodec()
+        self.assertEqual(store.get_event('$event1'), EVENT)
+        store.close()
+
+if __name__ == '__main__':
+    unittest.main()
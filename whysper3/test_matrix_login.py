@@ -0,0 +1,578 @@
+import unittest
+from unittest.mock import MagicMock, patch
+import os
+import json
+import shutil
+import tempfile
+import threading
+import requests
+from matrix_login import MatrixLogin, HistoryPageError, HISTORY_PAGE_RETRIES, serialise_filter
+from matrix_sync import DEFAULT_SYNC_FILTER
+from matrix_media import MediaCache
+from PIL import Image
+
+
+class TestSession(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.client = MatrixLogin('https://matrix.org', data_dir=self.data_dir)
+        self.client.access_token = 'token'
+        self.client.user_id = '@testuser:matrix.org'
+        self.client.device_id = 'DEVICE'
+        self.client.sync_filter_id = '7'
+        self.client.sync_filter = serialise_filter(DEFAULT_SYNC_FILTER)
+        self.client.joined_rooms = ['!testroom:matrix.org']
+        self.client.sync_engine.next_batch = 's42'
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def test_save_and_resume_session(self):
+        """Test that a saved session resumes with its sync token"""
+        self.assertTrue(self.client.save_session())
+
+        resumed = MatrixLogin.from_session(self.data_dir)
+
+        self.assertIsNotNone(resumed)
+        self.assertEqual(resumed.homeserver_url, 'https://matrix.org')
+        self.assertEqual(resumed.access_token, 'token')
+        self.assertEqual(resumed.device_id, 'DEVICE')
+        self.assertEqual(resumed.sync_filter_id, '7')
+        self.assertEqual(resumed.joined_rooms, ['!testroom:matrix.org'])
+        self.assertEqual(resumed.sync_engine.next_batch, 's42')
+
+    def test_resumed_session_syncs_incrementally(self):
+        """Test that the first sync after resuming sends the saved token"""
+        self.client.save_session()
+        resumed = MatrixLogin.from_session(self.data_dir)
+        response = MagicMock(status_code=200, content=json.dumps({'next_batch': 's43'}).encode())
+        resumed.session.get = MagicMock(return_value=response)
+        resumed.session.post = MagicMock()
+
+        resumed.sync_engine.sync_once()
+
+        params = resumed.session.get.call_args[1]['params']
+        self.assertEqual(params['since'], 's42')
+        self.assertEqual(params['filter'], '7')
+        resumed.session.post.assert_not_called()
+        with open(os.path.join(self.data_dir, 'session.json')) as file:
+            self.assertEqual(json.load(file)['next_batch'], 's43')
+
+    @patch.dict('matrix_login._filter_id_cache', clear=True)
+    def test_changed_filter_uploaded_again(self):
+        """Test that a filter ID saved for another filter definition isn't resumed"""
+        self.client.sync_filter = serialise_filter({'room': {'timeline': {'limit': 1}}})
+        self.client.save_session()
+        resumed = MatrixLogin.from_session(self.data_dir)
+        response = MagicMock(status_code=200, content=json.dumps({'next_batch': 's43'}).encode())
+        resumed.session.get = MagicMock(return_value=response)
+        resumed.session.post = MagicMock(return_value=MagicMock(status_code=200, json=lambda: {'filter_id': '8'}))
+
+        self.assertIsNone(resumed.sync_filter_id)
+        resumed.sync_engine.sync_once()
+
+        self.assertEqual(resumed.session.get.call_args[1]['params']['filter'], '8')
+        self.assertEqual(resumed.session.post.call_args[1]['json'], DEFAULT_SYNC_FILTER)
+        resumed = MatrixLogin.from_session(self.data_dir)
+        self.assertEqual(resumed.sync_filter_id, '8')
+
+    def test_rejected_token_clears_session(self):
+        """Test that a revoked access token removes the snapshot"""
+        self.client.save_session()
+        self.client.session.get = MagicMock(return_value=MagicMock(status_code=401))
+
+        self.assertIsNone(self.client.sync_engine.sync_once())
+        self.assertIsNone(MatrixLogin.from_session(self.data_dir))
+
+    def test_concurrent_saves(self):
+        """Test that saving from several threads at once always leaves a complete snapshot"""
+        results = []
+
+        def save():
+            results.extend(self.client.save_session() for _ in range(50))
+        threads = [threading.Thread(target=save) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertTrue(all(results))
+        self.assertEqual(MatrixLogin.from_session(self.data_dir).access_token, 'token')
+
+    def test_no_session(self):
+        """Test that there is nothing to resume in an empty data directory"""
+        self.assertIsNone(MatrixLogin.from_session(self.data_dir))
+
+
+def make_event(index, room_id='!testroom:matrix.org'):
+    return {
+        'type': 'm.room.message',
+        'sender': '@testuser:matrix.org',
+        'content': {'msgtype': 'm.text', 'body': f'Message {index}'},
+        'event_id': f'$event{index}',
+        'origin_server_ts': 1234567890000 + index
+    }
+
+
+class TestRoomMessages(unittest.TestCase):
+    def setUp(self):
+        self.client = MatrixLogin('https://matrix.org')
+        self.client.access_token = 'token'
+        self.client.user_id = '@testuser:matrix.org'
+        self.room_id = '!testroom:matrix.org'
+        # Stored events are only trusted once a sync of the session has been dispatched
+        self.client.sync_engine.synced = True
+
+    def mock_messages_response(self, events, end):
+        response = MagicMock(status_code=200)
+        response.content = json.dumps({'chunk': events, 'start': 't0', 'end': end}).encode()
+        self.client.session.get = MagicMock(return_value=response)
+
+    def test_reopening_room_served_from_store(self):
+        """Test that a room's first page is only fetched once"""
+        self.mock_messages_response([make_event(i) for i in range(9, -1, -1)], 't1')
+
+        first = self.client.get_room_messages(self.room_id, limit=10)
+        second = self.client.get_room_messages(self.room_id, limit=10)
+
+        self.assertEqual(self.client.session.get.call_count, 1)
+        self.assertEqual([m['event_id'] for m in first], [m['event_id'] for m in second])
+        self.assertEqual(second[0]['event_id'], '$event9')
+        self.assertEqual(second[0]['room_id'], self.room_id)
+
+    def test_newest_page_fetched_before_first_sync(self):
+        """Test that the newest page comes from the homeserver while stored events may be stale"""
+        store = self.client.get_event_store()
+        store.add_timeline(self.room_id, [make_event(i) for i in range(5)], prev_batch='p0')
+        self.client.sync_engine.synced = False
+        self.mock_messages_response([make_event(i) for i in range(20, 15, -1)], 't16')
+
+        page = self.client.get_room_messages_page(self.room_id, limit=5)
+
+        self.assertNotIn('from', self.client.session.get.call_args[1]['params'])
+        self.assertEqual([e.event_id for e in page['chunk']], [f'$event{i}' for i in range(20, 15, -1)])
+        # Stored above the old events, with the gap between them left to fill
+        self.assertEqual(store.get_gap(self.room_id)[1], 't16')
+        self.assertIsNotNone(store.get_event('$event0'))
+
+        self.client.sync_engine.synced = True
+        self.client.get_room_messages_page(self.room_id, limit=5)
+        self.assertEqual(self.client.session.get.call_count, 1)
+
+    def test_gap_below_store_is_fetched(self):
+        """Test that only the missing older events are fetched"""
+        store = self.client.get_event_store()
+        store.add_timeline(self.room_id, [make_event(i) for i in range(10, 15)], prev_batch='p1')
+        self.mock_messages_response([make_event(i) for i in range(9, 4, -1)], 't2')
+
+        messages = self.client.get_room_messages(self.room_id, limit=10)
+
+        params = self.client.session.get.call_args[1]['params']
+        self.assertEqual(params['from'], 'p1')
+        self.assertEqual(params['limit'], 5)
+        self.assertEqual([m['event_id'] for m in messages], [f'$event{i}' for i in range(14, 4, -1)])
+        self.assertEqual(store.get_room(self.room_id)[2], 't2')
+
+    def test_limited_sync_keeps_stored_events(self):
+        """Test that a gap in the sync timeline is filled by paging instead of dropping the stored span"""
+        store = self.client.get_event_store()
+        store.add_timeline(self.room_id, [make_event(i) for i in range(1, 6)], prev_batch='p1')
+        store.add_timeline(self.room_id, [make_event(i) for i in range(20, 23)], prev_batch='p20', limited=True)
+        pages = {
+            'p20': {'chunk': [make_event(i) for i in range(19, 12, -1)], 'end': 'p13'},
+            'p13': {'chunk': [make_event(i) for i in range(12, 2, -1)], 'end': 'p3'},
+            'p1': {'chunk': [make_event(0)], 'end': None}
+        }
+
+        def get(url, params):
+            return MagicMock(status_code=200, content=json.dumps(pages[params.get('from')]).encode())
+        self.client.session.get = MagicMock(side_effect=get)
+
+        self.assertEqual([event['event_id'] for _, event in store.get_events(self.room_id, 10)],
+                         ['$event22', '$event21', '$event20'])
+        self.assertIsNotNone(store.get_event('$event1'))
+        self.assertEqual(store.get_room(self.room_id)[2], 'p1')
+        # Newer events can't be continued from across the gap
+        self.assertIsNone(self.client.get_newer_room_messages(self.room_id, '$event5'))
+
+        events = list(self.client.iter_room_history(self.room_id, page_size=10))
+
+        self.assertEqual([e['event_id'] for e in events], [f'$event{i}' for i in range(22, -1, -1)])
+        froms = [call[1]['params'].get('from') for call in self.client.session.get.call_args_list]
+        self.assertEqual(froms, ['p20', 'p13', 'p1'])
+        self.assertIsNone(store.get_gap(self.room_id))
+        self.assertEqual(len(self.client.get_newer_room_messages(self.room_id, '$event5')), 17)
+
+    def test_history_pages_with_tokens(self):
+        """Test that history is paged with the 'end' tokens of the previous pages"""
+        pages = {
+            None: {'chunk': [make_event(i) for i in range(29, 19, -1)], 'end': 't1'},
+            't1': {'chunk': [make_event(i) for i in range(19, 9, -1)], 'end': 't2'},
+            't2': {'chunk': [make_event(i) for i in range(9, -1, -1)], 'end': None}
+        }
+
+        def get(url, params):
+            response = MagicMock(status_code=200, content=json.dumps(pages[params.get('from')]).encode())
+            return response
+        self.client.session.get = MagicMock(side_effect=get)
+
+        events = list(self.client.iter_room_history(self.room_id, page_size=10))
+
+        self.assertEqual([e['event_id'] for e in events], [f'$event{i}' for i in range(29, -1, -1)])
+        froms = [call[1]['params'].get('from') for call in self.client.session.get.call_args_list]
+        self.assertEqual(froms, [None, 't1', 't2'])
+        self.assertIsNone(self.client.pagination_tokens[self.room_id]['end'])
+
+        # Scrolling through the same history again is served from the store
+        again = list(self.client.iter_room_history(self.room_id, page_size=10))
+        self.assertEqual([e['event_id'] for e in again], [e['event_id'] for e in events])
+        self.assertEqual(self.client.session.get.call_count, 3)
+
+    @patch('matrix_login.time.sleep')
+    def test_failed_history_page_retried(self, sleep):
+        """Test that a failed page is fetched again instead of ending the history"""
+        first = {'chunk': [make_event(i) for i in range(99, 49, -1)], 'start': None, 'end': 't1'}
+        second = {'chunk': [make_event(i) for i in range(49, -1, -1)], 'start': 't1', 'end': None}
+        self.client.get_room_messages_page = MagicMock(side_effect=[first, None, second])
+
+        events = list(self.client.iter_room_history(self.room_id, page_size=50))
+
+        self.assertEqual(len(events), 100)
+        froms = [call[0][2] for call in self.client.get_room_messages_page.call_args_list]
+        self.assertEqual(froms, [None, 't1', 't1'])
+        sleep.assert_called_once()
+
+    @patch('matrix_login.time.sleep')
+    def test_failing_history_raises(self, sleep):
+        """Test that history that keeps failing raises with the token to resume from"""
+        first = {'chunk': [make_event(i) for i in range(99, 49, -1)], 'start': None, 'end': 't1'}
+        self.client.get_room_messages_page = MagicMock(side_effect=[first] + [None] * (HISTORY_PAGE_RETRIES + 1))
+
+        history = self.client.iter_room_history(self.room_id, page_size=50)
+        events = [next(history) for _ in range(50)]
+        with self.assertRaises(HistoryPageError) as raised:
+            next(history)
+
+        self.assertEqual(events[-1]['event_id'], '$event50')
+        self.assertEqual(raised.exception.from_token, 't1')
+        self.assertEqual(sleep.call_count, HISTORY_PAGE_RETRIES)
+
+    def test_page_returns_end_token(self):
+        """Test that a page hands out the token to continue from"""
+        self.mock_messages_response([make_event(i) for i in range(9, -1, -1)], 't1')
+
+        page = self.client.get_room_messages_page(self.room_id, limit=10)
+        self.mock_messages_response([make_event(i) for i in range(-1, -6, -1)], None)
+        next_page = self.client.get_room_messages_page(self.room_id, limit=10, from_token=page['end'])
+
+        self.assertIsNotNone(page['end'])
+        self.assertEqual(self.client.session.get.call_args[1]['params']['from'], 't1')
+        self.assertEqual([e['event_id'] for e in next_page['chunk']], [f'$event{i}' for i in range(-1, -6, -1)])
+        self.assertIsNone(next_page['end'])
+
+
+    def test_reload_released_events(self):
+        """Test that events released by the GUI can be reloaded around a stored event"""
+        store = self.client.get_event_store()
+        store.add_timeline(self.room_id, [make_event(i) for i in range(20)], prev_batch='p1')
+        self.client.session.get = MagicMock()
+
+        newer = self.client.get_newer_room_messages(self.room_id, '$event9', limit=5)
+        token = self.client.get_history_token(self.room_id, '$event10')
+        older = self.client.get_room_messages(self.room_id, limit=5, since=token)
+
+        self.assertEqual([e['event_id'] for e in newer], [f'$event{i}' for i in range(10, 15)])
+        self.assertEqual(newer[0]['room_id'], self.room_id)
+        self.assertEqual([e['event_id'] for e in older], [f'$event{i}' for i in range(9, 4, -1)])
+        self.client.session.get.assert_not_called()
+
+        # Events that aren't stored can't be continued from
+        self.assertIsNone(self.client.get_newer_room_messages(self.room_id, '$unknown'))
+        self.assertIsNone(self.client.get_history_token(self.room_id, '$unknown'))
+
+class TestMediaCache(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def test_memory_budget_evicts_least_recently_used(self):
+        """Test that the memory tier stays within its byte budget"""
+        cache = MediaCache(memory_budget=10)
+        cache.put('mxc://test.com/a', b'aaaa')
+        cache.put('mxc://test.com/b', b'bbbb')
+        cache.get('mxc://test.com/a')
+        cache.put('mxc://test.com/c', b'cccc')
+
+        self.assertEqual(cache.memory_size, 8)
+        self.assertIsNone(cache.get('mxc://test.com/b'))
+        self.assertEqual(cache.get('mxc://test.com/a'), b'aaaa')
+
+    def test_disk_tier(self):
+        """Test that evicted media is still served from disk within the disk budget"""
+        cache = MediaCache(memory_budget=10, disk_dir=self.data_dir, disk_budget=10)
+        cache.put('mxc://test.com/a', b'aaaa')
+        cache.clear()
+
+        self.assertEqual(cache.get('mxc://test.com/a'), b'aaaa')
+
+        cache.put('mxc://test.com/b', b'bbbb')
+        cache.put('mxc://test.com/c', b'cccc')
+        self.assertLessEqual(cache.disk_size, 10)
+
+    def test_download_media_uses_cache(self):
+        """Test that repeat downloads of the same media don't touch the network"""
+        client = MatrixLogin('https://matrix.org', data_dir=self.data_dir)
+        client.access_token = 'token'
+        client.session.get = MagicMock(return_value=MagicMock(status_code=200, content=b'image'))
+
+        self.assertEqual(client.download_media('mxc://test.com/image'), b'image')
+        self.assertEqual(client.download_media('mxc://test.com/image'), b'image')
+
+        # A new client for the same data directory finds it on disk
+        other = MatrixLogin('https://matrix.org', data_dir=self.data_dir)
+        other.access_token = 'token'
+        other.session.get = MagicMock()
+        self.assertEqual(other.download_media('mxc://test.com/image'), b'image')
+
+        self.assertEqual(client.session.get.call_count, 1)
+        other.session.get.assert_not_called()
+
+    def test_client_uses_given_cache(self):
+        """Test that a client can be given a cache with its own budgets"""
+        cache = MediaCache(memory_budget=4)
+        client = MatrixLogin('https://matrix.org', data_dir=self.data_dir, media_cache=cache)
+        client.access_token = 'token'
+        client.session.get = MagicMock(return_value=MagicMock(status_code=200, content=b'image'))
+
+        self.assertEqual(client.download_media('mxc://test.com/image'), b'image')
+
+        self.assertIs(client.media_cache, cache)
+        # Larger than the memory budget and there is no disk tier
+        self.assertNotIn('mxc://test.com/image', cache)
+
+    def test_download_thumbnail(self):
+        """Test that thumbnails are requested at the preview size and cached"""
+        client = MatrixLogin('https://matrix.org')
+        client.access_token = 'token'
+        client.session.get = MagicMock(return_value=MagicMock(status_code=200, content=b'thumb'))
+
+        self.assertEqual(client.download_thumbnail('mxc://test.com/image', 300, 300), b'thumb')
+        self.assertEqual(client.download_thumbnail('mxc://test.com/image', 300, 300), b'thumb')
+
+        url = client.session.get.call_args[0][0]
+        params = client.session.get.call_args[1]['params']
+        self.assertEqual(url, 'https://matrix.org/_matrix/media/r0/thumbnail/test.com/image')
+        self.assertEqual(params, {'width': 300, 'height': 300, 'method': 'scale'})
+        self.assertEqual(client.session.get.call_count, 1)
+        self.assertIsNone(client.media_cache.get('mxc://test.com/image'))
+
+
+def make_stream_response(status_code, chunks, headers):
+    response = MagicMock(status_code=status_code, headers=headers)
+    response.__enter__.return_value = response
+
+    def iter_content(chunk_size):
+        for chunk in chunks:
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    response.iter_content.side_effect = iter_content
+    return response
+
+
+class TestStreamingDownload(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.client = MatrixLogin('https://matrix.org')
+        self.client.access_token = 'token'
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def test_iter_media_yields_chunks(self):
+        """Test that media is streamed in chunks"""
+        self.client.session.get = MagicMock(return_value=make_stream_response(
+            200, [b'abc', b'def'], {'Content-Length': '6'}))
+
+        chunks = list(self.client.iter_media('mxc://test.com/file', chunk_size=3))
+
+        self.assertEqual(chunks, [b'abc', b'def'])
+        self.assertTrue(self.client.session.get.call_args[1]['stream'])
+
+    @patch('matrix_login.time.sleep')
+    def test_download_resumes_with_range(self, sleep):
+        """Test that an interrupted download resumes where it stopped"""
+        self.client.session.get = MagicMock(side_effect=[
+            make_stream_response(200, [b'abc', requests.exceptions.ChunkedEncodingError('reset')],
+                                 {'Content-Length': '6'}),
+            make_stream_response(206, [b'def'], {'Content-Range': 'bytes 3-5/6'})
+        ])
+        progress = []
+        path = os.path.join(self.data_dir, 'file.bin')
+
+        result = self.client.download_media_to_file('mxc://test.com/file', path,
+                                                    lambda done, total: progress.append((done, total)))
+
+        self.assertTrue(result)
+        with open(path, 'rb') as file:
+            self.assertEqual(file.read(), b'abcdef')
+        self.assertFalse(os.path.exists(path + '.part'))
+        self.assertEqual(self.client.session.get.call_args[1]['headers']['Range'], 'bytes=3-')
+        self.assertEqual(progress, [(3, 6), (6, 6)])
+
+    def test_complete_partial_file_is_renamed(self):
+        """Test that a partial file holding the whole media is renamed instead of failing on 416"""
+        path = os.path.join(self.data_dir, 'file.bin')
+        with open(path + '.part', 'wb') as file:
+            file.write(b'abcdef')
+        self.client.session.get = MagicMock(return_value=make_stream_response(
+            416, [], {'Content-Range': 'bytes */6'}))
+
+        self.assertTrue(self.client.download_media_to_file('mxc://test.com/file', path))
+
+        with open(path, 'rb') as file:
+            self.assertEqual(file.read(), b'abcdef')
+        self.assertFalse(os.path.exists(path + '.part'))
+        self.assertEqual(self.client.session.get.call_args[1]['headers']['Range'], 'bytes=6-')
+
+
+class TestSendQueue(unittest.TestCase):
+    def setUp(self):
+        self.client = MatrixLogin('https://matrix.org')
+        self.client.access_token = 'token'
+
+    def mock_put(self, *responses):
+        def make(status_code, data):
+            response = MagicMock(status_code=status_code, text='')
+            response.json.return_value = data
+            return response
+        self.client.session.put = MagicMock(side_effect=[make(*r) for r in responses])
+
+    def test_transaction_ids_are_unique(self):
+        """Test that messages queued in the same millisecond get different transaction IDs"""
+        self.mock_put(*[(200, {'event_id': f'$e{i}'}) for i in range(20)])
+
+        futures = [self.client.queue_message('!testroom:matrix.org', f'Message {i}') for i in range(20)]
+        results = [future.result() for future in futures]
+
+        self.assertEqual(len({future.txn_id for future in futures}), 20)
+        self.assertEqual(results, [{'event_id': f'$e{i}'} for i in range(20)])
+
+    def test_room_order_is_preserved(self):
+        """Test that messages to a room are sent in the order they were queued"""
+        self.mock_put(*[(200, {'event_id': f'$e{i}'}) for i in range(10)])
+
+        futures = [self.client.queue_message('!testroom:matrix.org', f'Message {i}') for i in range(10)]
+        for future in futures:
+            future.result()
+
+        bodies = [call[1]['json']['body'] for call in self.client.session.put.call_args_list]
+        self.assertEqual(bodies, [f'Message {i}' for i in range(10)])
+
+    @patch('matrix_send.time.sleep')
+    def test_rate_limit_retries_with_same_transaction(self, sleep):
+        """Test that a rate limited send waits retry_after_ms and reuses its transaction ID"""
+        self.mock_put((429, {'errcode': 'M_LIMIT_EXCEEDED', 'retry_after_ms': 1500}),
+                      (200, {'event_id': '$sent'}))
+
+        result = self.client.send_message('!testroom:matrix.org', 'Hello')
+
+        self.assertEqual(result, {'event_id': '$sent'})
+        urls = [call[0][0] for call in self.client.session.put.call_args_list]
+        self.assertEqual(len(urls), 2)
+        self.assertEqual(urls[0], urls[1])
+        self.assertAlmostEqual(sleep.call_args[0][0], 1.5, places=1)
+
+    @patch('matrix_send.time.sleep')
+    def test_rate_limits_do_not_use_up_retries(self, sleep):
+        """Test that an event is sent however often it is rate limited, while server errors give up"""
+        self.mock_put(*[(429, {'errcode': 'M_LIMIT_EXCEEDED', 'retry_after_ms': 100})] * 8,
+                      (200, {'event_id': '$sent'}))
+
+        self.assertEqual(self.client.send_message('!testroom:matrix.org', 'Hello'), {'event_id': '$sent'})
+        self.assertEqual(self.client.session.put.call_count, 9)
+
+        self.mock_put(*[(500, {})] * 6)
+        self.assertIsNone(self.client.send_message('!testroom:matrix.org', 'Hello'))
+        self.assertEqual(self.client.session.put.call_count, 6)
+
+
+
+class TestSendImage(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.client = MatrixLogin('https://matrix.org')
+        self.client.access_token = 'token'
+        self.uploads = []
+
+        def post(url, params, data, headers):
+            self.uploads.append((params['filename'], headers['Content-Type'], data))
+            response = MagicMock(status_code=200)
+            response.json.return_value = {'content_uri': f"mxc://matrix.org/{params['filename']}"}
+            return response
+        self.client.session.post = MagicMock(side_effect=post)
+        put_response = MagicMock(status_code=200)
+        put_response.json.return_value = {'event_id': '$image'}
+        self.client.session.put = MagicMock(return_value=put_response)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def save_image(self, name, width, height):
+        path = os.path.join(self.temp_dir, name)
+        Image.effect_noise((width, height), 64).convert('RGB').save(path, quality=95)
+        return path
+
+    def sent_content(self):
+        return self.client.session.put.call_args[1]['json']
+
+    def test_large_image_downscaled_with_thumbnail(self):
+        """Test a camera-sized photo is downscaled and sent with a thumbnail and dimensions"""
+        path = self.save_image('photo.jpg', 2600, 1950)
+
+        self.assertEqual(self.client.send_image('!testroom:matrix.org', path), {'event_id': '$image'})
+
+        uploads = {name: (mime_type, data) for name, mime_type, data in self.uploads}
+        self.assertEqual(set(uploads), {'photo.jpg', 'thumbnail-photo.jpg'})
+        info = self.sent_content()['info']
+        self.assertEqual((info['w'], info['h']), (2048, 1536))
+        self.assertEqual(info['mimetype'], 'image/jpeg')
+        self.assertEqual(info['size'], len(uploads['photo.jpg'][1]))
+        self.assertLess(info['size'], os.path.getsize(path))
+        self.assertEqual(self.sent_content()['url'], 'mxc://matrix.org/photo.jpg')
+        self.assertEqual(info['thumbnail_url'], 'mxc://matrix.org/thumbnail-photo.jpg')
+        thumbnail_info = info['thumbnail_info']
+        self.assertEqual((thumbnail_info['w'], thumbnail_info['h']), (800, 600))
+        self.assertEqual(thumbnail_info['size'], len(uploads['thumbnail-photo.jpg'][1]))
+
+    def test_small_image_sent_unchanged(self):
+        """Test a small image is sent as it is, without a thumbnail"""
+        path = self.save_image('small.png', 200, 100)
+        with open(path, 'rb') as file:
+            original = file.read()
+
+        self.client.send_image('!testroom:matrix.org', path)
+
+        self.assertEqual(self.uploads, [('small.png', 'image/png', original)])
+        info = self.sent_content()['info']
+        self.assertEqual(info, {'mimetype': 'image/png', 'size': len(original), 'w': 200, 'h': 100})
+
+    def test_downscale_disabled(self):
+        """Test the original is uploaded when downscaling is turned off"""
+        path = self.save_image('photo.jpg', 3000, 1000)
+        with open(path, 'rb') as file:
+            original = file.read()
+
+        self.client.send_image('!testroom:matrix.org', path, downscale=False)
+
+        uploads = {name: data for name, _, data in self.uploads}
+        self.assertEqual(uploads['photo.jpg'], original)
+        info = self.sent_content()['info']
+        self.assertEqual((info['w'], info['h']), (3000, 1000))
+        self.assertIn('thumbnail_url', info)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,275 @@
+import unittest
+import json
+from unittest.mock import MagicMock, patch
+import threading
+from matrix_login import MatrixLogin
+from matrix_sync import MessageQueue, OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST
+
+SYNC_RESPONSE = {
+    'next_batch': 's2',
+    'rooms': {
+        'join': {
+            '!a:matrix.org': {
+                'timeline': {
+                    'events': [
+                        {
+                            'type': 'm.room.message',
+                            'sender': '@alice:matrix.org',
+                            'content': {'msgtype': 'm.text', 'body': 'Hello A'},
+                            'event_id': '$a1',
+                            'origin_server_ts': 1234567890000,
+                            'unsigned': {'transaction_id': 'txn1'}
+                        }
+                    ]
+                }
+            },
+            '!b:matrix.org': {
+                'timeline': {
+                    'events': [
+                        {
+                            'type': 'm.room.message',
+                            'sender': '@bob:matrix.org',
+                            'content': {'msgtype': 'm.text', 'body': 'Hello B'},
+                            'event_id': '$b1',
+                            'origin_server_ts': 1234567890000
+                        }
+                    ]
+                }
+            }
+        }
+    }
+}
+
+
+class TestSyncEngine(unittest.TestCase):
+    def setUp(self):
+        self.client = MatrixLogin('https://matrix.org')
+        self.client.access_token = 'token'
+        self.engine = self.client.sync_engine
+
+    def test_dispatch_to_room_subscribers(self):
+        """Test that events only reach the subscribers of their room"""
+        received_a = []
+        received_b = []
+        self.engine.subscribe('!a:matrix.org', received_a.append)
+        self.engine.subscribe('!b:matrix.org', received_b.append)
+
+        self.engine.dispatch(SYNC_RESPONSE)
+
+        self.assertEqual([m['event_id'] for m in received_a], ['$a1'])
+        self.assertEqual([m['event_id'] for m in received_b], ['$b1'])
+        # Our own events carry the transaction ID they were sent with
+        self.assertEqual(received_a[0]['unsigned'], {'transaction_id': 'txn1'})
+
+    def test_unsubscribe(self):
+        """Test that unsubscribed callbacks receive nothing"""
+        received = []
+        self.engine.subscribe('!a:matrix.org', received.append)
+        self.engine.unsubscribe('!a:matrix.org', received.append)
+
+        self.engine.dispatch(SYNC_RESPONSE)
+
+        self.assertEqual(received, [])
+        self.assertNotIn('!a:matrix.org', self.engine.subscribers)
+
+    def test_listening_to_many_rooms_uses_one_sync_loop(self):
+        """Test that start_listening reuses the running sync loop"""
+        with patch('matrix_sync.threading.Thread') as thread_class:
+            thread_class.return_value.is_alive.return_value = True
+
+            self.client.start_listening('!a:matrix.org', lambda m: None)
+            self.client.start_listening('!b:matrix.org', lambda m: None)
+            self.client.start_listening('!c:matrix.org', lambda m: None)
+
+        self.assertEqual(thread_class.call_count, 1)
+        self.assertEqual(len(self.engine.subscribers), 3)
+
+    def test_restart_while_stopping(self):
+        """Test that listening again while the stopped loop waits on its long-poll starts a new loop"""
+        release = threading.Event()
+        started = []
+
+        def sync_once(stop_event=None):
+            started.append(stop_event)
+            release.wait(5)
+        self.engine.sync_once = sync_once
+
+        self.engine.start()
+        old_thread = self.engine.thread
+        self.engine.stop()
+        self.engine.start()
+        new_thread = self.engine.thread
+        release.set()
+        old_thread.join(5)
+
+        self.assertIsNot(new_thread, old_thread)
+        self.assertFalse(old_thread.is_alive())
+        self.assertTrue(self.engine.is_running())
+        self.assertFalse(self.engine.stop_event.is_set())
+        self.engine.stop()
+        new_thread.join(5)
+
+    def test_sync_once_advances_next_batch(self):
+        """Test that the engine tracks next_batch between syncs"""
+        response = MagicMock(status_code=200)
+        response.content = json.dumps(SYNC_RESPONSE).encode()
+        self.client.session.get = MagicMock(return_value=response)
+
+        self.client.sync_filter_id = '1'
+        self.engine.next_batch = 's1'
+        self.engine.sync_once()
+
+        params = self.client.session.get.call_args[1]['params']
+        self.assertEqual(params['since'], 's1')
+        self.assertEqual(self.engine.next_batch, 's2')
+
+    def test_next_batch_advanced_after_dispatch(self):
+        """Test that next_batch only moves on once the batch is stored and delivered"""
+        response = MagicMock(status_code=200)
+        response.content = json.dumps(SYNC_RESPONSE).encode()
+        self.client.session.get = MagicMock(return_value=response)
+        self.client.sync_filter_id = '1'
+        self.engine.next_batch = 's1'
+        tokens = []
+        self.engine.subscribe('!a:matrix.org', lambda message: tokens.append(self.engine.next_batch))
+
+        self.engine.sync_once()
+
+        self.assertEqual(tokens, ['s1'])
+        self.assertIsNotNone(self.client.get_event_store().get_event('$a1'))
+        self.assertEqual(self.engine.next_batch, 's2')
+
+    def test_stopped_sync_not_advanced(self):
+        """Test that a response arriving after stop is dropped without advancing next_batch"""
+        stop_event = threading.Event()
+        response = MagicMock(status_code=200)
+        response.content = json.dumps(SYNC_RESPONSE).encode()
+
+        def get(url, params=None):
+            stop_event.set()
+            return response
+        self.client.session.get = MagicMock(side_effect=get)
+        self.client.sync_filter_id = '1'
+        self.engine.next_batch = 's1'
+        received = []
+        self.engine.subscribe('!a:matrix.org', received.append)
+
+        self.assertIsNone(self.engine.sync_once(stop_event=stop_event))
+
+        self.assertEqual(self.engine.next_batch, 's1')
+        self.assertEqual(received, [])
+        self.assertIsNone(self.client.get_event_store().get_event('$a1'))
+
+    def test_sync_filter_uploaded_once(self):
+        """Test that the sync filter is uploaded once and its ID reused"""
+        self.client.user_id = '@filtertest:matrix.org'
+        upload = MagicMock(status_code=200)
+        upload.json.return_value = {'filter_id': '42'}
+        self.client.session.post = MagicMock(return_value=upload)
+        response = MagicMock(status_code=200)
+        response.content = json.dumps(SYNC_RESPONSE).encode()
+        self.client.session.get = MagicMock(return_value=response)
+
+        self.engine.sync_once()
+        self.engine.sync_once()
+
+        # A second client for the same account reuses the cached filter ID
+        other = MatrixLogin('https://matrix.org')
+        other.access_token = 'token'
+        other.user_id = '@filtertest:matrix.org'
+        self.assertEqual(other.get_sync_filter(), '42')
+
+        self.assertEqual(self.client.session.post.call_count, 1)
+        self.assertIn('/user/%40filtertest%3Amatrix.org/filter', self.client.session.post.call_args[0][0])
+        self.assertEqual(self.client.session.get.call_args[1]['params']['filter'], '42')
+
+    def test_sync_filter_falls_back_to_inline(self):
+        """Test that a failed filter upload falls back to an inline filter"""
+        self.client.user_id = '@inline:matrix.org'
+        self.client.session.post = MagicMock(return_value=MagicMock(status_code=500))
+
+        first = self.client.get_sync_filter()
+        second = self.client.get_sync_filter()
+
+        self.assertEqual(json.loads(first)['room']['state']['lazy_load_members'], True)
+        self.assertEqual(first, second)
+        self.assertEqual(self.client.session.post.call_count, 1)
+
+
+class TestMessageQueue(unittest.TestCase):
+    def setUp(self):
+        self.client = MatrixLogin('https://matrix.org')
+        self.client.access_token = 'token'
+
+    def test_queue_is_opt_in(self):
+        """Test that messages are only queued once the queue is enabled"""
+        self.client.sync_engine.dispatch(SYNC_RESPONSE)
+        self.assertIsNone(self.client.message_queue)
+        self.assertIsNone(self.client.get_next_message(timeout=0))
+
+        self.client.enable_message_queue()
+        self.client.sync_engine.dispatch(SYNC_RESPONSE)
+        events = [self.client.get_next_message(timeout=0)['event_id'] for _ in range(2)]
+        self.assertEqual(sorted(events), ['$a1', '$b1'])
+        self.assertIsNone(self.client.get_next_message(timeout=0))
+
+    def test_drop_oldest(self):
+        """Test that a full queue drops its oldest message and counts it"""
+        queue = MessageQueue(2, OVERFLOW_DROP_OLDEST)
+        for i in range(5):
+            self.assertTrue(queue.put({'n': i}))
+
+        self.assertEqual([queue.get(0)['n'] for _ in range(2)], [3, 4])
+        self.assertEqual(queue.stats(), {'size': 0, 'dropped': 3, 'high_water': 2})
+
+    def test_drop_newest(self):
+        """Test that a full queue drops new messages and counts them"""
+        queue = MessageQueue(2, OVERFLOW_DROP_NEWEST)
+        results = [queue.put({'n': i}) for i in range(5)]
+
+        self.assertEqual(results, [True, True, False, False, False])
+        self.assertEqual([queue.get(0)['n'] for _ in range(2)], [0, 1])
+        self.assertEqual(queue.stats()['dropped'], 3)
+
+    def test_block_until_taken(self):
+        """Test that a full blocking queue holds the producer until a message is taken"""
+        queue = MessageQueue(1, OVERFLOW_BLOCK)
+        queue.put({'n': 0})
+        producer = threading.Thread(target=queue.put, args=({'n': 1},))
+        producer.start()
+        producer.join(0.1)
+        self.assertTrue(producer.is_alive())
+
+        self.assertEqual(queue.get(1)['n'], 0)
+        producer.join(1)
+        self.assertFalse(producer.is_alive())
+        self.assertEqual(queue.get(1)['n'], 1)
+        self.assertEqual(queue.stats(), {'size': 0, 'dropped': 0, 'high_water': 1})
+
+    def test_blocked_put_gives_up(self):
+        """Test that a blocked put drops its message when cancelled or the queue is closed"""
+        queue = MessageQueue(1, OVERFLOW_BLOCK)
+        queue.put({'n': 0})
+        cancel = threading.Event()
+        cancel.set()
+        self.assertFalse(queue.put({'n': 1}, cancel))
+        self.assertEqual(queue.stats()['dropped'], 1)
+
+        results = []
+        producer = threading.Thread(target=lambda: results.append(queue.put({'n': 2})))
+        producer.start()
+        queue.close()
+        producer.join(1)
+        self.assertEqual(results, [False])
+        self.assertEqual(len(queue), 0)
+
+    def test_invalid_arguments(self):
+        """Test that an unknown policy or an unbounded size is rejected"""
+        with self.assertRaises(ValueError):
+            MessageQueue(0)
+        with self.assertRaises(ValueError):
+            MessageQueue(10, 'unbounded')
+
+
+if __name__ == '__main__':
+    unittest.main()
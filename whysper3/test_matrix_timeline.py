@@ -0,0 +1,165 @@
+import unittest
+from PyQt5.QtWidgets import QApplication
+from PyQt5.QtCore import Qt
+from PyQt5.QtGui import QPixmap
+import sys
+from matrix_timeline import TimelineModel, PixmapCache, MessageRole
+
+def make_message(body, url=None):
+    content = {'msgtype': 'm.image' if url else 'm.text', 'body': body}
+    if url:
+        content['url'] = url
+    return {'sender': '@testuser:matrix.org', 'content': content, 'origin_server_ts': 1234567890000}
+
+class TestTimelineModel(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.app = QApplication.instance() or QApplication(sys.argv)
+        
+    def setUp(self):
+        self.model = TimelineModel()
+        
+    def bodies(self):
+        return [self.model.index(row).data(MessageRole)['content']['body']
+                for row in range(self.model.rowCount())]
+        
+    def test_append_and_prepend_keep_order(self):
+        """Test rows stay in chronological order when appending and prepending"""
+        self.model.append_messages([make_message('3'), make_message('4')])
+        self.model.prepend_messages([make_message('2'), make_message('1')])
+        self.model.append_messages([make_message('5')])
+        
+        self.assertEqual(self.bodies(), ['1', '2', '3', '4', '5'])
+        self.assertEqual(self.model.index(0).data(), '@testuser:matrix.org: 1')
+        
+    def test_insert_signals(self):
+        """Test only the inserted rows are reported to the view"""
+        self.model.append_messages([make_message('2')])
+        inserted = []
+        self.model.rowsInserted.connect(lambda parent, first, last: inserted.append((first, last)))
+        
+        self.model.prepend_messages([make_message('1'), make_message('0')])
+        self.model.append_messages([make_message('3')])
+        
+        self.assertEqual(inserted, [(0, 1), (3, 3)])
+        
+    def test_media_changed(self):
+        """Test loading media updates every row showing it, also after prepending"""
+        self.model.append_messages([make_message('a', 'mxc://test.com/image'), make_message('b')])
+        self.model.prepend_messages([make_message('c', 'mxc://test.com/image'), make_message('d')])
+        changed = []
+        self.model.dataChanged.connect(lambda top, bottom, roles: changed.append(top.row()))
+        
+        self.model.media_changed('mxc://test.com/image')
+        
+        self.assertEqual(sorted(changed), [1, 2])
+        for row in changed:
+            self.assertEqual(self.model.index(row).data(MessageRole)['content']['url'], 'mxc://test.com/image')
+        
+    def test_remove_rows(self):
+        """Test releasing rows from either end keeps the rest and their media rows"""
+        self.model.append_messages([make_message('3', 'mxc://test.com/image'), make_message('4')])
+        self.model.prepend_messages([make_message('2'), make_message('1', 'mxc://test.com/image')])
+        self.model.append_messages([make_message('5')])
+        
+        self.model.remove_oldest(1)
+        self.model.remove_newest(2)
+        
+        self.assertEqual(self.bodies(), ['2', '3'])
+        changed = []
+        self.model.dataChanged.connect(lambda top, bottom, roles: changed.append(top.row()))
+        self.model.media_changed('mxc://test.com/image')
+        self.assertEqual(changed, [1])
+        
+        # Rows can still be added at both ends afterwards
+        self.model.prepend_messages([make_message('1')])
+        self.model.append_messages([make_message('4')])
+        self.assertEqual(self.bodies(), ['1', '2', '3', '4'])
+        
+    def test_has_event(self):
+        """Test the model knows which events it shows"""
+        message = make_message('a')
+        message['event_id'] = '$event1'
+        self.model.append_messages([message, make_message('b')])
+        
+        self.assertTrue(self.model.has_event('$event1'))
+        self.assertFalse(self.model.has_event('$event2'))
+        self.assertFalse(self.model.has_event(None))
+        self.model.remove_oldest(1)
+        self.assertFalse(self.model.has_event('$event1'))
+        
+    def test_transaction_rows(self):
+        """Test echoes are found by transaction ID while rows are added and removed around them"""
+        echo = make_message('sending')
+        echo['unsigned'] = {'transaction_id': 'txn1'}
+        self.model.append_messages([make_message('a'), echo])
+        self.model.prepend_messages([make_message('older')])
+        self.assertEqual(self.model.transaction_row('txn1'), 2)
+        self.assertIsNone(self.model.transaction_row('txn2'))
+        
+        changed = []
+        self.model.dataChanged.connect(lambda first, last, roles: changed.append(first.row()))
+        event = make_message('sent')
+        event['event_id'] = '$sent'
+        event['unsigned'] = {'transaction_id': 'txn1'}
+        self.model.replace_message(2, event)
+        self.assertEqual(changed, [2])
+        self.assertEqual(self.bodies(), ['older', 'a', 'sent'])
+        self.assertTrue(self.model.has_event('$sent'))
+        
+        self.model.remove_oldest(2)
+        self.assertEqual(self.model.transaction_row('txn1'), 0)
+        
+    def test_clear(self):
+        """Test clearing removes all rows and tracked media"""
+        self.model.append_messages([make_message('a', 'mxc://test.com/image')])
+        self.model.clear()
+        
+        self.assertEqual(self.model.rowCount(), 0)
+        self.assertEqual(self.model.media_rows, {})
+
+class TestPixmapCache(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.app = QApplication.instance() or QApplication(sys.argv)
+        
+    def make_pixmap(self, size):
+        pixmap = QPixmap(size, size)
+        pixmap.fill(Qt.blue)
+        return pixmap
+        
+    def test_keyed_by_uri_and_size(self):
+        """Test pixmaps are found by URI and rendered size"""
+        cache = PixmapCache()
+        pixmap = self.make_pixmap(10)
+        cache.put('mxc://test.com/image', 300, pixmap)
+        
+        self.assertIs(cache.get('mxc://test.com/image', 300), pixmap)
+        self.assertIsNone(cache.get('mxc://test.com/image', 100))
+        self.assertIsNone(cache.get('mxc://test.com/other', 300))
+        
+    def test_budget(self):
+        """Test the least recently used pixmaps are evicted to fit the budget"""
+        pixmap = self.make_pixmap(10)
+        cache = PixmapCache(budget=2 * cache_cost(pixmap))
+        cache.put('mxc://test.com/a', 300, pixmap)
+        cache.put('mxc://test.com/b', 300, self.make_pixmap(10))
+        cache.get('mxc://test.com/a', 300)
+        cache.put('mxc://test.com/c', 300, self.make_pixmap(10))
+        
+        self.assertIsNotNone(cache.get('mxc://test.com/a', 300))
+        self.assertIsNone(cache.get('mxc://test.com/b', 300))
+        self.assertIsNotNone(cache.get('mxc://test.com/c', 300))
+        self.assertEqual(cache.size, 2 * cache_cost(pixmap))
+        
+        # Replacing a pixmap doesn't count it twice, oversized ones aren't kept
+        cache.put('mxc://test.com/c', 300, self.make_pixmap(10))
+        self.assertEqual(cache.size, 2 * cache_cost(pixmap))
+        cache.put('mxc://test.com/d', 300, self.make_pixmap(100))
+        self.assertIsNone(cache.get('mxc://test.com/d', 300))
+
+def cache_cost(pixmap):
+    return pixmap.width() * pixmap.height() * pixmap.depth() // 8
+
+if __name__ == '__main__':
+    unittest.main()